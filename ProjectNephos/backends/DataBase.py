@@ -1,8 +1,25 @@
-from sqlalchemy import create_engine, ForeignKey, Boolean, event, or_
+import contextlib
+import fcntl
+import functools
+import os
+import random
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine, ForeignKey, Boolean, event, or_, and_, select
+from sqlalchemy import exists, case, inspect
+from sqlalchemy import Table
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, Integer
-from sqlalchemy.orm import sessionmaker, validates
+from sqlalchemy import Column, String, Integer, Float
+from sqlalchemy.orm import sessionmaker, validates, relationship
+
+from logging import getLogger
+
+logger = getLogger(__name__)
 
 Base = declarative_base()
 
@@ -25,6 +42,59 @@ class Channel(Base):
         )
 
 
+class ChannelCheck(Base):
+    """
+    Result of one health check of a channel. See check_channel_up.
+    """
+    __tablename__ = "channel_check"
+
+    id = Column(Integer, primary_key=True)
+    channel = Column(String, ForeignKey("channel.name"), index=True)
+    checked_at = Column(Float, index=True)  # Unix timestamp
+    is_up = Column(Boolean)
+    packets = Column(Integer)  # TS packets read
+    errors = Column(Integer)  # broken TS packets
+    message = Column(String)
+
+    def __repr__(self):
+        return "<ChannelCheck: {} at {}, UP: {}, packets={}, errors={}, {}>".format(
+            self.channel,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.checked_at)),
+            self.is_up,
+            self.packets,
+            self.errors,
+            self.message,
+        )
+
+
+class Tag(Base):
+    """
+    Every tag used by a job or a schedule, stored once.
+    """
+    __tablename__ = "tag"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(1200), unique=True, nullable=False)
+
+    def __repr__(self):
+        return "<Tag: {}>".format(self.name)
+
+
+job_tag = Table(
+    "job_tag",
+    Base.metadata,
+    Column("job_id", Integer, ForeignKey("job.id"), primary_key=True),
+    Column("tag_id", Integer, ForeignKey("tag.id"), primary_key=True, index=True),
+)
+
+schedule_tag = Table(
+    "schedule_tag",
+    Base.metadata,
+    Column("schedule_id", Integer, ForeignKey("schedule.id"), primary_key=True),
+    Column("tag_id", Integer, ForeignKey("tag.id"), primary_key=True, index=True),
+)
+
+
 class Job(Base):
     """
     Define jobs for each channel.
@@ -34,19 +104,24 @@ class Job(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(1200), unique=True, nullable=False)
-    channel = Column(String, ForeignKey("channel.name"))
+    channel = Column(String, ForeignKey("channel.name"), index=True)
 
-    start = Column(String(16))
+    start = Column(String(16), index=True)
     duration = Column(Integer)
 
     convert_to = Column(String(8))
     subtitles = Column(Boolean)
     upload = Column(Boolean)
+    # Comma separated copy of tag_list, for display.
     tags = Column(String(1200))
+    tag_list = relationship(Tag, secondary=job_tag)
 
     # True if the jobs are already scheduled. False if they need to be scheduled.
     # Note that this field is ignored during the first run of the scheduler.
     in_execution = Column(Boolean)
+    # Unix timestamp of the last change. The server polls this to pick up new and
+    # changed jobs, see Server.add_recording_jobs.
+    updated_at = Column(Float, default=time.time, onupdate=time.time)
 
     def __repr__(self):
         return "<Job: namne={}, channel={}, convert_to={}, upload={}, tags={}>".format(
@@ -63,12 +138,14 @@ class Schedule(Base):
 
     id = Column(Integer, primary_key=True)
 
-    channel = Column(String, ForeignKey("channel.name"))
+    channel = Column(String, ForeignKey("channel.name"), index=True)
     program = Column(String, nullable=False)
-    start = Column(String(16))
+    start = Column(String(16), index=True)
     duration = Column(Integer)
 
+    # Comma separated copy of tag_list, for display.
     tags = Column(String)
+    tag_list = relationship(Tag, secondary=schedule_tag)
 
     def __repr__(self):
         return "<Schedule: program={}, channel={}, start={}, duration={}, tags={}>".format(
@@ -83,7 +160,7 @@ class Permission(Base):
     __tablename__ = "permission"
 
     id = Column(Integer, primary_key=True)
-    tag = Column(String(1200))
+    tag = Column(String(1200), index=True)
     role = Column(String(16))
     email = Column(String(128))
 
@@ -101,6 +178,10 @@ class Download(Base):
     Update this table whenever a download completes.
     This is associated with a job name. It retrieves metadata
     from the job.
+
+    Rows are handed to workers with a lease. A claimed row belongs to `claimed_by`
+    until `lease_expires`, after which any worker may claim it again. Rows are only
+    deleted once the worker acknowledges that processing is done.
     """
     __tablename__ = "downloads"
 
@@ -108,29 +189,371 @@ class Download(Base):
     filename = Column(String, nullable=False)  # Full path to the filename
     jobname = Column(String, ForeignKey("job.name"))  # Associated Job
 
+    # One of "pending", "claimed" or "failed"
+    status = Column(String(16), nullable=False, server_default="pending")
+    claimed_by = Column(String(128))
+    lease_expires = Column(Float)  # Unix timestamp
+    attempts = Column(Integer, nullable=False, server_default="0")
+
+    # Segmented recordings queue each segment as soon as it is recorded, with the
+    # filename of the whole recording as parent. The whole recording is queued last,
+    # with the number of segments, and only handed out once its segments are done.
+    parent = Column(String, index=True)
+    segments = Column(Integer)
+
     def __repr__(self):
         return "<Download: {} ## {}>".format(self.filename, self.jobname)
 
 
+class UploadSession(Base):
+    """
+    Resumable upload sessions that have been started but not finished. A file is
+    identified by its path, size and modification time so that a changed file is
+    never resumed into an old session.
+    """
+    __tablename__ = "upload_session"
+
+    id = Column(Integer, primary_key=True)
+    filename = Column(String, nullable=False)
+    size = Column(Integer)
+    mtime = Column(Float)
+    uri = Column(String, nullable=False)
+
+    def __repr__(self):
+        return "<UploadSession: {} ## {}>".format(self.filename, self.uri)
+
+
+class DriveFolder(Base):
+    """
+    Ids of the folders created on Google Drive, by their path. This saves looking a
+    folder up before every upload into it.
+    """
+    __tablename__ = "drive_folder"
+
+    path = Column(String, primary_key=True)
+    fileid = Column(String, nullable=False)
+
+    def __repr__(self):
+        return "<DriveFolder: {} ## {}>".format(self.path, self.fileid)
+
+
+class IndexedFile(Base):
+    """
+    Local copy of what has been uploaded to each backend. This is what searches are
+    answered from, so that the backends themselves don't have to be walked.
+    """
+    __tablename__ = "indexed_file"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, index=True)
+    folder = Column(String)
+    backend = Column(String(32), nullable=False)
+    fileid = Column(String, nullable=False, index=True)
+
+    tags = relationship("IndexedTag", cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return "<IndexedFile: {} ## {}: {}>".format(
+            self.name, self.backend, self.fileid
+        )
+
+
+class IndexedTag(Base):
+    __tablename__ = "indexed_tag"
+
+    id = Column(Integer, primary_key=True)
+    file_id = Column(Integer, ForeignKey("indexed_file.id"), nullable=False, index=True)
+    tag = Column(String, nullable=False, index=True)
+
+
+class IndexedBackend(Base):
+    """
+    Backends whose whole content has been indexed, see DBStorage.replace_index. Only
+    these can be searched through the index, as files uploaded before the index
+    existed are missing from it otherwise.
+    """
+    __tablename__ = "indexed_backend"
+
+    backend = Column(String(32), primary_key=True)
+    indexed_at = Column(Float)  # Unix timestamp
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _add_missing_columns(engine):
+    """
+    create_all only creates missing tables. Columns added to an existing table
+    in a later version are added here so that old databases keep working.
+    """
+    for table in Base.metadata.sorted_tables:
+        existing = [
+            row[1] for row in engine.execute("PRAGMA table_info({})".format(table.name))
+        ]
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+                table.name, column.name, column.type.compile(engine.dialect)
+            )
+            if column.server_default is not None:
+                ddl += " NOT NULL DEFAULT '{}'".format(column.server_default.arg)
+            engine.execute(ddl)
+
+
+def _add_missing_indexes(engine):
+    """
+    Same as _add_missing_columns, for indexes.
+    """
+    for table in Base.metadata.sorted_tables:
+        existing = [
+            row[1] for row in engine.execute("PRAGMA index_list({})".format(table.name))
+        ]
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+def _get_tags(session, names, cache=None):
+    """
+    Takes:
+        An open session.
+        List of tag names.
+        (optional) dictionary of already looked up tags, which is kept up to date.
+    Returns:
+        The Tag objects for the names, created if they don't exist yet.
+    """
+    if cache is None:
+        cache = {}
+    names = list(dict.fromkeys(x.strip() for x in names if x and x.strip()))
+
+    missing = [x for x in names if x not in cache]
+    if missing:
+        for tag in session.query(Tag).filter(Tag.name.in_(missing)):
+            cache[tag.name] = tag
+        for name in missing:
+            if name not in cache:
+                cache[name] = Tag(name=name)
+                session.add(cache[name])
+    return [cache[x] for x in names]
+
+
+def _migrate_tags(engine):
+    """
+    Tags used to be stored only as comma separated strings. Fill in the tag tables for
+    the rows that don't have their tags there yet.
+    """
+    session = sessionmaker(bind=engine)()
+    cache = {}
+    for model in (Job, Schedule):
+        rows = (
+            session.query(model)
+            .filter(model.tags != None, model.tags != "")  # noqa: E711
+            .filter(~model.tag_list.any())
+        )
+        for row in rows:
+            row.tag_list = _get_tags(session, row.tags.split(","), cache)
+    session.commit()
+    session.close()
+
+
+def init_schema(engine):
+    """
+    Create the tables, columns and indexes that are missing from the database and
+    move old data over to the current layout.
+    """
+    Base.metadata.create_all(engine)
+    _add_missing_columns(engine)
+    _add_missing_indexes(engine)
+    _migrate_tags(engine)
+
+
+class WriterLock(object):
+    """
+    Lets only one writer at a time, across all processes, into the database. Writers
+    queue up on an exclusive lock of a file next to the database instead of all
+    hammering SQLite, which only retries busy writers at intervals.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # flock only excludes other processes, threads need their own lock.
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def held(self):
+        """
+        Hold the lock for the duration of the with block. The lock is reentrant.
+        """
+        with self._lock:
+            if self._depth == 0:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def _set_wal(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+def get_engine(config):
+    """
+    Engines are expensive to create and hold a pool of connections, so there is only
+    one per database per process. It is created, and the schema brought up to date,
+    the first time the database is opened in a process. Processes don't share
+    engines as pooled connections must not cross a fork.
+
+    The following options are read from the `recording` section of the config:
+        db_location: path to the SQLite database.
+        db_wal: use write-ahead logging, so that readers and a writer don't block
+            each other.
+        db_busy_timeout: seconds to wait for a lock before failing with
+            "database is locked".
+        db_single_writer: serialize writes to busy tables, see WriterLock.
+
+    Returns:
+        The engine, a session factory bound to it and the WriterLock (or None).
+    """
+    location = config["recording", "db_location"]
+    key = (location, os.getpid())
+    with _engines_lock:
+        if key not in _engines:
+            engine = create_engine(
+                "sqlite:///" + location,
+                poolclass=QueuePool,
+                connect_args={
+                    # Pooled connections are handed to whichever thread needs one.
+                    "check_same_thread": False,
+                    "timeout": float(config["recording", "db_busy_timeout"]),
+                },
+            )
+            if config["recording", "db_wal"] is True:
+                event.listen(engine, "connect", _set_wal)
+            init_schema(engine)
+
+            writer_lock = None
+            if config["recording", "db_single_writer"] is True:
+                writer_lock = WriterLock(location + ".lock")
+            _engines[key] = (engine, sessionmaker(bind=engine), writer_lock)
+        return _engines[key]
+
+
+def _writes(serialize=False):
+    """
+    Decorator for the DBStorage methods that write. If the database stays locked for
+    longer than the busy timeout, the write is rolled back and tried again, up to
+    `db_retries` times, with an exponential backoff. Inside a unit of work the whole
+    unit would have to be redone, so the error is raised instead.
+
+    Writes marked with `serialize` also wait for the WriterLock, if it is enabled.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    with self._writer(serialize):
+                        return func(self, *args, **kwargs)
+                except OperationalError as e:
+                    if "locked" not in str(e) or self._units or attempt >= self.retries:
+                        raise
+                    self.session.rollback()
+
+                delay = self.RETRY_DELAY * 2 ** attempt * (0.5 + random.random())
+                logger.warning(
+                    "Database locked during {}. Retrying in {:.2f}s".format(
+                        func.__name__, delay
+                    )
+                )
+                time.sleep(delay)
+                attempt += 1
+
+        return wrapper
+
+    return decorator
+
+
 class DBStorage(object):
     """
     This class encompasses all our interactions with the database.
     This will connect to the SQL database and perform operations.
+
+    Creating one is cheap as the engine is shared, see get_engine. Every operation
+    commits on its own unless it is part of a `unit_of_work`.
     """
 
+    # How long a claimed download belongs to a worker before it is handed out again.
+    LEASE_TIME = 4 * 60 * 60
+    # Downloads that failed this many times are not handed out anymore.
+    MAX_ATTEMPTS = 3
+    # Seconds to wait before retrying a write that found the database locked. Doubles
+    # with every retry.
+    RETRY_DELAY = 0.1
+    # Seconds to keep channel checks for.
+    CHECK_HISTORY = 7 * 24 * 60 * 60
+    # Values looked up per IN query. SQLite allows 999 parameters per statement.
+    LOOKUP_SIZE = 500
+
     def __init__(self, config):
         self.config = config
+        self.engine, Session, self.writer_lock = get_engine(config)
+        self.session = Session()
+        self.retries = int(config["recording", "db_retries"])
+        self._units = 0
 
-        db_file = "sqlite:///" + config["recording", "db_location"]
-        self.engine = create_engine(db_file)
+    def _writer(self, serialize):
+        if not serialize or self.writer_lock is None or self._units:
+            # Holding the lock until a unit of work commits could deadlock with a
+            # process that holds the lock and waits for this one's transaction.
+            return contextlib.suppress()
+        return self.writer_lock.held()
 
-        self.engine.execute("pragma foreign_keys=ON;")
+    def _commit(self):
+        if self._units:
+            # Part of a unit of work, which commits once it is done.
+            self.session.flush()
+        else:
+            self.session.commit()
 
-        Base.metadata.create_all(self.engine)
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        """
+        Group several operations into a single transaction. Operations inside the with
+        block don't commit on their own. Everything is committed when the block ends,
+        or rolled back if it raises. Units of work can be nested, in which case only
+        the outermost one commits.
+        """
+        self._units += 1
+        try:
+            yield self
+        except BaseException:
+            self.session.rollback()
+            raise
+        else:
+            if self._units == 1:
+                self.session.commit()
+        finally:
+            self._units -= 1
 
-        Session = sessionmaker()
-        Session.configure(bind=self.engine)
-        self.session = Session()
+    def close(self):
+        """
+        Give the connection back to the pool. The object can still be used afterwards,
+        it will simply check out a connection again.
+        """
+        self.session.close()
 
     @staticmethod
     @event.listens_for(Engine, "connect")
@@ -146,6 +569,7 @@ class DBStorage(object):
         cursor.execute("PRAGMA foreign_keys=ON")
         cursor.close()
 
+    @_writes()
     def add_permissions(self, tags, email, role="reader"):
         """
         Store permissions. Permissions are of the form of (tag, mail, role) tuple.
@@ -162,7 +586,7 @@ class DBStorage(object):
         for tag in tags:
             entry = Permission(tag=tag, email=email, role=role)
             self.session.add(entry)
-        self.session.commit()
+        self._commit()
 
     def get_permissions(self, tag=None):
         """
@@ -177,6 +601,20 @@ class DBStorage(object):
             response = self.session.query(Permission).filter(Permission.tag == tag)
         return [(x.tag, x.email, x.role) for x in response]
 
+    def get_permissions_for_tags(self, tags):
+        """
+        Returns:
+            The set of (email, role) tuples that files with any of the tags are to be
+            shared with.
+        """
+        if not tags:
+            return set()
+        response = self.session.query(Permission.email, Permission.role).filter(
+            Permission.tag.in_(tags)
+        )
+        return set(response)
+
+    @_writes()
     def add_channel(self, name, ip):
         """
         Add a new channel to record. Currently not using most of the columns
@@ -189,7 +627,7 @@ class DBStorage(object):
 
         entry = Channel(name=name, ip_string=ip)
         self.session.add(entry)
-        self.session.commit()
+        self._commit()
 
     def get_channels(self, name=None):
         if name is None:
@@ -197,16 +635,54 @@ class DBStorage(object):
         else:
             return self.session.query(Channel).filter(Channel.name == name).first()
 
+    @_writes()
     def set_channel_up(self, name):
         channel = self.session.query(Channel).filter(Channel.name == name).first()
         channel.is_up = True
-        self.session.commit()
+        self._commit()
 
+    @_writes()
     def set_channel_down(self, name):
         channel = self.session.query(Channel).filter(Channel.name == name).first()
         channel.is_up = False
-        self.session.commit()
+        self._commit()
 
+    @_writes()
+    def add_channel_checks(self, checks):
+        """
+        Record the results of checking many channels and mark them up or down, in a
+        single transaction. Checks older than CHECK_HISTORY are dropped.
+
+        Takes:
+            List of dictionaries with channel, is_up, packets, errors and message.
+        """
+        now = time.time()
+        self.session.bulk_insert_mappings(
+            ChannelCheck, [dict(x, checked_at=now) for x in checks]
+        )
+        self.session.bulk_update_mappings(
+            Channel, [{"name": x["channel"], "is_up": x["is_up"]} for x in checks]
+        )
+        self.session.query(ChannelCheck).filter(
+            ChannelCheck.checked_at < now - self.CHECK_HISTORY
+        ).delete(synchronize_session=False)
+        self._commit()
+
+    def get_channel_checks(self, name, limit=None):
+        """
+        Returns:
+            The recorded checks of the channel, newest first.
+        """
+        query = (
+            self.session.query(ChannelCheck)
+            .filter(ChannelCheck.channel == name)
+            .order_by(ChannelCheck.checked_at.desc(), ChannelCheck.id.desc())
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @_writes()
     def add_job(
         self, name, channel, start, duration, upload, convert_to, subtitles, tags
     ):
@@ -223,9 +699,111 @@ class DBStorage(object):
             convert_to=convert_to,
             subtitles=subtitles,
             tags=tagstring,
+            tag_list=_get_tags(self.session, tags or []),
         )
         self.session.add(entry)
-        self.session.commit()
+        self._commit()
+
+    @_writes()
+    def add_jobs(self, jobs, dry_run=False):
+        """
+        Add many jobs in a single transaction. A job is skipped if its name is taken
+        or if another job already records the same channel at the same start, be it
+        an existing job or an earlier job in the list.
+
+        Takes:
+            List of dictionaries with the arguments of `add_job`.
+            (optional) if True, only count what would happen and write nothing.
+        Returns:
+            Names of the jobs that were (or would be) added, names of those skipped
+            because of an existing job and names of those skipped because of an
+            earlier job in the list.
+        """
+        taken_names, taken_slots = set(), set()
+        # Every job adds up to three parameters to the query.
+        size = self.LOOKUP_SIZE // 3
+        for i in range(0, len(jobs), size):
+            chunk = jobs[i : i + size]
+            query = self.session.query(Job.name, Job.channel, Job.start).filter(
+                or_(
+                    Job.name.in_([x["name"] for x in chunk]),
+                    and_(
+                        Job.channel.in_(set(x["channel"] for x in chunk)),
+                        Job.start.in_(set(x["start"] for x in chunk)),
+                    ),
+                )
+            )
+            for name, channel, start in query:
+                taken_names.add(name)
+                taken_slots.add((channel, start))
+
+        new, existing, duplicates = [], [], []
+        names, slots = set(), set()
+        for job in jobs:
+            slot = job["channel"], job["start"]
+            if job["name"] in taken_names or slot in taken_slots:
+                existing.append(job["name"])
+            elif job["name"] in names or slot in slots:
+                duplicates.append(job["name"])
+            else:
+                names.add(job["name"])
+                slots.add(slot)
+                new.append(job)
+
+        if dry_run or not new:
+            return [x["name"] for x in new], existing, duplicates
+
+        self.session.bulk_insert_mappings(
+            Job,
+            [
+                {
+                    "name": x["name"],
+                    "channel": x["channel"],
+                    "start": x["start"],
+                    "duration": x["duration"],
+                    "upload": x["upload"],
+                    "convert_to": x["convert_to"],
+                    "subtitles": x["subtitles"],
+                    "tags": ",".join(x["tags"]) if x["tags"] else None,
+                }
+                for x in new
+            ],
+        )
+
+        all_tags = set(t for x in new for t in x["tags"] or [])
+        tags = {t.name: t for t in _get_tags(self.session, all_tags)}
+        self.session.flush()
+
+        ids = {}
+        new_names = [x["name"] for x in new]
+        for i in range(0, len(new_names), self.LOOKUP_SIZE):
+            chunk = new_names[i : i + self.LOOKUP_SIZE]
+            ids.update(
+                self.session.query(Job.name, Job.id).filter(Job.name.in_(chunk))
+            )
+
+        links = [
+            {"job_id": ids[x["name"]], "tag_id": tags[t].id}
+            for x in new
+            for t in set(y.strip() for y in x["tags"] or [])
+            if t
+        ]
+        if links:
+            self.session.execute(job_tag.insert(), links)
+        self._commit()
+        return new_names, existing, duplicates
+
+    def get_jobs_by_tags(self, tags):
+        """
+        Returns:
+            All jobs that have any of the tags.
+        """
+        return (
+            self.session.query(Job)
+            .filter(Job.tag_list.any(Tag.name.in_(tags)))
+            .order_by(Job.name)
+            .all()
+        )
 
     def get_job(self, jobname=None):
         if jobname is None:
@@ -233,27 +811,237 @@ class DBStorage(object):
         else:
             return self.session.query(Job).filter(Job.name == jobname).first()
 
-    def pop_download(self):
-        item = self.session.query(Download).first()
-        if item is None:
+    def get_job_versions(self):
+        """
+        Returns:
+            Dictionary of job id to the time the job was last changed.
+        """
+        return dict(self.session.query(Job.id, Job.updated_at))
+
+    def get_jobs_by_ids(self, ids):
+        ids = list(ids)
+        jobs = []
+        for i in range(0, len(ids), self.LOOKUP_SIZE):
+            chunk = ids[i : i + self.LOOKUP_SIZE]
+            jobs.extend(self.session.query(Job).filter(Job.id.in_(chunk)))
+        return jobs
+
+    @_writes(serialize=True)
+    def claim_download(self, worker, lease_time=None):
+        """
+        Lease the oldest available download to `worker`. A download is available if it
+        is pending or if the lease of the worker that claimed it has run out (which
+        generally means that the worker crashed). Downloads whose lease ran out on the
+        last of MAX_ATTEMPTS attempts are marked as failed, as release_download would
+        have. Segmented recordings are only available once none of their segments can
+        be processed anymore.
+
+        The claim is a single UPDATE statement, so two workers can never claim the
+        same download.
+
+        Takes:
+            Name of the claiming worker.
+            (optional) length of the lease in seconds.
+        Returns:
+            The claimed Download object or None if nothing is available.
+        """
+        if lease_time is None:
+            lease_time = self.LEASE_TIME
+        now = time.time()
+        token = "{}/{}".format(worker, uuid.uuid4().hex)
+
+        abandoned = (
+            self.session.query(Download)
+            .filter(Download.status == "claimed")
+            .filter(Download.lease_expires < now)
+            .filter(Download.attempts >= self.MAX_ATTEMPTS)
+            .update(
+                {
+                    Download.status: "failed",
+                    Download.claimed_by: None,
+                    Download.lease_expires: None,
+                },
+                synchronize_session=False,
+            )
+        )
+        if abandoned:
+            logger.warning(
+                "{} downloads ran out of attempts. Marked as failed.".format(abandoned)
+            )
+
+        # Segments that are still being processed or will be retried.
+        children = Download.__table__.alias("children")
+        unfinished = (
+            exists()
+            .where(children.c.parent == Download.filename)
+            .where(children.c.status != "failed")
+            .where(
+                (children.c.attempts < self.MAX_ATTEMPTS)
+                | (children.c.lease_expires >= now)
+            )
+        )
+        available = (
+            select([Download.id])
+            .where(
+                or_(
+                    Download.status == "pending",
+                    (Download.status == "claimed") & (Download.lease_expires < now),
+                )
+            )
+            .where(Download.attempts < self.MAX_ATTEMPTS)
+            .where(~unfinished)
+            .order_by(Download.id)
+            .limit(1)
+            .as_scalar()
+        )
+        claimed = (
+            self.session.query(Download)
+            .filter(Download.id == available)
+            .update(
+                {
+                    Download.status: "claimed",
+                    Download.claimed_by: token,
+                    Download.lease_expires: now + lease_time,
+                    Download.attempts: Download.attempts + 1,
+                },
+                synchronize_session=False,
+            )
+        )
+        self._commit()
+
+        if claimed == 0:
             return None
-        else:
-            self.session.delete(item)
-            self.session.commit()
-            return item
+        download = (
+            self.session.query(Download).filter(Download.claimed_by == token).first()
+        )
+        # Kept outside of the mapped columns, so that a commit doesn't replace it with
+        # the token of whoever holds the lease now. See _lease.
+        download.lease_token = token
+        return download
+
+    def _lease(self, download):
+        """
+        Returns:
+            A query for the row of `download` that only matches while the lease taken
+            by claim_download is still held.
+        """
+        # The identity is known without loading the (possibly deleted) row.
+        download_id = inspect(download).identity[0]
+        return self.session.query(Download).filter(
+            Download.id == download_id,
+            Download.claimed_by == getattr(download, "lease_token", None),
+        )
+
+    @staticmethod
+    def _lost_lease(download, action):
+        logger.warning(
+            "Lease on download {} was lost, not {}.".format(
+                inspect(download).identity[0], action
+            )
+        )
+        return False
+
+    @_writes(serialize=True)
+    def extend_lease(self, download, lease_time=None):
+        """
+        Push the lease of a claimed download further into the future. Long running
+        workers should call this between steps so the download isn't handed out again.
+
+        This, ack_download and release_download only touch the download while the
+        caller still holds the lease. Once it has run out and another worker claimed
+        the download, they do nothing.
+
+        Returns:
+            False if the lease was lost, True otherwise.
+        """
+        if lease_time is None:
+            lease_time = self.LEASE_TIME
+        updated = self._lease(download).update(
+            {Download.lease_expires: time.time() + lease_time},
+            synchronize_session=False,
+        )
+        self._commit()
+        return updated > 0 or self._lost_lease(download, "extended")
+
+    @_writes(serialize=True)
+    def ack_download(self, download):
+        """
+        Mark a claimed download as completely processed. This removes it from the queue.
+
+        Returns:
+            False if the lease was lost, True otherwise.
+        """
+        deleted = self._lease(download).delete(synchronize_session=False)
+        self._commit()
+        if deleted and download in self.session:
+            self.session.expunge(download)
+        return deleted > 0 or self._lost_lease(download, "acknowledged")
+
+    @_writes(serialize=True)
+    def release_download(self, download):
+        """
+        Give back a claimed download after a failed attempt so that it is retried. Once it
+        has been attempted MAX_ATTEMPTS times, it is marked as failed instead.
+
+        Returns:
+            False if the lease was lost, True otherwise.
+        """
+        updated = self._lease(download).update(
+            {
+                Download.status: case(
+                    [(Download.attempts >= self.MAX_ATTEMPTS, "failed")],
+                    else_="pending",
+                ),
+                Download.claimed_by: None,
+                Download.lease_expires: None,
+            },
+            synchronize_session=False,
+        )
+        self._commit()
+        return updated > 0 or self._lost_lease(download, "released")
+
+    def get_failed_downloads(self):
+        return self.session.query(Download).filter(Download.status == "failed").all()
+
+    @_writes(serialize=True)
+    def pop_download(self):
+        """
+        Remove the oldest download from the queue and return it. This is the same as a
+        claim followed immediately by an ack, so a crash during processing loses it.
+        Prefer claim_download.
+
+        Returns:
+            The Download object or None if the queue is empty.
+        """
+        # A single transaction, so that a retry doesn't leave the first claim behind.
+        with self.unit_of_work():
+            item = self.claim_download("pop")
+            if item is None:
+                return None
+            self.session.expunge(item)
+            self.session.query(Download).filter(Download.id == item.id).delete(
+                synchronize_session=False
+            )
+        return item
 
-    def add_file(self, filename, jobname):
+    @_writes(serialize=True)
+    def add_file(self, filename, jobname, parent=None, segments=None):
         """
         This method adds files to the downloads table.
         Takes:
             The full path to the file.
             Name of the associated job.
+            (optional) full path of the recording, if the file is a segment of it.
+            (optional) number of segments, if the file was recorded in segments.
 
         """
-        entry = Download(filename=filename, jobname=jobname)
+        entry = Download(
+            filename=filename, jobname=jobname, parent=parent, segments=segments
+        )
         self.session.add(entry)
-        self.session.commit()
+        self._commit()
 
+    @_writes()
     def add_schedule(self, program, channel, start, duration, tags):
         entry = Schedule(
             program=program,
@@ -261,17 +1049,289 @@ class DBStorage(object):
             start=start,
             duration=duration,
             tags=",".join(tags),
+            tag_list=_get_tags(self.session, tags),
         )
         self.session.add(entry)
-        self.session.commit()
+        self._commit()
+
+    @_writes()
+    def import_schedule(self, items):
+        """
+        Add many schedule items in a single transaction. An item is identified by its
+        channel, start and program. Items that already exist get their duration and
+        tags updated instead of being added again.
+
+        Takes:
+            List of dictionaries with channel, program, start, duration and tags.
+        Returns:
+            Number of added items and number of updated items.
+        """
+        items = {(x["channel"], x["start"], x["program"]): x for x in items}
+        if not items:
+            return 0, 0
+
+        def lookup(keys):
+            keys = list(keys)
+            found = {}
+            # Every item can add a channel and a start to the query.
+            size = self.LOOKUP_SIZE // 2
+            for i in range(0, len(keys), size):
+                chunk = set(keys[i : i + size])
+                query = self.session.query(
+                    Schedule.id, Schedule.channel, Schedule.start, Schedule.program
+                ).filter(
+                    Schedule.channel.in_(set(x[0] for x in chunk)),
+                    Schedule.start.in_(set(x[1] for x in chunk)),
+                )
+                found.update(
+                    {(c, s, p): id for id, c, s, p in query if (c, s, p) in chunk}
+                )
+            return found
+
+        existing = lookup(items)
+        new = [k for k in items if k not in existing]
+
+        self.session.bulk_insert_mappings(
+            Schedule,
+            [
+                {
+                    "channel": items[k]["channel"],
+                    "program": items[k]["program"],
+                    "start": items[k]["start"],
+                    "duration": items[k]["duration"],
+                    "tags": ",".join(items[k]["tags"]),
+                }
+                for k in new
+            ],
+        )
+        self.session.bulk_update_mappings(
+            Schedule,
+            [
+                {
+                    "id": id,
+                    "duration": items[k]["duration"],
+                    "tags": ",".join(items[k]["tags"]),
+                }
+                for k, id in existing.items()
+            ],
+        )
+
+        ids = dict(existing)
+        if new:
+            ids.update(lookup(set(new)))
+
+        all_tags = set(t for x in items.values() for t in x["tags"])
+        tags = {t.name: t for t in _get_tags(self.session, all_tags)}
+        self.session.flush()
+
+        existing_ids = list(existing.values())
+        for i in range(0, len(existing_ids), self.LOOKUP_SIZE):
+            self.session.execute(
+                schedule_tag.delete().where(
+                    schedule_tag.c.schedule_id.in_(
+                        existing_ids[i : i + self.LOOKUP_SIZE]
+                    )
+                )
+            )
+        links = [
+            {"schedule_id": ids[k], "tag_id": tags[t].id}
+            for k, x in items.items()
+            for t in set(y.strip() for y in x["tags"])
+            if t
+        ]
+        if links:
+            self.session.execute(schedule_tag.insert(), links)
+        self._commit()
+        return len(new), len(existing)
 
     def get_schedule_items(self, channel=None, tags=None):
-        if tags is None and channel is None:
-            return self.session.query(Schedule).all()
-        if tags is None:
-            return (
-                self.session.query(Schedule).filter(Schedule.channel == channel).all()
+        """
+        Takes:
+            (optional) name of the channel.
+            (optional) list of tags. Items with any of these exact tags match.
+        Returns:
+            The matching schedule items, ordered by start time.
+        """
+        query = self.session.query(Schedule)
+        if channel is not None:
+            query = query.filter(Schedule.channel == channel)
+        if tags is not None:
+            query = query.filter(Schedule.tag_list.any(Tag.name.in_(tags)))
+        return query.order_by(Schedule.start).all()
+
+    def get_upload_session(self, filename, size, mtime):
+        """
+        Returns:
+            The session URI of an unfinished upload of this exact file, or None.
+        """
+        entry = (
+            self.session.query(UploadSession)
+            .filter(UploadSession.filename == filename)
+            .filter(UploadSession.size == size)
+            .filter(UploadSession.mtime == mtime)
+            .first()
+        )
+        if entry is None:
+            return None
+        return entry.uri
+
+    @_writes()
+    def add_upload_session(self, filename, size, mtime, uri):
+        self.delete_upload_session(filename)
+        entry = UploadSession(filename=filename, size=size, mtime=mtime, uri=uri)
+        self.session.add(entry)
+        self._commit()
+
+    @_writes()
+    def delete_upload_session(self, filename):
+        self.session.query(UploadSession).filter(
+            UploadSession.filename == filename
+        ).delete()
+        self._commit()
+
+    def get_folder_id(self, path):
+        """
+        Returns:
+            The id of the Drive folder at `path`, or None if it is not known.
+        """
+        entry = self.session.query(DriveFolder).get(path)
+        if entry is None:
+            return None
+        return entry.fileid
+
+    @_writes()
+    def add_folder_id(self, path, fileid):
+        self.session.merge(DriveFolder(path=path, fileid=fileid))
+        self._commit()
+
+    @_writes()
+    def delete_folder_id(self, path):
+        """
+        Forget the id of the folder at `path` along with all the folders inside it and
+        all the folders it is in, as any of them may be the one that was deleted.
+        """
+        parts = path.split("/")
+        ancestors = ["/".join(parts[:i]) for i in range(1, len(parts))]
+        self.session.query(DriveFolder).filter(
+            or_(
+                DriveFolder.path == path,
+                DriveFolder.path.like(path + "/%"),
+                DriveFolder.path.in_(ancestors),
             )
-        else:
-            paramaters = [Schedule.tags.like("%{}%".format(x)) for x in tags]
-            return self.session.query(Schedule).filter(or_(*paramaters)).all()
+        ).delete(synchronize_session=False)
+        self._commit()
+
+    @_writes()
+    def index_file(self, name, folder, backend, fileid, tags=None):
+        """
+        Add an uploaded file to the search index. Re-adding a file replaces the old entry.
+
+        Takes:
+            Name of the file.
+            Folder it was uploaded to (or None).
+            Name of the backend.
+            Id of the file on that backend.
+            (optional) list of tags of the file.
+        """
+        self._unindex_file(backend, fileid)
+        entry = IndexedFile(name=name, folder=folder, backend=backend, fileid=fileid)
+        for tag in tags or []:
+            entry.tags.append(IndexedTag(tag=tag))
+        self.session.add(entry)
+        self._commit()
+
+    @_writes()
+    def index_tags(self, backend, fileid, tags):
+        """
+        Add tags to a file already in the index.
+        """
+        entry = (
+            self.session.query(IndexedFile)
+            .filter(IndexedFile.backend == backend)
+            .filter(IndexedFile.fileid == fileid)
+            .first()
+        )
+        if entry is None:
+            return
+        for tag in tags:
+            entry.tags.append(IndexedTag(tag=tag))
+        self._commit()
+
+    def _unindex_file(self, backend, fileid):
+        entries = (
+            self.session.query(IndexedFile)
+            .filter(IndexedFile.backend == backend)
+            .filter(IndexedFile.fileid == fileid)
+        )
+        for entry in entries:
+            self.session.delete(entry)
+
+    @_writes()
+    def unindex_file(self, backend, fileid):
+        self._unindex_file(backend, fileid)
+        self._commit()
+
+    @_writes()
+    def replace_index(self, backend, files):
+        """
+        Replace everything indexed for a backend in one go. The backend counts as
+        indexed from then on, see get_indexed_backends.
+
+        Takes:
+            Name of the backend.
+            Iterable of (name, folder, fileid, tags) tuples.
+        """
+        for entry in self.session.query(IndexedFile).filter(
+            IndexedFile.backend == backend
+        ):
+            self.session.delete(entry)
+
+        for name, folder, fileid, tags in files:
+            entry = IndexedFile(
+                name=name, folder=folder, backend=backend, fileid=fileid
+            )
+            for tag in tags:
+                entry.tags.append(IndexedTag(tag=tag))
+            self.session.add(entry)
+        self.session.merge(IndexedBackend(backend=backend, indexed_at=time.time()))
+        self._commit()
+
+    def get_indexed_backends(self):
+        """
+        Returns:
+            Set of names of the backends that have been indexed completely.
+        """
+        return set(x for x, in self.session.query(IndexedBackend.backend))
+
+    def search_index(self, name_subs=None, tag_subs=None, do_and=False):
+        """
+        Search the index the same way the backends search. Name and tags are matched as
+        substrings and combined with OR, or with AND if do_and is set.
+
+        Returns:
+            A list of (filename, {backend: fileid}) tuples ordered by filename.
+        """
+        conditions = []
+        if name_subs is not None:
+            conditions.append(IndexedFile.name.like("%{}%".format(name_subs)))
+        for tag in tag_subs or []:
+            conditions.append(
+                IndexedFile.tags.any(IndexedTag.tag.like("%{}%".format(tag)))
+            )
+        if not conditions:
+            return []
+
+        combined = and_(*conditions) if do_and else or_(*conditions)
+        entries = (
+            self.session.query(IndexedFile)
+            .filter(combined)
+            .order_by(IndexedFile.name)
+        )
+
+        response = []
+        for entry in entries:
+            if response and response[-1][0] == entry.name:
+                response[-1][1][entry.backend] = entry.fileid
+            else:
+                response.append((entry.name, {entry.backend: entry.fileid}))
+        return response
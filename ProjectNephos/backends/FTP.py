@@ -1,19 +1,58 @@
+import contextlib
 import ftplib, io
+import threading
+import time
 from logging import getLogger
-from os.path import isfile
+from os.path import isfile, basename, dirname
 
+from ProjectNephos.backends.cache import ExpiringCache
+from ProjectNephos.backends.streams import copy_chunks
 from ProjectNephos.exceptions import AuthFailure, FileNotFound
 
 logger = getLogger(__name__)
 
 
-class FTPStorage(object):
+class FTPConnectionPool(object):
+    """
+    A bounded pool of logged in FTP control connections.
+
+    Connections are borrowed with `connection()` and given back when the with block
+    ends. At most `pool_max` connections exist at a time. If all of them are in use,
+    borrowers wait. Idle connections get a NOOP every `keepalive` seconds so that the
+    server doesn't drop them, and ones that have been idle longer than `idle_timeout`
+    are closed, as long as `pool_min` connections remain. Connections that break are
+    thrown away and replaced with freshly logged in ones.
+    """
 
     def __init__(self, config):
-        self.ftp = ftplib.FTP()
+        self.host = config["ftp", "host"]
+        self.port = int(config["ftp", "port"])
+        self.username = config["ftp", "username"]
+        self.password = config["ftp", "password"]
+
+        self.min_size = int(config["ftp", "pool_min"])
+        self.max_size = max(int(config["ftp", "pool_max"]), 1)
+        self.idle_timeout = float(config["ftp", "idle_timeout"])
+        self.keepalive = float(config["ftp", "keepalive"])
+
+        self._idle = []  # (connection, time it was last used)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = threading.Event()
+
+        for _ in range(self.min_size):
+            self._idle.append((self._connect(), time.time()))
+            self._size += 1
+
+        if self.keepalive > 0:
+            t = threading.Thread(target=self._keepalive_loop, daemon=True)
+            t.start()
+
+    def _connect(self):
+        ftp = ftplib.FTP()
 
         try:
-            self.ftp.connect(config["ftp", "host"], int(config["ftp", "port"]))
+            ftp.connect(self.host, self.port)
         except ConnectionError:
             logger.critical(
                 "Unable to connect to the server. Please check and try again"
@@ -23,7 +62,7 @@ class FTPStorage(object):
             logger.debug("FTP connection established.")
 
         try:
-            self.ftp.login(config["ftp", "username"], config["ftp", "password"])
+            ftp.login(self.username, self.password)
         except ftplib.error_perm:
             logger.critical(
                 "Bad username or password supplied. Please check and try again."
@@ -31,6 +70,138 @@ class FTPStorage(object):
             raise AuthFailure("Wrong credentials supplied")
         else:
             logger.debug("FTP authenticated successfully")
+        return ftp
+
+    @staticmethod
+    def _close(ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                self._cond.wait()
+
+            if self._idle:
+                return self._idle.pop()[0]
+            self._size += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, ftp):
+        if self._closed.is_set():
+            # Borrowed before the pool was closed.
+            self._discard(ftp)
+            return
+        with self._cond:
+            self._idle.append((ftp, time.time()))
+            self._cond.notify()
+
+    def _discard(self, ftp):
+        self._close(ftp)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of the with block.
+        """
+        ftp = self._acquire()
+        try:
+            yield ftp
+        except (ftplib.error_proto, EOFError, OSError):
+            # The connection itself is probably broken. Don't hand it out again.
+            # Other errors, including 4xx replies (error_temp), leave it usable.
+            self._discard(ftp)
+            raise
+        except BaseException:
+            self._release(ftp)
+            raise
+        else:
+            self._release(ftp)
+
+    def prune(self):
+        """
+        Close connections idle for longer than `idle_timeout` and NOOP the others
+        that haven't been used for `keepalive` seconds.
+        """
+        now = time.time()
+        with self._cond:
+            idle, self._idle = self._idle, []
+
+        for ftp, last_used in idle:
+            with self._cond:
+                keep_count = self._size - 1 >= self.min_size
+            if now - last_used > self.idle_timeout and keep_count:
+                logger.debug("Closing idle FTP connection.")
+                self._discard(ftp)
+                continue
+
+            if now - last_used > self.keepalive:
+                try:
+                    ftp.voidcmd("NOOP")
+                except Exception:
+                    logger.debug("Idle FTP connection broke. Replacing it.")
+                    self._discard(ftp)
+                    continue
+                last_used = now
+            with self._cond:
+                self._idle.append((ftp, last_used))
+                self._cond.notify()
+
+        with self._cond:
+            missing = self.min_size - self._size
+        for _ in range(missing):
+            try:
+                ftp = self._connect()
+            except Exception:
+                logger.exception("Unable to replace FTP connection")
+                break
+            with self._cond:
+                self._size += 1
+            self._release(ftp)
+
+    def _keepalive_loop(self):
+        while not self._closed.wait(self.keepalive):
+            self.prune()
+
+    def close(self):
+        self._closed.set()
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for ftp, _ in idle:
+            self._discard(ftp)
+
+
+class FTPStorage(object):
+    # Every operation borrows its own connection from the pool and only uses
+    # absolute paths, so nothing depends on a shared working directory.
+    THREAD_SAFE = True
+    # Largest piece of a file held in memory while streaming it.
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, config):
+        self.pool = FTPConnectionPool(config)
+        self.optimistic = config["others", "optimistic"] is True
+        self.exists_cache = ExpiringCache(config["others", "exists_ttl"])
+
+    def health_check(self):
+        with self.pool.connection() as ftp:
+            ftp.voidcmd("NOOP")
+        return True
+
+    def close(self):
+        self.pool.close()
 
     def write(self, filename, folder=None):
         logger.debug("Trying to upload {}".format(filename))
@@ -42,51 +213,80 @@ class FTPStorage(object):
         folder_path = ""
         if folder is not None:
             folder_path = self.create_folder(folder)
-        full_path = folder_path + "/" + filename
+        full_path = folder_path + "/" + basename(filename)
 
-        with open(filename, "rb") as f:
-            self.ftp.storbinary("STOR {}".format(full_path), f)
+        with open(filename, "rb") as f, self.pool.connection() as ftp:
+            ftp.storbinary("STOR {}".format(full_path), f)
 
+        self.exists_cache.set(full_path, True)
         return full_path
 
-    def is_exists(self, fullpath):
-        current_folder = self.ftp.pwd()
-
-        file_path = "/".join(fullpath.split("/")[:-1])
-        filename = fullpath.split("/")[-1]
-
-        self.ftp.cwd(file_path)
+    @staticmethod
+    def _is_exists(ftp, fullpath):
+        folder = dirname(fullpath) or "/"
+        filename = basename(fullpath)
 
-        files_in_pwd = list(self.ftp.mlsd())
-
-        if len(files_in_pwd) == 0:
+        try:
+            files_in_folder = list(ftp.mlsd(folder))
+        except ftplib.error_perm:
             return False
 
-        for file in files_in_pwd:
+        for file in files_in_folder:
             if file[0] == filename and file[1]["type"] == "file":
                 return True
-
-        self.ftp.cwd(current_folder)
         return False
 
-    def create_folder(self, foldername):
+    def is_exists(self, fullpath):
+        exists = self.exists_cache.get(fullpath)
+        if exists is None:
+            with self.pool.connection() as ftp:
+                exists = self._is_exists(ftp, fullpath)
+            self.exists_cache.set(fullpath, exists)
+        return exists
+
+    def _check_exists(self, ftp, fullpath):
+        """
+        Raise FileNotFound if the file does not exist. Listing the whole folder is
+        skipped in optimistic mode, where it is left to the operation itself to fail,
+        see `_not_found`.
+        """
+        if self.optimistic:
+            return
+        if not self._is_exists(ftp, fullpath):
+            logger.critical("Given file not found.")
+            raise FileNotFound("{} not found on server".format(fullpath))
+
+    @contextlib.contextmanager
+    def _not_found(self, fullpath):
+        """
+        Turn a "550 No such file" reply to a command on `fullpath` into a FileNotFound.
+        """
         try:
-            self.ftp.mkd(foldername)
-        except ftplib.error_perm:
-            logger.debug("Folder already exists.")
-        else:
-            logger.debug("Created new folder.")
+            yield
+        except ftplib.error_perm as e:
+            if not str(e).startswith("550"):
+                raise
+            self.exists_cache.set(fullpath, False)
+            logger.critical("Given file not found.")
+            raise FileNotFound("{} not found on server".format(fullpath))
+
+    def create_folder(self, foldername):
+        with self.pool.connection() as ftp:
+            try:
+                ftp.mkd("/" + foldername)
+            except ftplib.error_perm:
+                logger.debug("Folder already exists.")
+            else:
+                logger.debug("Created new folder.")
         return "/" + foldername
 
-    def _traverse_tree(self, start):
-        for item in self.ftp.mlsd(start):
+    def _traverse_tree(self, ftp, start):
+        for item in ftp.mlsd(start):
+            path = start.rstrip("/") + "/" + item[0]
             if item[1]["type"] == "dir":
-                old_pwd = self.ftp.pwd()
-                self.ftp.cwd(item[0])
-                yield from self._traverse_tree(".")
-                self.ftp.cwd(old_pwd)
-            else:
-                item[1]["folder"] = self.ftp.pwd()
+                yield from self._traverse_tree(ftp, path)
+            elif item[1]["type"] == "file":
+                item[1]["folder"] = start.rstrip("/")
                 yield item
 
     def search(self, name_subs=None, tag_subs=None, do_and=False):
@@ -97,65 +297,158 @@ class FTPStorage(object):
                 "Currently only one of name_subs or tag_subs can be provided."
             )
         matching_items = []
-        if name_subs is not None:
-            for file in self._traverse_tree("/"):
-                if file[0].endswith(".tag"):
-                    continue
-                else:
-                    if file[0].find(name_subs) != -1:
-                        matching_items.append(
-                            (file[0], file[1]["folder"] + "/" + file[0])
-                        )
-
-        if tag_subs is not None:
-            for file in self._traverse_tree("/"):
-                if file[0].endswith(".tag"):
-                    full_path = file[1]["folder"] + "/" + file[0]
-
-                    contents = self.read(full_path)
-                    matching_tags = list(map(contents.find, tag_subs))
-
-                    if do_and:
-                        if (
-                            len(list(filter(lambda x: x != -1, matching_tags)))
-                            == len(matching_tags)
-                            and len(matching_tags) > 0
-                        ):
-                            matching_items.append((file[0], full_path))
+        with self.pool.connection() as ftp:
+            if name_subs is not None:
+                for file in self._traverse_tree(ftp, "/"):
+                    if file[0].endswith(".tag"):
+                        continue
                     else:
-                        if len(list(filter(lambda x: x != -1, matching_tags))) > 0:
-                            matching_items.append((file[0], full_path))
+                        if file[0].find(name_subs) != -1:
+                            matching_items.append(
+                                (file[0], file[1]["folder"] + "/" + file[0])
+                            )
+
+            if tag_subs is not None:
+                for file in self._traverse_tree(ftp, "/"):
+                    if file[0].endswith(".tag"):
+                        full_path = file[1]["folder"] + "/" + file[0]
+
+                        contents = self._read(ftp, full_path).decode("utf-8")
+                        matching_tags = list(map(contents.find, tag_subs))
+
+                        if do_and:
+                            if (
+                                len(list(filter(lambda x: x != -1, matching_tags)))
+                                == len(matching_tags)
+                                and len(matching_tags) > 0
+                            ):
+                                matching_items.append((file[0], full_path))
+                        else:
+                            if len(list(filter(lambda x: x != -1, matching_tags))) > 0:
+                                matching_items.append((file[0], full_path))
 
         return matching_items
 
+    def list_files(self):
+        """
+        List every file on the server along with the folder it is in and its tags.
+        This is used to rebuild the search index.
+
+        Returns:
+            A list of (filename, foldername, fileid, tags) tuples.
+        """
+        response = []
+        with self.pool.connection() as ftp:
+            items = list(self._traverse_tree(ftp, "/"))
+            paths = set(x[1]["folder"] + "/" + x[0] for x in items)
+
+            for name, facts in items:
+                if name.endswith(".tag"):
+                    continue
+                path = facts["folder"] + "/" + name
+
+                tags = []
+                if path + ".tag" in paths:
+                    contents = self._read(ftp, path + ".tag").decode("utf-8")
+                    tags = [x for x in contents.split("\n") if x]
+                response.append((name, facts["folder"].lstrip("/") or None, path, tags))
+        return response
+
+    def _read(self, ftp, filepath):
+        self._check_exists(ftp, filepath)
+
+        fp = io.BytesIO()
+        with self._not_found(filepath):
+            ftp.retrbinary("RETR {}".format(filepath), fp.write)
+        return fp.getvalue()
+
     def read(self, filepath):
+        """
+        Read the whole file into memory. Use `read_to` or `iter_read` for anything
+        large.
+        """
         logger.debug("Trying to read file id: {}".format(filepath))
 
-        if self.is_exists(filepath):
-            fp = io.BytesIO()
-            self.ftp.retrbinary("RETR {}".format(filepath), fp.write)
-            return fp.getvalue().decode("ascii")
-        else:
-            logger.critical("Given file not found.")
-            raise FileNotFound("{} not found on drive".format(filepath))
+        with self.pool.connection() as ftp:
+            return self._read(ftp, filepath)
+
+    def iter_read(self, filepath, start=0, end=None):
+        """
+        Read the file at most BLOCK_SIZE bytes at a time. Optionally only the bytes
+        from `start` to `end` (inclusive) are read. The connection is held until the
+        generator is exhausted or closed.
+
+        Returns:
+            A generator of binary strings.
+        """
+        logger.debug("Trying to stream file id: {}".format(filepath))
+
+        with self.pool.connection() as ftp:
+            self._check_exists(ftp, filepath)
+
+            ftp.voidcmd("TYPE I")
+            with self._not_found(filepath):
+                conn = ftp.transfercmd("RETR {}".format(filepath), rest=start or None)
+
+            remaining = None if end is None else end + 1 - start
+            try:
+                with conn:
+                    while remaining is None or remaining > 0:
+                        size = self.BLOCK_SIZE
+                        if remaining is not None:
+                            size = min(size, remaining)
+                        chunk = conn.recv(size)
+                        if not chunk:
+                            break
+                        if remaining is not None:
+                            remaining -= len(chunk)
+                        yield chunk
+            finally:
+                try:
+                    ftp.voidresp()
+                except ftplib.error_temp:
+                    # "426 Transfer aborted" when the transfer is stopped early.
+                    pass
+
+    def read_to(self, filepath, dest, start=0, end=None):
+        """
+        Same as `iter_read` but writes the file to `dest`, which is either a path or
+        a binary file like object.
+
+        Returns:
+            The number of bytes written.
+        """
+        return copy_chunks(self.iter_read(filepath, start, end), dest)
 
     def delete(self, filepath):
-        if not self.is_exists(filepath):
+        try:
+            with self.pool.connection() as ftp:
+                self._check_exists(ftp, filepath)
+                with self._not_found(filepath):
+                    ftp.delete(filepath)
+        except FileNotFound:
             logger.warning("The provided fileid ({}) never existed.".format(filepath))
             return None
 
-        self.ftp.delete(filepath)
+        self.exists_cache.set(filepath, False)
         logger.debug("Fileid ({}) deleted.".format(filepath))
 
     def tag(self, filepath, tags):
-        if not self.is_exists(filepath):
-            logger.critical("Given file not found")
-            raise FileNotFound("The provided fileid {} does not exist".format(filepath))
+        with self.pool.connection() as ftp:
+            if self.optimistic:
+                # Storing the tag file would succeed even without the file, so ask
+                # the server about just this one file instead of listing the folder.
+                with self._not_found(filepath):
+                    ftp.sendcmd("MLST {}".format(filepath))
+            else:
+                self._check_exists(ftp, filepath)
 
-        tag_filepath = filepath + ".tag"
-        f = io.BytesIO(b"\n".join(map(lambda x: x.encode("utf-8"), tags)))
+            tag_filepath = filepath + ".tag"
+            f = io.BytesIO(b"\n".join(map(lambda x: x.encode("utf-8"), tags)))
 
-        self.ftp.storlines("STOR {}".format(tag_filepath), f)
+            ftp.storlines("STOR {}".format(tag_filepath), f)
 
     def add_permission_user(self, *_):
         return None
+
+    add_permissions_user = add_permission_user
@@ -1,3 +1,7 @@
+import contextlib
+import json
+import os
+import time
 from os.path import isfile
 from mimetypes import guess_type
 
@@ -13,6 +17,9 @@ from logging import getLogger
 
 from oauth2client.clientsecrets import InvalidClientSecretsError
 
+from ProjectNephos.backends.cache import ExpiringCache
+from ProjectNephos.backends.DataBase import DBStorage
+from ProjectNephos.backends.streams import copy_chunks
 from ProjectNephos.exceptions import AuthFailure, FileNotFound
 from ProjectNephos.config import Configuration
 
@@ -22,6 +29,14 @@ logger = getLogger(__name__)
 class DriveStorage(object):
     SCOPES = "https://www.googleapis.com/auth/drive"
     APPLICATION_NAME = "Project Nephos"
+    # Number of times a failed chunk is retried before giving up on the upload.
+    NUM_RETRIES = 5
+    # httplib2 connections must not be shared between threads.
+    THREAD_SAFE = False
+    # Largest pageSize the files.list API accepts.
+    MAX_PAGE_SIZE = 1000
+    # Largest number of calls the API accepts in a single batch request.
+    BATCH_SIZE = 100
 
     @staticmethod
     def _run_credentials_flow(client_secret_loc):
@@ -110,9 +125,32 @@ class DriveStorage(object):
         http = credentials.authorize(Http())
         service = discovery.build("drive", "v3", http=http)
 
+        self.service = service
         self.file_service = service.files()
         self.perm_service = service.permissions()
 
+        self.config = config
+        self.resumable = config["google", "resumable"] is True
+        self.chunk_size = int(config["google", "chunk_size"]) * 1024 * 1024
+        self.page_size = min(
+            int(config["google", "search_page_size"]), self.MAX_PAGE_SIZE
+        )
+        self.search_limit = int(config["google", "search_limit"]) or None
+        self.last_upload_stats = None
+        self._db = None
+
+        self.optimistic = config["others", "optimistic"] is True
+        self.exists_cache = ExpiringCache(config["others", "exists_ttl"])
+
+    @property
+    def db(self):
+        """
+        The database is only needed for some operations, so connect only when needed.
+        """
+        if self._db is None:
+            self._db = DBStorage(self.config)
+        return self._db
+
     def write(self, filename, folder=None):
         """
         Upload the file the Google Drive. The file should essentially exist before you try to upload it.
@@ -120,6 +158,8 @@ class DriveStorage(object):
         which is unique to each file.
 
         Optionally, it also takes the name of the folder you want to upload to.
+        If `resumable` is set in the config, the file is uploaded in chunks and an
+        interrupted upload can be resumed later.
         Takes:
             path to the file as a string.
             (optional) name of the folder to upload to.
@@ -132,9 +172,6 @@ class DriveStorage(object):
             logger.critical("No such file exists. Check path and try again")
             raise FileNotFound(filename + "does not exist")
 
-        media = MediaFileUpload(
-            filename=filename, mimetype=guess_type(filename)[0], chunksize=1024
-        )
         file_metadata = {
             "name": filename.split("/")[-1],  # Get filename from path
             "description": "",  # Required so that the field actually exists when the file is uploaded.
@@ -144,40 +181,245 @@ class DriveStorage(object):
             f_id = self.create_folder(folder)
             file_metadata["parents"] = [f_id]
 
-        f = self.file_service.create(body=file_metadata, media_body=media).execute()
+        try:
+            f = self._upload(filename, file_metadata)
+        except HttpError as e:
+            if folder is None or e.resp.status != 404:
+                raise
+            # The folder id was cached but the folder has since been deleted.
+            logger.warning("Folder {} not found. Looking it up again.".format(folder))
+            # Any folder along the path may be the one that is gone.
+            self.db.delete_folder_id(self._folder_path(folder))
+            file_metadata["parents"] = [self.create_folder(folder)]
+            f = self._upload(filename, file_metadata)
+
         logger.info("File successfully uploaded.")
         logger.debug("File metadata: {}".format(f))
+        self.exists_cache.set(f["id"], True)
         return f['id']
 
+    def _upload(self, filename, file_metadata):
+        if self.resumable:
+            return self._resumable_upload(filename, file_metadata)
+
+        media = MediaFileUpload(filename=filename, mimetype=guess_type(filename)[0])
+        return self.file_service.create(body=file_metadata, media_body=media).execute()
+
+    def _resumable_upload(self, filename, file_metadata):
+        """
+        Upload the file in chunks of `chunk_size` bytes. The session URI is stored in the
+        database as soon as the upload starts. If the upload is interrupted, even by a
+        restart, the next upload of the same (unchanged) file continues where the old
+        one left off instead of starting over.
+
+        Sets `last_upload_stats` to the bytes sent, the time taken and the throughput.
+
+        Takes:
+            path to the file as a string.
+            metadata to create the file with.
+        Returns:
+             The metadata dictionary
+        """
+        stat = os.stat(filename)
+        media = MediaFileUpload(
+            filename=filename,
+            mimetype=guess_type(filename)[0],
+            chunksize=self.chunk_size,
+            resumable=True,
+        )
+        request = self.file_service.create(body=file_metadata, media_body=media)
+
+        start_time = time.time()
+        resumed_from = 0
+        response = None
+
+        session_uri = self.db.get_upload_session(filename, stat.st_size, stat.st_mtime)
+        if session_uri is not None:
+            logger.info("Resuming earlier upload of {}".format(filename))
+            request.resumable_uri = session_uri
+            try:
+                response = self._query_upload(request, stat.st_size)
+            except HttpError as e:
+                if e.resp.status not in (404, 410):
+                    raise
+                logger.warning("Upload session expired. Starting over.")
+                self.db.delete_upload_session(filename)
+                return self._resumable_upload(filename, file_metadata)
+
+            if response is None:
+                resumed_from = request.resumable_progress
+            else:
+                # The server got the whole file before the upload was interrupted.
+                resumed_from = stat.st_size
+
+        while response is None:
+            status, response = request.next_chunk(num_retries=self.NUM_RETRIES)
+
+            if request.resumable_uri != session_uri:
+                session_uri = request.resumable_uri
+                self.db.add_upload_session(
+                    filename, stat.st_size, stat.st_mtime, session_uri
+                )
+            if status:
+                logger.debug("Uploaded {}%".format(int(status.progress() * 100)))
+
+        self.db.delete_upload_session(filename)
+
+        elapsed = time.time() - start_time
+        sent = stat.st_size - resumed_from
+        self.last_upload_stats = {
+            "bytes": sent,
+            "seconds": elapsed,
+            "bytes_per_second": sent / elapsed if elapsed > 0 else None,
+        }
+        logger.info(
+            "Uploaded {} bytes of {} in {:.1f} seconds".format(sent, filename, elapsed)
+        )
+        return response
+
+    @staticmethod
+    def _query_upload(request, size):
+        """
+        Ask the server how much of an interrupted upload it already has, as described
+        in the Drive API docs on resumable uploads. The next chunk of `request` is sent
+        from there on.
+
+        Takes:
+            The upload request, with `resumable_uri` set to the session to resume.
+            Size of the file.
+        Returns:
+            The metadata dictionary if the server already has the whole file,
+            otherwise None.
+        Raises:
+            HttpError, with status 404 or 410 if the session has expired.
+        """
+        headers = {"Content-Range": "bytes */{}".format(size), "Content-Length": "0"}
+        resp, content = request.http.request(
+            request.resumable_uri, "PUT", headers=headers
+        )
+        if resp.status in (200, 201):
+            return json.loads(content.decode("utf-8"))
+        if resp.status != 308:
+            raise HttpError(resp, content, uri=request.resumable_uri)
+
+        # e.g. "bytes=0-1048575". No range means the server has nothing yet.
+        received = resp.get("range")
+        request.resumable_progress = int(received.split("-")[1]) + 1 if received else 0
+        return None
+
+    def health_check(self):
+        """
+        Make the cheapest possible API call to make sure the connection still works.
+        """
+        self.file_service.list(pageSize=1, fields="files(id)").execute()
+        return True
+
     def is_exists(self, fileid):
         """
         Check if given file already exists in the Drive. It does it by requesting for the
-        file metadata.
+        file metadata. The answer is remembered for `exists_ttl` seconds.
 
         Takes:
             The unique fileid for the item.
         Returns:
             Boolean.
         """
+        exists = self.exists_cache.get(fileid)
+        if exists is not None:
+            return exists
+
         try:
             self.file_service.get(fileId=fileid).execute()
         except HttpError:
-            return False
-        return True
+            exists = False
+        else:
+            exists = True
+        self.exists_cache.set(fileid, exists)
+        return exists
+
+    def _check_exists(self, fileid):
+        """
+        Raise FileNotFound if the file does not exist. In optimistic mode this is left
+        to the operation itself, see `_not_found`, which saves a round trip.
+        """
+        if not self.optimistic and not self.is_exists(fileid):
+            logger.critical("Given file not found.")
+            raise FileNotFound("{} not found on drive".format(fileid))
+
+    @contextlib.contextmanager
+    def _not_found(self, fileid):
+        """
+        Turn the 404 of a request on `fileid` into a FileNotFound.
+        """
+        try:
+            yield
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            self.exists_cache.set(fileid, False)
+            logger.critical("Given file not found.")
+            raise FileNotFound("{} not found on drive".format(fileid))
 
     def create_folder(self, name):
         """
         Create a folder with a given name. If the folder already exists, the function is a NOOP.
+        The name can be a path like `channel/2018/06`, in which case every folder along the
+        path is created as needed.
+
+        Folder ids are remembered in the database so that, after the first time, no API
+        call is needed at all. If a remembered folder turns out to have been deleted,
+        the upload into it fails and `write` looks it up again.
 
         Takes:
             the name of the folder to create.
         Returns:
             the id of the folder
         """
+        parts = self._folder_parts(name)
+        path = "/".join(parts)
+
+        folder_id = self.db.get_folder_id(path)
+        if folder_id is not None:
+            return folder_id
+
+        parent = None
+        for i, part in enumerate(parts):
+            sub_path = "/".join(parts[: i + 1])
+            folder_id = self.db.get_folder_id(sub_path)
+            if folder_id is None:
+                folder_id = self._find_or_create_folder(part, parent)
+                self.db.add_folder_id(sub_path, folder_id)
+            parent = folder_id
+        return folder_id
+
+    @staticmethod
+    def _folder_parts(name):
+        return [x for x in name.split("/") if x]
+
+    @classmethod
+    def _folder_path(cls, name):
+        """
+        Returns:
+            The path folder ids are remembered under, e.g. "a/b" for "/a//b/".
+        """
+        return "/".join(cls._folder_parts(name))
+
+    def _find_or_create_folder(self, name, parent=None):
+        """
+        Takes:
+            the name of the folder.
+            (optional) the id of the folder it should be in.
+        Returns:
+            the id of the folder
+        """
         search_query = "name = '{}' and mimeType = '{}'".format(
             name, "application/vnd.google-apps.folder"
         )
-        resp = self.file_service.list(q=search_query, pageSize=5).execute()
+        if parent is not None:
+            search_query += " and '{}' in parents".format(parent)
+        resp = self.file_service.list(
+            q=search_query, pageSize=5, fields="files(id)"
+        ).execute()
         folders = resp.get("files", [])
 
         if len(folders) == 0:
@@ -195,55 +437,138 @@ class DriveStorage(object):
             "name": name,
             "mimeType": "application/vnd.google-apps.folder",
         }
+        if parent is not None:
+            folder_metadata["parents"] = [parent]
         file = self.file_service.create(body=folder_metadata, fields="id").execute()
         return file.get("id")
 
-    def search(self, name_subs=None, tag_subs=None, do_and=False):
+    def _list(self, page_size=None, limit=None, **kwargs):
         """
-        Search for a file in the drive. Many filters are supported but we currently only
-        search for a substring on a filename and for tags. It returns the names as well as fileids for
-        all matching objects.
+        Run a files.list request and follow `nextPageToken` until all the pages have
+        been read. Pages are only requested as the results are consumed.
 
         Takes:
-            Substring to be searched.
+            (optional) number of results per request. Defaults to `search_page_size`.
+            (optional) maximum number of results to return. None returns all.
+            Any other argument is passed on to files.list as is.
         Returns:
-             A list of tuples: [(filename, fileid)...]
+            A generator of file metadata dictionaries.
         """
-        # TODO: Improve this section
-        if tag_subs is None:
-            query = "name contains '{}'".format(name_subs)
-        elif name_subs is None:
-            query_set = ["fullText contains '{}'".format(x) for x in tag_subs]
-            if do_and:
-                query = " and ".join(query_set)
-            else:
-                query = " or ".join(query_set)
-        else:
-            qn = "name contains '{}'".format(name_subs)
-            qt_set = ["fullText contains '{}'".format(x) for x in tag_subs]
+        page_size = min(page_size or self.page_size, self.MAX_PAGE_SIZE)
+        count = 0
+        page_token = None
+        while True:
+            if limit is not None:
+                page_size = min(page_size, limit - count)
+            response = self.file_service.list(
+                pageSize=page_size, pageToken=page_token, **kwargs
+            ).execute()
+
+            for f in response.get("files", []):
+                yield f
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+            page_token = response.get("nextPageToken")
+            if page_token is None:
+                return
 
-            if do_and:
-                query = qn + " and " + " and ".join(qt_set)
+    @staticmethod
+    def _search_query(name_subs=None, tag_subs=None, do_and=False):
+        parts = []
+        if name_subs is not None:
+            parts.append("name contains '{}'".format(name_subs))
+        if tag_subs is not None:
+            parts.extend("fullText contains '{}'".format(x) for x in tag_subs)
+
+        if do_and:
+            return " and ".join(parts)
+        return " or ".join(parts)
+
+    def iter_search(
+        self, name_subs=None, tag_subs=None, do_and=False, page_size=None, limit=None
+    ):
+        """
+        Same as `search` but lazily yields the results one page at a time. Only the
+        name and the id of each file are fetched.
 
+        Takes:
+            Substring to be searched.
+            (optional) number of results per request. Defaults to `search_page_size`.
+            (optional) maximum number of results. Defaults to `search_limit`.
+        Returns:
+            A generator of tuples: (filename, fileid)
+        """
+        query = self._search_query(name_subs, tag_subs, do_and)
         logger.debug("Following is the search query: " + query)
 
-        response = self.file_service.list(
-            q=query, pageSize=5, includeTeamDriveItems=True, supportsTeamDrives=True
-        ).execute()
+        if limit is None:
+            limit = self.search_limit
+
+        for f in self._list(
+            page_size,
+            limit,
+            q=query,
+            fields="nextPageToken, files(id, name)",
+            includeTeamDriveItems=True,
+            supportsTeamDrives=True,
+        ):
+            yield f["name"], f["id"]
+
+    def search(self, name_subs=None, tag_subs=None, do_and=False):
+        """
+        Search for a file in the drive. Many filters are supported but we currently only
+        search for a substring on a filename and for tags. It returns the names as well as fileids for
+        all matching objects, up to `search_limit` of them.
 
-        items = response.get("files", [])
-        if not items:
+        Takes:
+            Substring to be searched.
+        Returns:
+             A list of tuples: [(filename, fileid)...]
+        """
+        response = list(self.iter_search(name_subs, tag_subs, do_and))
+        if not response:
             logger.critical("No files were found matching the query.")
             raise FileNotFound("Query returned empty")
 
-        response = [(f["name"], f["id"]) for f in items]
         logger.debug("following information was returned.\n{}".format(response))
         return response
 
+    def list_files(self):
+        """
+        List every file in the drive along with the folder it is in and its tags.
+        This is used to rebuild the search index.
+
+        Returns:
+            A generator of (filename, foldername, fileid, tags) tuples.
+        """
+        folder_type = "application/vnd.google-apps.folder"
+        folders = {}
+        files = []
+
+        for f in self._list(
+            self.MAX_PAGE_SIZE,
+            q="trashed = false",
+            fields="nextPageToken, files(id, name, mimeType, description, parents)",
+        ):
+            if f["mimeType"] == folder_type:
+                folders[f["id"]] = f["name"]
+            else:
+                files.append(f)
+
+        for f in files:
+            parents = f.get("parents", [])
+            folder = folders.get(parents[0]) if parents else None
+            # See `tag` for how tags are stored in the description.
+            tags = [x.strip() for x in f.get("description", "").split("\n")]
+            yield f["name"], folder, f["id"], [x for x in tags if x]
+
     def read(self, fileid):
         """
         Read a file of the given id. Raises error if file does not already
-        exist for some reason
+        exist for some reason. The whole file is read into memory, so use
+        `read_to` or `iter_read` for anything large.
 
         Takes:
             The id of the file to be read.
@@ -252,11 +577,57 @@ class DriveStorage(object):
         """
         logger.debug("Trying to read file id: {}".format(fileid))
 
-        if self.is_exists(fileid):
+        self._check_exists(fileid)
+        with self._not_found(fileid):
             return self.file_service.get_media(fileId=fileid).execute()
-        else:
-            logger.critical("Given file not found.")
-            raise FileNotFound("{} not found on drive".format(fileid))
+
+    def iter_read(self, fileid, start=0, end=None):
+        """
+        Read a file of the given id, `chunk_size` bytes at a time. Only one chunk is
+        held in memory at a time, so this works for files of any size. Optionally
+        only a range of the file is read. Every chunk is requested with a Range header.
+
+        Takes:
+            The id of the file to be read.
+            (optional) offset of the first byte to read.
+            (optional) offset of the last byte to read. By default, reads till the end.
+        Returns:
+            A generator of binary strings.
+        """
+        logger.debug("Trying to stream file id: {}".format(fileid))
+        self._check_exists(fileid)
+
+        with self._not_found(fileid):
+            while end is None or start <= end:
+                last = start + self.chunk_size - 1
+                if end is not None:
+                    last = min(last, end)
+
+                request = self.file_service.get_media(fileId=fileid)
+                request.headers["range"] = "bytes={}-{}".format(start, last)
+                try:
+                    chunk = request.execute(num_retries=self.NUM_RETRIES)
+                except HttpError as e:
+                    # The file ends right before `start`.
+                    if e.resp.status == 416:
+                        return
+                    raise
+
+                yield chunk
+                # A short chunk is the end of the file.
+                if len(chunk) < last + 1 - start:
+                    return
+                start += len(chunk)
+
+    def read_to(self, fileid, dest, start=0, end=None):
+        """
+        Same as `iter_read` but writes the file to `dest`, which is either a path or
+        a binary file like object.
+
+        Returns:
+            The number of bytes written.
+        """
+        return copy_chunks(self.iter_read(fileid, start, end), dest)
 
     def delete(self, fileid):
         """
@@ -266,11 +637,15 @@ class DriveStorage(object):
         Takes:
             fileid of the object to be deleted.
         """
-        if not self.is_exists(fileid):
+        try:
+            self._check_exists(fileid)
+            with self._not_found(fileid):
+                self.file_service.delete(fileId=fileid).execute()
+        except FileNotFound:
             logger.warning("The provided fileid ({}) never existed.".format(fileid))
             return None
 
-        self.file_service.delete(fileId=fileid).execute()
+        self.exists_cache.set(fileid, False)
         logger.debug("Fileid ({}) deleted.".format(fileid))
 
     def tag(self, fileid, tags):
@@ -284,17 +659,101 @@ class DriveStorage(object):
             fileid of the object to be tagged.
             a list of tags to be added.
         """
-        if not self.is_exists(fileid):
-            logger.critical("Given file not found")
-            raise FileNotFound("The provided fileid {} does not exist".format(fileid))
+        self._check_exists(fileid)
+
+        with self._not_found(fileid):
+            # so as to not delete old contents:
+            info = self.file_service.get(fileId=fileid, fields="description").execute()
+            old_description = info["description"]
+
+            # TODO: We can do this better by overwriting repeating tags
+            metadata = {"description": old_description + "\n" + " \n".join(tags)}
+            self.file_service.update(fileId=fileid, body=metadata).execute()
+
+    def _execute_batch(self, requests):
+        """
+        Send many requests in as few HTTP round trips as possible by packing up to
+        BATCH_SIZE of them in a single batch request. A failing request does not stop
+        the others.
+
+        Takes:
+            A dictionary of fileids to the (not yet executed) request for that file.
+        Returns:
+            A dictionary of fileids to the response of the request, or the exception
+            it failed with.
+        """
+        results = {}
+
+        def callback(request_id, response, exception):
+            fileid = fileids[int(request_id)]
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                exception = FileNotFound("{} not found on drive".format(fileid))
+            if exception is not None:
+                logger.error("Request for {} failed: {}".format(fileid, exception))
+            results[fileid] = exception if exception is not None else response
+
+        fileids = list(requests.keys())
+        for start in range(0, len(fileids), self.BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for i in range(start, min(start + self.BATCH_SIZE, len(fileids))):
+                batch.add(requests[fileids[i]], request_id=str(i))
+            batch.execute()
+        return results
+
+    def tag_bulk(self, fileids, tags):
+        """
+        Same as `tag` but for many files at once. The current descriptions are
+        fetched, and the new ones written, in batches.
 
-        # so as to not delete old contents:
-        info = self.file_service.get(fileId=fileid, fields="description").execute()
-        old_description = info["description"]
+        Takes:
+            list of fileids of the objects to be tagged.
+            a list of tags to be added to each of them.
+        Returns:
+            A dictionary of fileids to None on success or the exception on failure.
+        """
+        infos = self._execute_batch(
+            {
+                fid: self.file_service.get(fileId=fid, fields="description")
+                for fid in fileids
+            }
+        )
+
+        updates = {}
+        for fid, info in infos.items():
+            if isinstance(info, Exception):
+                continue
+            metadata = {
+                "description": info.get("description", "") + "\n" + " \n".join(tags)
+            }
+            updates[fid] = self.file_service.update(fileId=fid, body=metadata)
+
+        results = self._execute_batch(updates)
+        response = {}
+        for fid, info in infos.items():
+            result = info if isinstance(info, Exception) else results[fid]
+            response[fid] = result if isinstance(result, Exception) else None
+        return response
 
-        # TODO: We can do this better by overwriting repeating tags
-        metadata = {"description": old_description + "\n" + " \n".join(tags)}
-        self.file_service.update(fileId=fileid, body=metadata).execute()
+    def add_permissions_bulk(self, fileids, email, role):
+        """
+        Same as `add_permissions_user` but for many files at once. The permissions
+        are created in batches, without checking whether each file exists first.
+
+        Takes:
+            list of ids of the files to which permissions have to be added.
+            email address of the entity to which permission is granted.
+            the role granted to the entity.
+        Returns:
+            A dictionary of fileids to the metadata of the permission, or the
+            exception adding it failed with.
+        """
+        permission = {"type": "user", "role": role, "emailAddress": email}
+        return self._execute_batch(
+            {
+                fid: self.perm_service.create(fileId=fid, body=permission)
+                for fid in fileids
+            }
+        )
 
     def add_permissions_user(self, fileid, email, role):
         """
@@ -317,12 +776,11 @@ class DriveStorage(object):
             "fileid: {f}\nrole: {r}\n email: {e}\n".format(f=fileid, r=role, e=email)
         )
 
-        if not self.is_exists(fileid):
-            logger.critical("File not found")
-            raise FileNotFound("No file to add permission to")
+        self._check_exists(fileid)
 
         permission = {"type": "user", "role": role, "emailAddress": email}
-        mdata = self.perm_service.create(fileId=fileid, body=permission).execute()
+        with self._not_found(fileid):
+            mdata = self.perm_service.create(fileId=fileid, body=permission).execute()
         logger.debug("The permission was created.\n{}".format(mdata))
 
         return mdata
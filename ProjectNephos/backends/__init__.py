@@ -1,5 +1,6 @@
 from ProjectNephos.backends.DataBase import DBStorage
 from ProjectNephos.backends.GDrive import DriveStorage
+from ProjectNephos.backends.registry import get_backend
 from ProjectNephos.backends.storage import DataStore
 
-__all__ = [DataStore, DBStorage, DriveStorage]
+__all__ = [DataStore, DBStorage, DriveStorage, get_backend]
@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+class ExpiringCache(object):
+    """
+    A small thread safe dictionary whose entries are forgotten `ttl` seconds after
+    they were set. A ttl of 0 disables the cache, i.e. nothing is ever found in it.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, ttl):
+        self.ttl = float(ttl)
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires = self._items.get(key, (self._MISSING, 0))
+            if value is self._MISSING or expires < time.time():
+                self._items.pop(key, None)
+                return default
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.time() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items = {}
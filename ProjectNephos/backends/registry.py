@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+from ProjectNephos.backends.GDrive import DriveStorage
+from ProjectNephos.backends.FTP import FTPStorage
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+options = {"google": DriveStorage, "ftp": FTPStorage}
+
+
+class BackendRegistry(object):
+    """
+    Keeps one long lived client per backend so that authentication, API discovery and
+    logins happen once per process instead of once per operation.
+
+    Clients are created on first use. A client that hasn't been used for
+    CHECK_INTERVAL seconds is health checked before being handed out again and
+    recreated if the check fails.
+
+    Clients are never shared across processes. Backends that are not THREAD_SAFE
+    additionally get one client per thread, which is closed once the thread is gone.
+    Replaced clients are closed as well.
+    """
+
+    CHECK_INTERVAL = 60
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name):
+        if options[name].THREAD_SAFE:
+            return name, os.getpid(), None
+        # The Thread object rather than its ident, as idents are reused.
+        return name, os.getpid(), threading.current_thread()
+
+    def _evict_dead(self):
+        """
+        Forget the clients of threads that have finished. Called with the lock held.
+
+        Returns:
+            The evicted clients, to be closed once the lock is released.
+        """
+        dead = [x for x in self._clients if x[2] is not None and not x[2].is_alive()]
+        return [self._clients.pop(x)[0] for x in dead]
+
+    def get(self, name, config):
+        """
+        Takes:
+            Name of the backend, as used in the `others.backends` config option.
+            Config object. Only used when the client has to be created.
+        Returns:
+            The client object for the backend.
+        """
+        key = self._key(name)
+        with self._lock:
+            evicted = self._evict_dead()
+            entry = self._clients.get(key)
+        for client in evicted:
+            self._close(client)
+
+        now = time.time()
+        if entry is not None:
+            client, last_used = entry
+            if now - last_used <= self.CHECK_INTERVAL or self._is_healthy(client):
+                with self._lock:
+                    if self._clients.get(key) is entry:
+                        self._clients[key] = (client, now)
+                return client
+            logger.warning("Backend {} is unhealthy. Reconnecting.".format(name))
+
+        # Connecting can be slow, so it happens outside of the lock. Whichever thread
+        # gets its client in first wins, the others close theirs.
+        logger.debug("Connecting to backend {}".format(name))
+        client = options[name](config)
+
+        with self._lock:
+            current = self._clients.get(key)
+            if current is entry or current is None:
+                self._clients[key] = (client, now)
+                discard = None if entry is None else entry[0]
+            else:
+                discard, client = client, current[0]
+        if discard is not None:
+            self._close(discard)
+        return client
+
+    @staticmethod
+    def _close(client):
+        close = getattr(client, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception:
+            logger.exception("Unable to close backend client")
+
+    @staticmethod
+    def _is_healthy(client):
+        try:
+            return client.health_check()
+        except Exception:
+            logger.exception("Health check failed")
+            return False
+
+    def reset(self):
+        """
+        Forget all clients. The next `get` creates new ones.
+        """
+        with self._lock:
+            self._clients = {}
+
+
+registry = BackendRegistry()
+
+
+def get_backend(name, config):
+    """
+    Return the shared client for the backend `name`. See BackendRegistry.
+    """
+    return registry.get(name, config)
@@ -1,38 +1,193 @@
-from ProjectNephos.backends.GDrive import DriveStorage
-from ProjectNephos.backends.FTP import FTPStorage
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from logging import getLogger
+from os.path import basename
+import os
+import threading
+import time
+import weakref
 
-options = {"google": DriveStorage, "ftp": FTPStorage}
+from ProjectNephos.backends.DataBase import DBStorage
+from ProjectNephos.backends.registry import get_backend
+from ProjectNephos.exceptions import BackendFailure
+
+logger = getLogger(__name__)
+
+# Threads shared by every DataStore of a process, and one lock per backend client
+# that must not be used by two threads at once.
+MAX_THREADS = 16
+_executors = {}
+_client_locks = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _executor():
+    """
+    The thread pool of the current process. Pools aren't inherited across a fork.
+    """
+    with _lock:
+        pid = os.getpid()
+        if pid not in _executors:
+            _executors.clear()
+            _executors[pid] = ThreadPoolExecutor(max_workers=MAX_THREADS)
+        return _executors[pid]
+
+
+def _client_lock(client):
+    """
+    The lock serializing calls to `client`, or None if it is THREAD_SAFE.
+    """
+    if getattr(client, "THREAD_SAFE", False) is True:
+        return None
+    with _lock:
+        if client not in _client_locks:
+            _client_locks[client] = threading.Lock()
+        return _client_locks[client]
 
 
 class DataStore(object):
+    """
+    Performs every operation on all the configured backends at once.
+
+    Each operation is sent to all backends concurrently. The result is a dictionary
+    keyed by backend name. What happens when some backends fail depends on the
+    `others.backend_policy` config option:
+        all: raise BackendFailure if any backend failed.
+        best_effort: raise BackendFailure only if every backend failed. Otherwise the
+            failed backends map to the exception they raised.
+    Backends that take longer than `others.backend_timeout` seconds are counted as
+    failed with a TimeoutError. The operation keeps running in the background though,
+    so backends that are not THREAD_SAFE only get the next operation once it is done.
+
+    Every write, tag and delete is also recorded in a local search index. If
+    `others.search_index` is set, searches are answered from that index instead of
+    asking every backend. `reindex` rebuilds the index from the backends. Backends
+    that have never been indexed, e.g. on databases from before the index existed,
+    are indexed before the first search. If that fails, the backends are searched.
+    """
 
     def __init__(self, config):
+        self.config = config
         self.backends = {}
 
         for item in config["others", "backends"].split():
-            self.backends[item] = options[item](config)
+            self.backends[item] = get_backend(item, config)
+
+        self.policy = config["others", "backend_policy"]
+        self.timeout = float(config["others", "backend_timeout"]) or None
+        self.use_index = config["others", "search_index"] is True
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = DBStorage(self.config)
+        return self._db
+
+    def _dispatch(self, operation, backends=None):
+        """
+        Run `operation(backend_name, backend_object)` for every backend concurrently.
+
+        Takes:
+            The function to run.
+            (optional) names of the backends to run on. Defaults to all of them.
+        Returns:
+            Dictionary of backend names to results.
+        """
+        if backends is None:
+            backends = list(self.backends.keys())
+
+        def run(name, obj):
+            lock = _client_lock(obj)
+            if lock is None:
+                return operation(name, obj)
+            with lock:
+                return operation(name, obj)
+
+        executor = _executor()
+        futures = {
+            name: executor.submit(run, name, self.backends[name]) for name in backends
+        }
+
+        results, errors = {}, {}
+        start = time.time()
+        for name, future in futures.items():
+            remaining = None
+            if self.timeout is not None:
+                remaining = max(self.timeout - (time.time() - start), 0)
+            try:
+                results[name] = future.result(timeout=remaining)
+            except TimeoutError as e:
+                logger.critical("Backend {} timed out.".format(name))
+                errors[name] = e
+            except Exception as e:
+                logger.critical("Backend {} failed: {}".format(name, e))
+                errors[name] = e
+
+        if errors and (self.policy != "best_effort" or not results):
+            raise BackendFailure(
+                "Failed on backends: {}".format(", ".join(errors)), results, errors
+            )
+
+        results.update(errors)
+        return results
+
+    @staticmethod
+    def _succeeded(fileids):
+        """
+        Names of the backends that have a usable id in `fileids`.
+        """
+        return [
+            name for name, fid in fileids.items() if not isinstance(fid, Exception)
+        ]
 
     def write(self, filename, folder=None):
-        response = {}
-        for backend, obj in self.backends.items():
-            response[backend] = obj.write(filename, folder)
+        response = self._dispatch(lambda _, obj: obj.write(filename, folder))
 
+        with self.db.unit_of_work():
+            for backend in self._succeeded(response):
+                self.db.index_file(
+                    basename(filename), folder, backend, response[backend]
+                )
         return response
 
     def is_exists(self, filename):
-        return all(map(lambda x: x.is_exists(filename), self.backends.items()))
+        return all(self._dispatch(lambda _, obj: obj.is_exists(filename)).values())
 
     def create_folder(self, name):
-        response = {}
-        for backend, obj in self.backends.items():
-            response[backend] = obj.create_folder(name)
+        return self._dispatch(lambda _, obj: obj.create_folder(name))
 
-        return response
+    def _index_ready(self):
+        """
+        Index the backends that haven't been indexed yet.
+
+        Returns:
+            True if the index covers all backends.
+        """
+        missing = [x for x in self.backends if x not in self.db.get_indexed_backends()]
+        if not missing:
+            return True
+
+        logger.info("Building the search index for {}".format(", ".join(missing)))
+        try:
+            indexed = self.reindex(missing)
+        except BackendFailure:
+            indexed = {}
+        if len(indexed) < len(missing):
+            logger.warning("Search index incomplete. Searching the backends instead.")
+            return False
+        return True
 
     def search(self, name_subs=None, tag_subs=None, do_and=False):
+        if self.use_index and self._index_ready():
+            return self.db.search_index(name_subs, tag_subs, do_and)
+
+        results = self._dispatch(
+            lambda _, obj: obj.search(name_subs, tag_subs, do_and)
+        )
+
         response = []
-        for backend, obj in self.backends.items():
-            intr = sorted(obj.search(name_subs, tag_subs, do_and), key=lambda x: x[0])
+        for backend in self._succeeded(results):
+            intr = sorted(results[backend], key=lambda x: x[0])
             if len(response) == 0:
                 response = [(x[0], {backend: x[1]}) for x in intr]
             else:
@@ -47,19 +202,120 @@ class DataStore(object):
         return response
 
     def read(self, fileids):
-        name, obj = list(self.backends.items())[0]
-        return obj.read(fileids[name])
+        name = self._succeeded(fileids)[0]
+        return self.backends[name].read(fileids[name])
+
+    def iter_read(self, fileids, start=0, end=None):
+        name = self._succeeded(fileids)[0]
+        return self.backends[name].iter_read(fileids[name], start, end)
+
+    def read_to(self, fileids, dest, start=0, end=None):
+        name = self._succeeded(fileids)[0]
+        return self.backends[name].read_to(fileids[name], dest, start, end)
 
     def delete(self, fileids):
-        map(lambda name, obj: obj.delete(fileids[name]), self.backends.items())
+        response = self._dispatch(
+            lambda name, obj: obj.delete(fileids[name]), self._succeeded(fileids)
+        )
+
+        for backend in self._succeeded(response):
+            self.db.unindex_file(backend, fileids[backend])
+        return response
 
     def tag(self, fileids, tags):
-        response = {}
-        for backend, obj in self.backends.items():
-            response[backend] = obj.tag(fileids[backend], tags)
+        response = self._dispatch(
+            lambda name, obj: obj.tag(fileids[name], tags), self._succeeded(fileids)
+        )
 
+        for backend in self._succeeded(response):
+            self.db.index_tags(backend, fileids[backend], tags)
         return response
 
     def add_permission_user(self, fileids, email, role):
-        for backend, obj in self.backends.items():
-            obj.add_permission_user(fileids[backend], email, role)
+        return self._dispatch(
+            lambda name, obj: obj.add_permissions_user(fileids[name], email, role),
+            self._succeeded(fileids),
+        )
+
+    def _bulk(self, fileids_list, bulk, single, *args):
+        """
+        Run an operation on many files, on every backend concurrently. Backends with a
+        `bulk` method get all of their ids in one call, the rest get a call to their
+        `single` method for each id.
+
+        Takes:
+            A list of `fileids` dictionaries, as returned by `search`.
+            Names of the bulk and the single file methods of the backends.
+            Arguments passed to the methods after the id(s).
+        Returns:
+            Dictionary of backend names to a dictionary of their ids to the result
+            for that id, or the exception it failed with.
+        """
+
+        def run(name, obj):
+            ids = [f[name] for f in fileids_list if name in self._succeeded(f)]
+            if hasattr(obj, bulk):
+                return getattr(obj, bulk)(ids, *args)
+
+            response = {}
+            for fid in ids:
+                try:
+                    response[fid] = getattr(obj, single)(fid, *args)
+                except Exception as e:
+                    logger.error("{} of {} on {} failed: {}".format(single, fid, name, e))
+                    response[fid] = e
+            return response
+
+        return self._dispatch(run)
+
+    @staticmethod
+    def failed_items(results):
+        """
+        Takes:
+            The result of a bulk operation.
+        Returns:
+            Dictionary of backend names to the ids the operation failed on. Backends
+            without failures are left out.
+        """
+        response = {}
+        for backend, items in results.items():
+            if isinstance(items, Exception):
+                continue
+            failed = [fid for fid, r in items.items() if isinstance(r, Exception)]
+            if failed:
+                response[backend] = failed
+        return response
+
+    def tag_bulk(self, fileids_list, tags):
+        response = self._bulk(fileids_list, "tag_bulk", "tag", tags)
+
+        with self.db.unit_of_work():
+            for backend in self._succeeded(response):
+                for fid, result in response[backend].items():
+                    if not isinstance(result, Exception):
+                        self.db.index_tags(backend, fid, tags)
+        return response
+
+    def add_permission_user_bulk(self, fileids_list, email, role):
+        return self._bulk(
+            fileids_list, "add_permissions_bulk", "add_permissions_user", email, role
+        )
+
+    def reindex(self, backends=None):
+        """
+        Throw away the search index and build it again from what is actually stored
+        on the backends.
+
+        Takes:
+            (optional) names of the backends to index. Defaults to all of them.
+        Returns:
+            Dictionary of backend names to the number of files indexed.
+        """
+        listing = self._dispatch(lambda _, obj: list(obj.list_files()), backends)
+
+        response = {}
+        for backend in self._succeeded(listing):
+            self.db.replace_index(backend, listing[backend])
+            response[backend] = len(listing[backend])
+            logger.info("Indexed {} files from {}".format(response[backend], backend))
+        return response
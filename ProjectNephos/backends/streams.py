@@ -0,0 +1,33 @@
+import contextlib
+
+
+@contextlib.contextmanager
+def open_destination(dest):
+    """
+    Takes:
+        Either a path to write to or an already open, binary, file like object.
+    Returns:
+        A context manager giving a writable file object. Files opened here are
+        closed again at the end of the with block. Objects passed in are not.
+    """
+    if hasattr(dest, "write"):
+        yield dest
+    else:
+        with open(dest, "wb") as f:
+            yield f
+
+
+def copy_chunks(chunks, dest):
+    """
+    Write an iterable of binary strings to `dest`, see `open_destination`.
+    Only one chunk is held in memory at a time.
+
+    Returns:
+        The number of bytes written.
+    """
+    written = 0
+    with open_destination(dest) as f:
+        for chunk in chunks:
+            f.write(chunk)
+            written += len(chunk)
+    return written
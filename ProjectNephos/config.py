@@ -12,6 +12,10 @@ default_values = {
     "google": {
         "client_secret_location": "~/aanair_nephos/ProjectNephos/client_secret.json",
         "auth_token_location": BASE_FOLDER + "/access.json",
+        "resumable": "True",
+        "chunk_size": "32",  # In MiB. Resumable uploads need a multiple of 256KiB.
+        "search_page_size": "100",  # Results per request. The API allows up to 1000.
+        "search_limit": "0",  # Max results returned by a search. 0 returns all.
     },
     "downloads": {
         "local_save_location": BASE_FOLDER + "/files/",
@@ -19,9 +23,23 @@ default_values = {
     },
     "recording": {
         "db_location": BASE_FOLDER + "/nephos.sqlite",
+        "db_wal": "True",
+        "db_busy_timeout": "30",  # seconds
+        "db_retries": "5",
+        # Queue writes to the downloads table behind a lock file.
+        "db_single_writer": "False",
+        # "multicat", or "native" to record in-process without multicat.
+        "recorder": "multicat",
+        "progress_interval": "60",  # seconds between progress logs of native recordings
+        # Record in segments of this many minutes that are processed while recording
+        # goes on. Always uses the native recorder. 0 records in one piece.
+        "segment_length": "0",
         "multicat": "~/multicat-2.1/multicat",
         "ccextractor": "~/aanair_nephos/ccextractor",
         "bind": "159.237.36.240",
+        "probe_packets": "500",  # TS packets a channel has to deliver to be up.
+        "probe_timeout": "5",  # seconds
+        "probe_workers": "8",  # channels probed at once
         "logs": BASE_FOLDER + "/logs/",
     },
     "ftp": {
@@ -29,6 +47,10 @@ default_values = {
         "port": "2121",
         "username": "anonymous",
         "password": "password",
+        "pool_min": "1",
+        "pool_max": "4",
+        "idle_timeout": "300",  # seconds
+        "keepalive": "60",  # seconds
     },
     "mail": {
         "host": "smtp.server.com",
@@ -36,7 +58,49 @@ default_values = {
         "admin": "admin@ccextractor.org",
         "From": "nephos@ccextractor.org",
     },
-    "others": {"backends": "google ftp"},
+    "processing": {
+        "workers": "2",
+        "idle_wait": "60",
+        "notify_socket": BASE_FOLDER + "/notify.sock",
+        "convert_concurrency": "2",
+        "subtitles_concurrency": "2",
+        "upload_concurrency": "4",
+        "queue_size": "2",
+        # Seconds ffmpeg and ccextractor may run for on one file. 0 is unlimited.
+        "process_timeout": "0",
+    },
+    # Transcode profiles. See profiles.py. Set a job's convert_to to the name after
+    # "profile:" to use one.
+    "profile:h264": {
+        "extension": "mp4",
+        "video_codec": "libx264",
+        "preset": "veryfast",
+        "crf": "23",
+        "threads": "2",
+        "audio_codec": "aac",
+        "audio_bitrate": "128k",
+    },
+    "profile:h264_sd": {
+        "extension": "mp4",
+        "video_codec": "libx264",
+        "preset": "veryfast",
+        "crf": "26",
+        "scale": "480",
+        "threads": "2",
+        "audio_codec": "aac",
+        "audio_bitrate": "96k",
+    },
+    "profile:h264_all": {"renditions": "h264 h264_sd"},
+    "others": {
+        "backends": "google ftp",
+        # "all": fail if any backend fails. "best_effort": fail only if all of them do.
+        "backend_policy": "all",
+        "backend_timeout": "0",  # seconds per backend operation. 0 waits forever.
+        "search_index": "True",  # Search the local index instead of the backends.
+        # Skip the existence check before operating on a file and rely on the error.
+        "optimistic": "True",
+        "exists_ttl": "30",  # seconds to remember whether a file exists. 0 disables.
+    },
 }
 
 USER_CONFIG_LOC = BASE_FOLDER
@@ -85,9 +149,7 @@ class Configuration(object):
         except NoSectionError:
             raise NoSectionError("Section '{}' not found".format(section))
         except NoOptionError:
-            raise NoOptionError(
-                "Section '{}' does not contain a key '{}'".format(section, key)
-            )
+            raise NoOptionError(key, section)
 
         if value == "None":
             return None
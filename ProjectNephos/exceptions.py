@@ -12,3 +12,28 @@ class FileNotFound(NephosException):
 
 class SubCommandNotFound(NephosException):
     pass
+
+
+class BackendFailure(NephosException):
+    """
+    Raised when an operation failed on some of the backends. `results` holds the
+    return values of the backends that succeeded, `errors` the exceptions of the
+    ones that didn't. Both are keyed by backend name.
+    """
+
+    def __init__(self, message, results, errors):
+        super().__init__(message)
+        self.results = results
+        self.errors = errors
+
+
+class ProcessFailed(NephosException):
+    """
+    Raised when an external program fails, times out or is cancelled. `output` holds
+    the last lines it printed.
+    """
+
+    def __init__(self, message, returncode, output):
+        super().__init__(message)
+        self.returncode = returncode
+        self.output = output
@@ -10,7 +10,7 @@ logger = getLogger(__name__)
 
 class ChannelHandler(BaseHandler):
     """
-    Handles creating channels.
+    Handles creating channels and showing the results of their health checks.
     """
 
     def init_with_config(self, config):
@@ -22,7 +22,7 @@ class ChannelHandler(BaseHandler):
         parser = super().init_args(subparser)
 
         parser.add_argument(
-            "action", help="Define what action to take.", choices=["list", "add"]
+            "action", help="Define what action to take.", choices=["list", "add", "history"]
         )
 
         parser.add_argument("--name", action="store", help="Name of the channel")
@@ -39,3 +39,10 @@ class ChannelHandler(BaseHandler):
 
         if args.action == "list":
             print(self.db.get_channels())
+
+        if args.action == "history":
+            if not args.name:
+                logger.critical("--name is required. Try again.")
+            else:
+                for check in self.db.get_channel_checks(args.name, limit=50):
+                    print(check)
@@ -58,6 +58,12 @@ class JobHandler(BaseHandler):
             " Ignores --channel, --start and --duration",
         )
 
+        parser.add_argument(
+            "--dry_run",
+            action="store_true",
+            help="With --program_tags, only report how many jobs would be added.",
+        )
+
         parser.add_argument(
             "--upload",
             action="store_true",
@@ -120,17 +126,40 @@ class JobHandler(BaseHandler):
                     )
                     return -1
                 individual_programs = self.db.get_schedule_items(tags=args.program_tags)
-                for prog in individual_programs:
-                    self.db.add_job(
-                        args.name + "->" + prog.program,
-                        prog.channel,
-                        prog.start,
-                        prog.duration,
-                        args.upload,
-                        args.convert_to,
-                        args.subtitles,
-                        args.tags,
+                # Programs are repeated, so every airing needs a name of its own.
+                jobs = [
+                    {
+                        "name": "{}->{}-{}".format(args.name, prog.program, prog.id),
+                        "channel": prog.channel,
+                        "start": prog.start,
+                        "duration": prog.duration,
+                        "upload": args.upload,
+                        "convert_to": args.convert_to,
+                        "subtitles": args.subtitles,
+                        "tags": args.tags,
+                    }
+                    for prog in individual_programs
+                ]
+                added, existing, duplicates = self.db.add_jobs(
+                    jobs, dry_run=args.dry_run
+                )
+                for name in existing:
+                    logger.warning("Skipping {}: job already exists".format(name))
+                for name in duplicates:
+                    logger.warning(
+                        "Skipping {}: another program airs at the same time".format(
+                            name
+                        )
+                    )
+                print(
+                    "{} {} jobs, skipped {} that already have a job and {} that "
+                    "overlap with another program.".format(
+                        "Would add" if args.dry_run else "Added",
+                        len(added),
+                        len(existing),
+                        len(duplicates),
                     )
+                )
 
         if args.action == "list":
             for items in self.db.get_job():
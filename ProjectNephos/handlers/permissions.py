@@ -1,4 +1,4 @@
-from ProjectNephos.backends import DriveStorage, DBStorage
+from ProjectNephos.backends import DataStore, DBStorage
 from ProjectNephos.config import Configuration
 from ProjectNephos.handlers.base import BaseHandler
 from ProjectNephos.handlers.search import SearchHandler
@@ -23,7 +23,7 @@ class PermissionHandler(BaseHandler):
     def init_with_config(self, config):
         super().init_with_config(config)
 
-        self.backend = DriveStorage(config)
+        self.backend = DataStore(config)
         self.db = DBStorage(config)
         self.search = SearchHandler(config=config)
 
@@ -46,7 +46,7 @@ class PermissionHandler(BaseHandler):
         )
 
     def execute_command(self, id, email, role):
-        self.backend.add_permissions_user(fileid=id, email=email, role=role)
+        self.backend.add_permission_user(fileids=id, email=email, role=role)
 
     def run(self, args):
         if args.action == "add":
@@ -65,9 +65,13 @@ class PermissionHandler(BaseHandler):
                     name=None, tags=tags, do_and=False
                 )
 
-                for item in response:
-                    id = item[1]
-                    self.backend.add_permissions_user(fileid=id, email=email, role=role)
+                results = self.backend.add_permission_user_bulk(
+                    [item[1] for item in response], email=email, role=role
+                )
+                for backend, failed in self.backend.failed_items(results).items():
+                    logger.critical(
+                        "Could not share {} files on {}".format(len(failed), backend)
+                    )
 
         if args.action == "list":
             if args.for_tags is None:
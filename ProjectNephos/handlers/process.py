@@ -1,7 +1,10 @@
-import subprocess
+import os
+import time
 
 from ProjectNephos.exceptions import FileNotFound
 from ProjectNephos.handlers.base import BaseHandler
+from ProjectNephos.profiles import input_args
+from ProjectNephos.runner import FFMPEG_PROGRESS, run_process
 
 from argparse import _SubParsersAction, Namespace
 from logging import getLogger
@@ -11,6 +14,9 @@ import ffmpy
 
 logger = getLogger(__name__)
 
+# Seconds between progress logs of a conversion.
+PROGRESS_INTERVAL = 60
+
 
 class ProcessHandler(BaseHandler):
     """
@@ -43,25 +49,90 @@ class ProcessHandler(BaseHandler):
         )
         ff.run()
 
-    def execute_command(self, input_file, output_file):
-        command = "ffmpeg -i {input} {output}".format(
-            input=input_file, output=output_file
-        )
+    def _timeout(self):
+        return float(self.config["processing", "process_timeout"]) or None
+
+    def execute_command(self, input_file, output_file, log=None, cancel=None):
+        """
+        Convert `input_file` with ffmpeg, logging its output to `log` and its
+        progress every PROGRESS_INTERVAL seconds. See runner.run_process.
 
-        process = subprocess.Popen(
-            command.split(), stderr=subprocess.STDOUT, stdout=subprocess.PIPE
+        Returns:
+            The last lines of output.
+        """
+        log = log or logger
+        command = ["ffmpeg", "-nostdin", "-y", "-i", input_file]
+        command += FFMPEG_PROGRESS + [output_file]
+        return run_process(
+            command,
+            log,
+            timeout=self._timeout(),
+            cancel=cancel,
+            on_progress=_progress_logger(log, output_file),
         )
-        stdout, _ = process.communicate()
-        return stdout.decode("ascii")
-
-    def execute_ccextractor(self, input_file, output_file):
-        command = "{ccextractor} {input} -o {output}".format(
-            ccextractor=self.config["recording", "ccextractor"],
-            input=input_file,
-            output=output_file,
+
+    def execute_profiles(self, input_file, outputs, log=None, cancel=None):
+        """
+        Encode `input_file` to several outputs in a single pass, decoding it only
+        once. See profiles.py.
+
+        Takes:
+            Path of the input file.
+            List of (TranscodeProfile, output path) pairs.
+        Returns:
+            The last lines of output.
+        """
+        log = log or logger
+        command = ["ffmpeg", "-nostdin", "-y"]
+        command += input_args([x for x, _ in outputs]) + ["-i", input_file]
+        command += FFMPEG_PROGRESS
+        for profile, path in outputs:
+            command += profile.output_args() + [path]
+        return run_process(
+            command,
+            log,
+            timeout=self._timeout(),
+            cancel=cancel,
+            on_progress=_progress_logger(log, outputs[0][1]),
         )
-        process = subprocess.Popen(
-                command.split(), stderr=subprocess.STDOUT, stdout=subprocess.PIPE
+
+    def execute_concat(self, input_files, output_file, log=None, cancel=None):
+        """
+        Join files of the same format into one, without converting them again.
+        """
+        list_file = output_file + ".txt"
+        with open(list_file, "w") as f:
+            for path in input_files:
+                f.write("file '{}'\n".format(path.replace("'", "'\\''")))
+
+        command = ["ffmpeg", "-nostdin", "-y", "-f", "concat", "-safe", "0"]
+        command += ["-i", list_file, "-c", "copy", output_file]
+        try:
+            return run_process(
+                command, log or logger, timeout=self._timeout(), cancel=cancel
+            )
+        finally:
+            os.remove(list_file)
+
+    def execute_ccextractor(self, input_file, output_file, log=None, cancel=None):
+        command = [self.config["recording", "ccextractor"], input_file]
+        command += ["-o", output_file]
+        return run_process(
+            command, log or logger, timeout=self._timeout(), cancel=cancel
         )
-        stdout, _ = process.communicate()
-        return stdout.decode("ascii")
+
+
+def _progress_logger(log, name):
+    last = [None]
+
+    def on_progress(progress):
+        now = time.monotonic()
+        if progress["done"] or last[0] is None or now - last[0] >= PROGRESS_INTERVAL:
+            last[0] = now
+            log.info(
+                "{}: {}s written at {}x, {} frames".format(
+                    name, progress["out_time"], progress["speed"], progress["frame"]
+                )
+            )
+
+    return on_progress
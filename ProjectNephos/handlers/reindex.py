@@ -0,0 +1,29 @@
+from ProjectNephos.backends import DataStore
+from ProjectNephos.handlers.base import BaseHandler
+
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class ReindexHandler(BaseHandler):
+    """
+    Rebuilds the local search index from the files that are actually on the backends.
+    The index is kept up to date by Nephos itself, so this is only needed if files were
+    changed on the backends by something else, or for files uploaded by an older version.
+    """
+
+    def init_with_config(self, config):
+        super().init_with_config(config)
+
+        self.backend = DataStore(config)
+
+    def execute_command(self):
+        return self.backend.reindex()
+
+    def run(self, args):
+        response = self.execute_command()
+
+        for backend, count in response.items():
+            print("{}\t{} files indexed".format(backend, count))
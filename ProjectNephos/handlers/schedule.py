@@ -1,17 +1,24 @@
+import itertools
+import sys
+import time
 from logging import getLogger
 from ProjectNephos.backends import DBStorage
 
 from ProjectNephos.handlers.base import BaseHandler
+from ProjectNephos.listings import FORMATS, read_listings
 
 logger = getLogger(__name__)
 
 
 class ScheduleHandler(BaseHandler):
     """
-    Add or list channel schedules.
+    Add, import or list channel schedules.
     The channel should already have been added to Nephos.
     """
 
+    # Programs written to the database per transaction during an import.
+    BATCH_SIZE = 500
+
     def init_with_config(self, config):
         super().init_with_config(config)
         self.db = DBStorage(config)
@@ -20,7 +27,9 @@ class ScheduleHandler(BaseHandler):
         parser = super().init_args(subparser)
 
         parser.add_argument(
-            "action", help="Define what action to take.", choices=["list", "add"]
+            "action",
+            help="Define what action to take.",
+            choices=["list", "add", "import"],
         )
 
         parser.add_argument("--channel", action="store", help="Name of the channel")
@@ -43,6 +52,82 @@ class ScheduleHandler(BaseHandler):
             help="Tags that should be associated with the program.",
         )
 
+        parser.add_argument(
+            "--file", action="store", help="Listings file to import. - for stdin."
+        )
+        parser.add_argument(
+            "--format",
+            action="store",
+            choices=FORMATS,
+            help="Format of the listings file. Guessed from the extension by default.",
+        )
+
+    def execute_command(self, programs):
+        """
+        Import programs, as read by one of the readers in ProjectNephos.listings,
+        BATCH_SIZE at a time. Programs for channels Nephos doesn't know and programs
+        without a title are skipped.
+
+        Returns:
+            Dictionary with the number of added, updated and skipped programs, the
+            number of those skipped for lack of a title, and the seconds it took.
+        """
+        channels = set(x.name for x in self.db.get_channels())
+        counts = {"added": 0, "updated": 0, "skipped": 0, "untitled": 0}
+        unknown = set()
+
+        def resolve(program):
+            if not program["program"]:
+                logger.warning(
+                    "Skipping program without a title on {} at {}".format(
+                        program["channel"], program["start"]
+                    )
+                )
+                counts["skipped"] += 1
+                counts["untitled"] += 1
+                return None
+
+            candidates = [program["channel"]] + program.get("aliases", [])
+            for name in candidates:
+                if name in channels:
+                    program["channel"] = name
+                    return program
+            if program["channel"] not in unknown:
+                unknown.add(program["channel"])
+                logger.warning("Skipping unknown channel {}".format(program["channel"]))
+            counts["skipped"] += 1
+            return None
+
+        start = time.time()
+        resolved = (x for x in map(resolve, programs) if x is not None)
+        while True:
+            batch = list(itertools.islice(resolved, self.BATCH_SIZE))
+            if not batch:
+                break
+            added, updated = self.db.import_schedule(batch)
+            counts["added"] += added
+            counts["updated"] += updated
+
+        counts["seconds"] = time.time() - start
+        return counts
+
+    @staticmethod
+    def _report(counts):
+        total = counts["added"] + counts["updated"]
+        elapsed = counts["seconds"]
+        print(
+            "Imported {} programs ({} new, {} updated, {} skipped, {} of them without "
+            "a title) in {:.1f}s, {:.0f} programs/s".format(
+                total,
+                counts["added"],
+                counts["updated"],
+                counts["skipped"],
+                counts["untitled"],
+                elapsed,
+                total / elapsed if elapsed > 0 else 0,
+            )
+        )
+
     def run(self, args):
         if args.action == "add":
             if not all([args.channel, args.name, args.start, args.duration]):
@@ -61,6 +146,26 @@ class ScheduleHandler(BaseHandler):
                 args.name, args.channel, args.start, args.duration, args.tags
             )
 
+        if args.action == "import":
+            if not args.file:
+                logger.critical("--file is required. Try again.")
+                return -1
+
+            fmt = args.format or args.file.rsplit(".", 1)[-1].lower()
+            if fmt == "xml":
+                fmt = "xmltv"
+            if fmt not in FORMATS:
+                logger.critical("Unknown format. Provide one with --format.")
+                return -1
+
+            if args.file == "-":
+                f = sys.stdin.buffer if fmt == "xmltv" else sys.stdin
+                counts = self.execute_command(read_listings(f, fmt))
+            else:
+                with open(args.file, "rb" if fmt == "xmltv" else "r") as f:
+                    counts = self.execute_command(read_listings(f, fmt))
+            self._report(counts)
+
         if args.action == "list":
             for items in self.db.get_schedule_items():
                 print(items)
@@ -61,5 +61,6 @@ class TagHandler(BaseHandler):
 
         file_ids = [x[1] for x in relevant_files]
 
-        for fid in file_ids:
-            self.backend.tag(fid, args.add_tags)
+        results = self.backend.tag_bulk(file_ids, args.add_tags)
+        for backend, failed in self.backend.failed_items(results).items():
+            logger.critical("Could not tag {} files on {}".format(len(failed), backend))
@@ -0,0 +1,180 @@
+"""
+Readers for TV listings, as used by `nephos schedule import`.
+
+Every reader takes an open file and lazily yields one dictionary per program with
+the keys channel, program, start (in the cron format used by jobs), duration (in
+minutes) and tags (a list). XMLTV programs also have aliases, the display names of
+their channel.
+"""
+import csv
+import json
+import re
+from datetime import datetime
+from xml.etree.ElementTree import iterparse
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+FORMATS = ["xmltv", "csv", "json"]
+
+
+def to_cron(start):
+    """
+    Convert a datetime to the cron format used for jobs, i.e.
+    "minute hour day month day_of_week year". Aware datetimes are converted to local
+    time first, as that is what the scheduler runs on.
+    """
+    if start.tzinfo is not None:
+        start = start.astimezone()
+    return "{} {} {} {} * {}".format(
+        start.minute, start.hour, start.day, start.month, start.year
+    )
+
+
+ISO_FORMATS = [
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%dT%H",
+    "%Y-%m-%d",
+]
+ISO_OFFSET = re.compile(r"(Z|[+-]\d\d:?\d\d)$")
+
+
+def _parse_iso(value):
+    """
+    Parse the ISO 8601 dates that datetime.fromisoformat would, e.g.
+    "2018-06-01 20:00" or "2018-06-01T20:00:00+02:00". That function is only
+    available from Python 3.7 on.
+    """
+    value = value.strip()
+    offset = ISO_OFFSET.search(value)
+    if offset is not None:
+        value = value[: offset.start()]
+    if len(value) > 10:
+        # Date and time may be separated by any character.
+        value = value[:10] + "T" + value[11:]
+
+    for fmt in ISO_FORMATS:
+        try:
+            parsed = datetime.strptime(value, fmt)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError("Invalid isoformat string: {!r}".format(value))
+
+    if offset is not None:
+        # Before Python 3.7 %z neither takes "Z" nor a colon in the offset.
+        tz = offset.group().replace("Z", "+0000").replace(":", "")
+        parsed = parsed.replace(tzinfo=datetime.strptime(tz, "%z").tzinfo)
+    return parsed
+
+
+def _parse_start(value):
+    """
+    Start times can be given either in cron format already or as an ISO 8601 date.
+    """
+    if len(value.split()) == 6:
+        return value
+    return to_cron(_parse_iso(value))
+
+
+def _parse_xmltv_time(value):
+    # e.g. "20180601200000 +0200". The offset is optional.
+    if " " in value:
+        return datetime.strptime(value, "%Y%m%d%H%M%S %z")
+    return datetime.strptime(value, "%Y%m%d%H%M%S")
+
+
+def read_xmltv(f):
+    """
+    Programs are matched to channels by the XMLTV channel id. If a channel id isn't
+    the name of the Nephos channel, any of its display names can be instead.
+    """
+    names = {}
+    root = None
+    for event, elem in iterparse(f, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+
+        if elem.tag == "channel":
+            names[elem.get("id")] = [x.text for x in elem.findall("display-name")]
+            root.clear()
+
+        elif elem.tag == "programme":
+            start = _parse_xmltv_time(elem.get("start"))
+            stop = _parse_xmltv_time(elem.get("stop"))
+            channel = elem.get("channel")
+
+            yield {
+                "channel": channel,
+                "aliases": names.get(channel, []),
+                "program": elem.findtext("title"),
+                "start": to_cron(start),
+                "duration": int((stop - start).total_seconds() // 60),
+                "tags": [x.text for x in elem.findall("category") if x.text],
+            }
+            # Keep memory flat no matter how large the file is. Clearing only the
+            # element would still leave an empty one behind for every program.
+            root.clear()
+
+
+def read_csv(f):
+    """
+    Columns: channel, program, start, duration, tags. Tags are separated by spaces.
+    """
+    for row in csv.DictReader(f):
+        yield {
+            "channel": row["channel"],
+            "program": row["program"],
+            "start": _parse_start(row["start"]),
+            "duration": int(row["duration"]),
+            "tags": (row.get("tags") or "").split(),
+        }
+
+
+def read_json(f):
+    """
+    Either a JSON array of objects or one object per line (JSON Lines). Objects have
+    the same keys as the CSV columns, with tags as a list. Only JSON Lines are read
+    lazily.
+    """
+    first = f.read(1)
+    while first.isspace():
+        first = f.read(1)
+
+    if first == "[":
+        items = json.loads(first + f.read())
+    else:
+        items = (json.loads(x) for x in _prepend(first, f) if x.strip())
+
+    for item in items:
+        yield {
+            "channel": item["channel"],
+            "program": item["program"],
+            "start": _parse_start(item["start"]),
+            "duration": int(item["duration"]),
+            "tags": item.get("tags") or [],
+        }
+
+
+def _prepend(first, f):
+    lines = iter(f)
+    yield first + next(lines, "")
+    yield from lines
+
+
+def read_listings(f, fmt):
+    """
+    Takes:
+        An open file. XMLTV needs it to be opened in binary mode.
+        One of FORMATS.
+    Returns:
+        A generator of programs.
+    """
+    readers = {"xmltv": read_xmltv, "csv": read_csv, "json": read_json}
+    return readers[fmt](f)
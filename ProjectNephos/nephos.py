@@ -16,6 +16,7 @@ from ProjectNephos.handlers.permissions import PermissionHandler
 from ProjectNephos.handlers.channels import ChannelHandler
 from ProjectNephos.handlers.jobs import JobHandler
 from ProjectNephos.handlers.schedule import ScheduleHandler
+from ProjectNephos.handlers.reindex import ReindexHandler
 
 ActionHandlers = [
     UploadHandler("upload"),
@@ -27,6 +28,7 @@ ActionHandlers = [
     ChannelHandler("channel"),
     JobHandler("job"),
     ScheduleHandler("schedule"),
+    ReindexHandler("reindex"),
 ]
 
 
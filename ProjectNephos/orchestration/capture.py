@@ -0,0 +1,255 @@
+"""
+A recorder that captures a channel in-process, as an alternative to multicat.
+
+It joins the multicast group of the channel with asyncio and writes the TS packets
+it receives straight to disk, keeping count of what it has seen so progress can be
+reported while recording. Recordings can be split into segments of a fixed length,
+which are handed off as soon as they are closed.
+"""
+import asyncio
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ProjectNephos.orchestration.mpegts import (
+    NULL_PID,
+    TS_PACKET_SIZE,
+    get_pid,
+    is_broken,
+    open_socket,
+    parse_address,
+    strip_rtp,
+)
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Writes are a multiple of both the TS packet size and the usual 4KiB block size.
+WRITE_ALIGN = 47 * 4096
+BUFFER_SIZE = 6 * WRITE_ALIGN  # ~1.1MiB
+
+
+def segment_path(path, index):
+    """
+    Path of segment `index` of the recording at `path`.
+    """
+    base, ext = os.path.splitext(path)
+    return "{}.part{:03d}{}".format(base, index, ext)
+
+
+def concat_files(paths, dest):
+    """
+    Join files into `dest`, one after the other. TS files can be joined as is.
+    """
+    with open(dest, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out, BUFFER_SIZE)
+
+
+class CaptureStats(object):
+    """
+    bytes: bytes written to disk.
+    packets: TS packets received.
+    errors: broken packets, which are dropped. See mpegts.is_broken.
+    continuity_errors: packets missing according to the continuity counters.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.bytes = 0
+        self.packets = 0
+        self.errors = 0
+        self.continuity_errors = 0
+
+    def __repr__(self):
+        return (
+            "<CaptureStats: {:.0f}s, {} bytes, {} packets, {} errors, "
+            "{} continuity errors>".format(
+                time.monotonic() - self.started,
+                self.bytes,
+                self.packets,
+                self.errors,
+                self.continuity_errors,
+            )
+        )
+
+
+class TSWriter(object):
+    """
+    Takes datagrams and writes the good TS packets in them to a file, in large
+    aligned writes.
+    """
+
+    def __init__(self, path, stats=None, buffer_size=BUFFER_SIZE):
+        self.stats = stats or CaptureStats()
+        self.buffer_size = buffer_size
+        self._buffer = bytearray()
+        # Last continuity counter per PID.
+        self._counters = {}
+        self.path = path
+        self._file = open(path, "wb", buffering=0)
+
+    def _check_continuity(self, packet):
+        pid = get_pid(packet)
+        if pid == NULL_PID:
+            return
+
+        control = packet[3] >> 4 & 0x3
+        counter = packet[3] & 0x0F
+        last = self._counters.get(pid)
+        discontinuity = control & 0x2 and packet[4] > 0 and packet[5] & 0x80
+
+        # The counter only moves on packets with a payload. A single repeat is allowed.
+        if control & 0x1:
+            if (
+                last is not None
+                and not discontinuity
+                and counter not in (last, (last + 1) & 0x0F)
+            ):
+                self.stats.continuity_errors += (counter - last - 1) & 0x0F
+            self._counters[pid] = counter
+
+    def feed(self, data):
+        data = memoryview(strip_rtp(data))
+        for i in range(0, len(data), TS_PACKET_SIZE):
+            packet = data[i : i + TS_PACKET_SIZE]
+            self.stats.packets += 1
+            if is_broken(packet):
+                self.stats.errors += 1
+                continue
+            self._check_continuity(packet)
+            self._buffer += packet
+
+        if len(self._buffer) >= self.buffer_size:
+            self.flush(aligned=True)
+
+    def flush(self, aligned=False):
+        size = len(self._buffer)
+        if aligned:
+            size -= size % WRITE_ALIGN
+        if size:
+            self._file.write(self._buffer[:size])
+            del self._buffer[:size]
+            self.stats.bytes += size
+
+    def rotate(self, path):
+        """
+        Close the current file and continue writing to `path`.
+
+        Returns:
+            Path of the closed file.
+        """
+        self.close()
+        closed, self.path = self.path, path
+        self._file = open(path, "wb", buffering=0)
+        return closed
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class _CaptureProtocol(asyncio.DatagramProtocol):
+    def __init__(self, writer):
+        self.writer = writer
+
+    def datagram_received(self, data, _):
+        self.writer.feed(data)
+
+    def error_received(self, exc):
+        logger.warning("Error while capturing: {}".format(exc))
+
+
+async def record(
+    address,
+    path,
+    duration,
+    bind=None,
+    progress=None,
+    interval=10,
+    segment=None,
+    on_segment=None,
+):
+    """
+    Takes:
+        Address of the channel, as "ip:port".
+        Path of the file to write to.
+        Seconds to record for.
+        (optional) IP of the interface to join the multicast group on.
+        (optional) function called with the CaptureStats every `interval` seconds
+            and once at the end.
+        (optional) length of segments in seconds. If given, the recording is
+            written to segment_path(path, 0), segment_path(path, 1), ... instead.
+        (optional) function called with the path of every segment once it is
+            closed, including the last one. It is called on a separate thread, one
+            segment after the other, so it may block. All calls are done by the
+            time `record` returns.
+    Returns:
+        The final CaptureStats.
+    Raises:
+        OSError if the channel can't be listened to.
+        Whatever `on_segment` raised.
+    """
+    loop = asyncio.get_event_loop()
+    # Keeps on_segment off the loop, which must not stop reading from the socket.
+    handoff = ThreadPoolExecutor(max_workers=1)
+    pending = []
+
+    def hand_off(closed):
+        if on_segment is not None:
+            pending.append(loop.run_in_executor(handoff, on_segment, closed))
+
+    try:
+        sock = open_socket(*parse_address(address), bind)
+        index = 0
+        writer = TSWriter(segment_path(path, index) if segment else path)
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _CaptureProtocol(writer), sock=sock
+        )
+
+        try:
+            now = loop.time()
+            deadline = now + duration
+            next_report = now + interval
+            next_segment = now + segment if segment else deadline
+
+            while now < deadline:
+                if now >= next_segment:
+                    index += 1
+                    hand_off(writer.rotate(segment_path(path, index)))
+                    next_segment += segment
+                if now >= next_report:
+                    next_report += interval
+                    if progress is not None:
+                        progress(writer.stats)
+
+                await asyncio.sleep(min(deadline, next_segment, next_report) - now)
+                now = loop.time()
+        finally:
+            transport.close()
+            writer.close()
+
+        if progress is not None:
+            progress(writer.stats)
+        if segment:
+            hand_off(writer.path)
+        await asyncio.gather(*pending)
+    finally:
+        handoff.shutdown(wait=False)
+    return writer.stats
+
+
+def capture(address, path, duration, **kwargs):
+    """
+    Blocking version of `record`, for use outside of an event loop. Runs on a new
+    event loop of its own, so it can be called from any thread.
+    """
+    # Not asyncio.run, which is only available from Python 3.7 on.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(record(address, path, duration, **kwargs))
+    finally:
+        loop.close()
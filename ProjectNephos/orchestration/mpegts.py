@@ -0,0 +1,66 @@
+"""
+Bits of MPEG-TS over UDP shared by the channel probes and the native recorder.
+"""
+import ipaddress
+import socket
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+NULL_PID = 0x1FFF
+RTP_HEADER_SIZE = 12
+# multicat listens on this port if the address of a channel has none.
+DEFAULT_PORT = 1234
+# Bursts of a high bitrate channel have to fit while the reader is busy.
+RECEIVE_BUFFER = 8 * 1024 * 1024
+
+
+def strip_rtp(data):
+    """
+    Return the TS payload of a datagram that is either raw TS or RTP.
+    """
+    if len(data) % TS_PACKET_SIZE == RTP_HEADER_SIZE and data[0] >> 6 == 2:
+        return data[RTP_HEADER_SIZE:]
+    return data
+
+
+def get_pid(packet):
+    return ((packet[1] & 0x1F) << 8) | packet[2]
+
+
+def is_broken(packet):
+    """
+    True if the packet is truncated, has a bad sync byte or the transport error bit.
+    """
+    return len(packet) < TS_PACKET_SIZE or packet[0] != TS_SYNC_BYTE or packet[1] & 0x80
+
+
+def parse_address(address):
+    """
+    Split the "ip:port" address of a channel.
+    """
+    host, _, port = address.partition(":")
+    return host, int(port) if port else DEFAULT_PORT
+
+
+def open_socket(host, port, bind=None):
+    """
+    Returns:
+        A UDP socket receiving the datagrams sent to host:port. Multicast groups
+        are joined on the interface with the IP `bind`, or the default one.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    # A probe and a recording of the same channel may run at the same time.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        if ipaddress.ip_address(host).is_multicast:
+            # Binding to the group address keeps other groups on the port out.
+            sock.bind((host, port))
+            membership = socket.inet_aton(host) + socket.inet_aton(bind or "0.0.0.0")
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            sock.bind(("", port))
+    except (OSError, ValueError):
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,69 @@
+import os
+import socket
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+def notify_new_download(config):
+    """
+    Tell the orchestration server that a new download has been queued, so that it is
+    processed right away. This is a single datagram on a local UNIX socket. If the
+    server isn't listening the notification is simply lost, and the download is
+    picked up by the server's periodic check instead.
+    """
+    path = config["processing", "notify_socket"]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(b"\0", path)
+    except OSError as e:
+        logger.debug("Could not notify about the new download: {}".format(e))
+    finally:
+        sock.close()
+
+
+class DownloadListener(object):
+    """
+    Receiving end of `notify_new_download`. Only one listener can exist per socket
+    path. A stale socket file left behind by an earlier run is replaced.
+    """
+
+    def __init__(self, config):
+        self.path = config["processing", "notify_socket"]
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+    def wait(self, timeout=None):
+        """
+        Block until a notification arrives. Notifications that arrived in the meantime
+        are all consumed at once, as the queue is drained either way.
+
+        Takes:
+            (optional) seconds to wait for. None waits forever.
+        Returns:
+            True if notified, False on timeout.
+        """
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.recv(16)
+        except socket.timeout:
+            return False
+
+        self.sock.setblocking(False)
+        try:
+            while True:
+                self.sock.recv(16)
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,82 @@
+import queue
+import threading
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+_STOP = object()
+
+
+class Pipeline(object):
+    """
+    A set of named stages, each with its own queue and its own set of worker threads.
+
+    A stage is a function that takes a single item. When it is done with the item it
+    hands it on by calling `put` with the name of the next stage(s), so items can fork
+    into several stages that run at the same time. Stage queues can be bounded, in which
+    case `put` blocks until the stage has room again. This way a slow stage slows down
+    everything feeding it instead of piling up work in memory.
+
+    If a stage raises, the exception is passed to `on_error` along with the stage name
+    and the item. The pipeline itself keeps on running.
+    """
+
+    def __init__(self, on_error=None):
+        self.on_error = on_error
+        self.stages = {}
+        self.threads = []
+
+    def add_stage(self, name, func, workers=1, maxsize=0):
+        """
+        Takes:
+            Name of the stage.
+            The function to run on every item put in the stage.
+            Number of threads running the function.
+            Maximum number of items waiting in the stage. 0 means unbounded.
+        """
+        self.stages[name] = (func, workers, queue.Queue(maxsize))
+
+    def put(self, stage, item):
+        """
+        Hand an item to a stage. Blocks while the stage is full.
+        """
+        self.stages[stage][2].put(item)
+
+    def start(self):
+        for name, (func, workers, q) in self.stages.items():
+            for i in range(workers):
+                t = threading.Thread(
+                    target=self._run,
+                    args=(name, func, q),
+                    name="{}-{}".format(name, i),
+                    daemon=True,
+                )
+                t.start()
+                self.threads.append(t)
+
+    def stop(self):
+        """
+        Stop all the stage threads once they are done with what's in their queue.
+        Items that are still moving between stages at this point are dropped, so only
+        call this when the pipeline is idle.
+        """
+        for _, workers, q in self.stages.values():
+            for _ in range(workers):
+                q.put(_STOP)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _run(self, name, func, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+
+            try:
+                func(item)
+            except Exception as e:
+                logger.exception("Stage {} failed for {}".format(name, item))
+                if self.on_error is not None:
+                    self.on_error(name, item, e)
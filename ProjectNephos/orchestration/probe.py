@@ -0,0 +1,126 @@
+"""
+Channel health probes. Instead of recording a sample to disk, a probe joins the
+multicast group of a channel and reads a few hundred MPEG-TS packets straight from
+the socket, checking their sync bytes and PIDs.
+"""
+import socket
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from ProjectNephos.orchestration.mpegts import (
+    NULL_PID,
+    TS_PACKET_SIZE,
+    get_pid,
+    is_broken,
+    open_socket,
+    parse_address,
+    strip_rtp,
+)
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Channels with more broken packets than this are considered down.
+MAX_ERROR_RATIO = 0.01
+
+
+class ProbeResult(namedtuple("ProbeResult", ["packets", "errors", "pids", "error"])):
+    """
+    packets: number of TS packets read.
+    errors: how many of them had a bad sync byte or the transport error bit set.
+    pids: set of PIDs seen in the good packets.
+    error: why the probe failed early, if it did.
+    """
+
+    def is_up(self, packets):
+        """
+        A channel is up if `packets` packets were read, few were broken and they
+        carried more than null packets.
+        """
+        return (
+            self.error is None
+            and self.packets >= packets
+            and self.errors <= self.packets * MAX_ERROR_RATIO
+            and bool(self.pids - {NULL_PID})
+        )
+
+
+def parse_datagram(data):
+    """
+    Takes:
+        Payload of a single UDP datagram, either raw TS or RTP.
+    Returns:
+        Number of TS packets, number of broken ones and the set of PIDs of the good
+        ones. Trailing bytes that don't make a full packet count as a broken packet.
+    """
+    data = strip_rtp(data)
+
+    packets, errors, pids = 0, 0, set()
+    for i in range(0, len(data), TS_PACKET_SIZE):
+        packet = data[i : i + TS_PACKET_SIZE]
+        packets += 1
+        if is_broken(packet):
+            errors += 1
+        else:
+            pids.add(get_pid(packet))
+    return packets, errors, pids
+
+
+def probe_channel(address, bind=None, packets=500, timeout=5):
+    """
+    Takes:
+        Address of the channel, as "ip:port".
+        (optional) IP of the interface to join the multicast group on.
+        (optional) number of TS packets to read.
+        (optional) seconds to read for at most.
+    Returns:
+        A ProbeResult. Never raises.
+    """
+    total, errors, pids = 0, 0, set()
+    deadline = time.monotonic() + timeout
+
+    try:
+        sock = open_socket(*parse_address(address), bind)
+    except (OSError, ValueError) as e:
+        return ProbeResult(0, 0, pids, "Could not listen on {}: {}".format(address, e))
+
+    try:
+        while total < packets:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return ProbeResult(total, errors, pids, "Timed out")
+            sock.settimeout(remaining)
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                return ProbeResult(total, errors, pids, "Timed out")
+
+            n, e, p = parse_datagram(data)
+            total += n
+            errors += e
+            pids.update(p)
+    except OSError as e:
+        return ProbeResult(total, errors, pids, str(e))
+    finally:
+        sock.close()
+
+    return ProbeResult(total, errors, pids, None)
+
+
+def probe_channels(addresses, bind=None, packets=500, timeout=5, workers=8):
+    """
+    Probe many channels at once, at most `workers` at a time. See probe_channel.
+
+    Returns:
+        List of ProbeResults, in the order of `addresses`.
+    """
+    if not addresses:
+        return []
+    with ThreadPoolExecutor(min(workers, len(addresses))) as executor:
+        return list(
+            executor.map(
+                lambda x: probe_channel(x, bind, packets, timeout), addresses
+            )
+        )
@@ -1,9 +1,13 @@
 import datetime
-import subprocess
+import os
 import logging
 
 from ProjectNephos.backends.DataBase import Job, DBStorage
 from ProjectNephos.config import Configuration
+from ProjectNephos.exceptions import ProcessFailed
+from ProjectNephos.orchestration.capture import capture, concat_files
+from ProjectNephos.orchestration.notify import notify_new_download
+from ProjectNephos.runner import run_process
 
 logger = logging.getLogger(__name__)
 
@@ -42,10 +46,31 @@ def record_video(job, config):
     fh.setFormatter(formatter)
     logger.addHandler(fh)
 
+    channel = db.get_channels(job.channel)
+    # Don't hold on to a read transaction for the whole recording.
+    db.close()
+    segments = None
+    if float(config["recording", "segment_length"]) > 0:
+        segments = _record_segmented(job, channel, full_path, config, logger, db)
+        ok = bool(segments)
+    elif config["recording", "recorder"] == "native":
+        ok = _record_native(job, channel, full_path, config, logger)
+    else:
+        ok = _record_multicat(job, channel, full_path, config, logger)
+    if not ok:
+        return -1
+
+    logger.debug("Recording completed successfully for the job {}".format(job))
+    db.add_file(full_path, job.name, segments=segments)
+    db.close()
+    notify_new_download(config)
+    return 0
+
+
+def _record_multicat(job, channel, full_path, config, logger):
     duration = job.duration * 60 * 27000000
     multicat = config["recording", "multicat"]
     bind_ip = config["recording", "bind"]
-    channel = db.get_channels(job.channel)
 
     if bind_ip:
         bind_ip = "/ifaddr=" + bind_ip
@@ -59,19 +84,94 @@ def record_video(job, config):
     )
 
     try:
-        stdout = subprocess.check_output(command.split(), stderr=subprocess.STDOUT)
+        # multicat stops on its own after `duration`. Give it a minute extra before
+        # assuming it hangs.
+        run_process(command.split(), logger, timeout=job.duration * 60 + 60)
 
     except FileNotFoundError:
         logger.critical(
             "multicat does not exist at the provided path {}".format(multicat)
         )
-        return -1
-    except subprocess.CalledProcessError:
-        logger.critical("Some error has occured during recording {}".format(job))
-        logger.critical("Dumping output:\n{}".format(stdout))
-        return -1
+        return False
+    except ProcessFailed as e:
+        logger.critical("Some error has occured during recording {}: {}".format(job, e))
+        logger.critical("Dumping output:\n{}".format(e.output))
+        return False
+    return True
 
-    logger.debug("Recording completed successfully for the job {}".format(job))
-    db.add_file(full_path, job.name)
-    db.session.close()
-    return 0
+
+def _record_native(job, channel, full_path, config, logger):
+    """
+    Record with the in-process recorder, see capture.py, logging its progress.
+    """
+    try:
+        stats = capture(
+            channel.ip_string,
+            full_path,
+            job.duration * 60,
+            bind=config["recording", "bind"],
+            progress=lambda x: logger.info("Recording {}: {}".format(job.name, x)),
+            interval=float(config["recording", "progress_interval"]),
+        )
+    except OSError:
+        logger.exception("Could not record {}".format(job))
+        return False
+
+    logger.info("Recording {} finished: {}".format(job.name, stats))
+    if not stats.bytes:
+        logger.critical("Nothing was received while recording {}".format(job))
+        return False
+    return True
+
+
+def _record_segmented(job, channel, full_path, config, logger, db):
+    """
+    Record with the in-process recorder in segments of `segment_length` minutes.
+    Every segment is queued for post-processing as soon as it is closed. Once the
+    recording is done, the segments are joined into `full_path`.
+
+    Returns:
+        Number of segments, see capture.segment_path. Empty segments are dropped
+        but still counted. 0 if nothing was recorded.
+    """
+    segments = []
+    count = 0
+
+    def on_segment(path):
+        # Runs on a thread of its own, see capture.record. `db` isn't used elsewhere
+        # until the capture is over.
+        nonlocal count
+        count += 1
+        if not os.path.getsize(path):
+            logger.warning("Nothing was received for segment {}".format(path))
+            os.remove(path)
+            return
+        segments.append(path)
+        db.add_file(path, job.name, parent=full_path)
+        db.close()
+        notify_new_download(config)
+
+    try:
+        stats = capture(
+            channel.ip_string,
+            full_path,
+            job.duration * 60,
+            bind=config["recording", "bind"],
+            progress=lambda x: logger.info("Recording {}: {}".format(job.name, x)),
+            interval=float(config["recording", "progress_interval"]),
+            segment=float(config["recording", "segment_length"]) * 60,
+            on_segment=on_segment,
+        )
+    except OSError:
+        logger.exception("Could not record {}".format(job))
+        return 0
+
+    logger.info("Recording {} finished: {}".format(job.name, stats))
+    if not segments:
+        logger.critical("Nothing was received while recording {}".format(job))
+        return 0
+
+    # The segments stay until the whole recording is processed, see
+    # PostProcessingPipeline.
+    concat_files(segments, full_path)
+    return count
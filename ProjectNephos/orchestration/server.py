@@ -1,11 +1,16 @@
+import threading
+
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ProcessPoolExecutor
 from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 from ProjectNephos.orchestration.tasks import run_job, check_channel_up
+from ProjectNephos.orchestration.notify import DownloadListener
 from ProjectNephos.orchestration.recording import record_video
+from ProjectNephos.orchestration.workers import WorkerPool
 from ProjectNephos.backends import DBStorage
 
 from logging import getLogger
@@ -28,9 +33,17 @@ class Server(object):
 
     The core of this server is a scheduler(APScheduler). It makes sure that jobs(functions)
     run at the specified REFRESH_TIMER. Event listeners are put in place to react to failures/successes.
+
+    New downloads don't wait for the timer though. Recording jobs notify the server as
+    soon as they queue a download, see `start_listener`, so the timer is only there
+    to catch notifications that got lost.
+
+    Recording jobs are reloaded every JOB_RELOAD_TIMER seconds, so jobs added, changed
+    or removed while the server is running are picked up without a restart.
     """
     JOB_LIST = [run_job]
-    REFRESH_TIMER = 5
+    REFRESH_TIMER = 60
+    JOB_RELOAD_TIMER = 10
 
     def __init__(self, config):
         self.config = config
@@ -38,6 +51,10 @@ class Server(object):
 
         self.jobs = self.JOB_LIST
         self.running_jobs = []
+        # Job id to the version (updated_at) of the job that is currently scheduled.
+        self.recording_jobs = {}
+        self.pool = None
+        self.listener = None
         logger.debug("Starting Orchestration.")
 
         self.sched = BlockingScheduler(
@@ -49,42 +66,128 @@ class Server(object):
             },
         )
 
+    def start_workers(self):
+        """
+        Start the post-processing worker pool, if one is configured. Without it,
+        downloads are processed one at a time by the periodic run_job instead.
+        """
+        pool = WorkerPool(self.config)
+        if pool.size == 0:
+            logger.debug("No post-processing workers configured.")
+            return
+
+        pool.start()
+        self.pool = pool
+
+    def start_listener(self):
+        """
+        Start listening for the notifications sent by recording jobs when they queue a
+        new download. See `on_new_download`.
+        """
+        self.listener = DownloadListener(self.config)
+        t = threading.Thread(target=self._listen_loop, daemon=True)
+        t.start()
+
+    def _listen_loop(self):
+        while True:
+            try:
+                self.listener.wait()
+            except OSError:
+                # The listener was closed.
+                return
+            self.on_new_download()
+
+    def on_new_download(self):
+        """
+        Get new downloads processed right away, by waking up the workers if there are
+        any or by running run_job otherwise.
+        """
+        logger.debug("New download queued.")
+        if self.pool is not None:
+            self.pool.notify()
+        else:
+            self.sched.add_job(run_job, args=[self.sched, self.config])
+
     def add_regular_jobs(self):
+        if self.pool is None:
+            j = self.sched.add_job(
+                run_job,
+                args=[self.sched, self.config],
+                trigger="interval",
+                seconds=self.REFRESH_TIMER,
+            )
+            logger.debug("Added regular job {}: {}".format(j.id, j.func))
+
         j = self.sched.add_job(
-            run_job,
+            check_channel_up,
             args=[self.sched, self.config],
             trigger="interval",
-            seconds=self.REFRESH_TIMER,
+            minutes=30,
         )
         logger.debug("Added regular job {}: {}".format(j.id, j.func))
 
         j = self.sched.add_job(
-            check_channel_up,
-            args=[self.sched, self.config],
+            self.add_recording_jobs,
             trigger="interval",
-            minutes=30,
+            seconds=self.JOB_RELOAD_TIMER,
+            max_instances=1,
         )
         logger.debug("Added regular job {}: {}".format(j.id, j.func))
 
-    def add_recording_jobs(self):
-        job_list = self.db.get_job()
+    @staticmethod
+    def _recording_id(job_id):
+        return "recording-{}".format(job_id)
 
-        for job in job_list:
+    def add_recording_jobs(self):
+        """
+        Bring the scheduled recordings in line with the jobs in the database. Only
+        the ids and versions of all jobs are read. Jobs that are new or have
+        changed since the last call are (re)scheduled and jobs that are gone are
+        unscheduled, everything else is left alone.
+        """
+        versions = self.db.get_job_versions()
+
+        for job_id in [x for x in self.recording_jobs if x not in versions]:
+            try:
+                self.sched.remove_job(self._recording_id(job_id))
+            except JobLookupError:
+                # It already ran for the last time.
+                pass
+            del self.recording_jobs[job_id]
+            logger.debug("Removed recording job {}".format(job_id))
+
+        changed = [
+            x
+            for x, version in versions.items()
+            if x not in self.recording_jobs or self.recording_jobs[x] != version
+        ]
+        for job in self.db.get_jobs_by_ids(changed):
+            # Whatever happens, don't try the same version again on the next reload.
+            self.recording_jobs[job.id] = versions[job.id]
             cron = job.start.split()
 
-            j = self.sched.add_job(
-                record_video,
-                args=[job, self.config],
-                trigger="cron",
-                minute=cron[0],
-                hour=cron[1],
-                day=cron[2],
-                month=cron[3],
-                day_of_week=cron[4],
-                year=cron[5],
-            )
+            try:
+                j = self.sched.add_job(
+                    record_video,
+                    args=[job, self.config],
+                    trigger="cron",
+                    minute=cron[0],
+                    hour=cron[1],
+                    day=cron[2],
+                    month=cron[3],
+                    day_of_week=cron[4],
+                    year=cron[5],
+                    id=self._recording_id(job.id),
+                    replace_existing=True,
+                )
+            except (ValueError, IndexError):
+                logger.exception("Invalid start time for {}".format(job))
+                continue
             logger.debug("Added recording job {}: {}".format(j.id, j.func))
 
+        # Don't keep a read transaction open between reloads.
+        self.db.close()
+
     @staticmethod
     def endjob_listener(event):
         if event.exception:
@@ -97,6 +200,8 @@ class Server(object):
             )
 
     def run_server(self):
+        self.start_workers()
+        self.start_listener()
         self.add_regular_jobs()
         self.add_recording_jobs()
 
@@ -104,11 +209,14 @@ class Server(object):
             self.endjob_listener, EVENT_JOB_ERROR | EVENT_JOB_EXECUTED
         )
 
-        self.db.session.close()
+        self.db.close()
 
         try:
             self.sched.start()
         except KeyboardInterrupt:
             logger.info("Interrupt received.")
             self.sched.shutdown()
+            if self.pool is not None:
+                self.pool.stop()
+            self.listener.close()
             logger.debug("Orchestration shut down.")
@@ -1,36 +1,69 @@
-import datetime
+import contextlib
 import os
-import subprocess
+import queue
+import threading
+from collections import namedtuple
 
 from ProjectNephos.backends import DBStorage
 from ProjectNephos.handlers.upload import UploadHandler
 from ProjectNephos.handlers.process import ProcessHandler
 from ProjectNephos.handlers.tag import TagHandler
 from ProjectNephos.handlers.permissions import PermissionHandler
+from ProjectNephos.orchestration.capture import segment_path
+from ProjectNephos.orchestration.pipeline import Pipeline
+from ProjectNephos.orchestration.probe import probe_channels
+from ProjectNephos.profiles import get_profiles
 
 from logging import getLogger
 
 logger = getLogger("ProjectNephos.job_log")
 
 
+def temp_path(filename, extension, config):
+    """
+    Path in the temp folder for `filename` with its extension changed.
+    """
+    file_basename = filename.split("/")[-1]
+
+    # This code changes the extension of the file
+    l = file_basename.split(".")
+    l.pop()  # Remove old extension
+    l.append(extension)  # add new extension
+    new_filename = ".".join(l)
+    return config["downloads", "temp_save_location"] + new_filename
+
+
+def output_paths(filename, convert_to, config):
+    """
+    Returns:
+        The paths `filename` is converted to. There are several if `convert_to` is a
+        profile with renditions, see profiles.py. The first one is the main output.
+    """
+    profiles = get_profiles(config, convert_to)
+    if profiles is None:
+        return [temp_path(filename, convert_to, config)]
+    if len(profiles) == 1:
+        return [temp_path(filename, profiles[0].extension, config)]
+    return [
+        temp_path(filename, "{}.{}".format(x.name, x.extension), config)
+        for x in profiles
+    ]
+
+
 def process_job(convert_to, filename, config):
     if convert_to:
         p = ProcessHandler("process")
         p.init_with_config(config)
 
-        file_basename = filename.split("/")[-1]
-
-        # This code changes the extension of the file
-        l = file_basename.split(".")
-        l.pop()  # Remove old extension
-        l.append(convert_to)  # add new extension
-        new_filename = ".".join(l)
-        new_full_path = config["downloads", "temp_save_location"] + new_filename
-        logger.debug(new_full_path)
+        profiles = get_profiles(config, convert_to)
+        paths = output_paths(filename, convert_to, config)
+        logger.debug(paths)
 
-        stdout = p.execute_command(filename, new_full_path)
-        logger.debug("FFMPEG OUTPUT:\n{}".format(stdout))
-        return new_full_path
+        if profiles is None:
+            p.execute_command(filename, paths[0], log=logger)
+        else:
+            p.execute_profiles(filename, list(zip(profiles, paths)), log=logger)
+        return paths[0]
     else:
         return filename
 
@@ -39,20 +72,45 @@ def run_ccex(subtitles, filename, config):
     if subtitles:
         p = ProcessHandler(config=config)
 
-        file_basename = filename.split("/")[-1]
-
-        # This code changes the extension of the file
-        l = file_basename.split(".")
-        l.pop()  # Remove old extension
-        l.append("srt")  # add new extension
-        new_filename = ".".join(l)
-        new_full_path = config["downloads", "temp_save_location"] + new_filename
+        new_full_path = temp_path(filename, "srt", config)
         logger.debug(new_full_path)
-        stdout = p.execute_ccextractor(filename, new_full_path)
-        logger.debug("CCEx Output:\n{}".format(stdout))
+        p.execute_ccextractor(filename, new_full_path, log=logger)
         return new_full_path
 
 
+def segment_files(download, convert_to, config):
+    """
+    Returns:
+        The segments of a segmented recording that are on disk and, for each of
+        them, the paths it is converted to (see output_paths). The latter is empty if
+        there is nothing to convert to.
+    """
+    raw = [segment_path(download.filename, i) for i in range(download.segments)]
+    raw = [x for x in raw if os.path.exists(x)]
+    if not convert_to:
+        return raw, []
+    return raw, [output_paths(x, convert_to, config) for x in raw]
+
+
+def join_job(convert_to, download, config):
+    """
+    Same as process_job, for segmented recordings. If all segments have been
+    converted already, the converted segments are joined instead of converting the
+    whole recording again.
+    """
+    _, converted = segment_files(download, convert_to, config)
+    if not converted or not all(os.path.exists(y) for x in converted for y in x):
+        return process_job(convert_to, download.filename, config)
+
+    p = ProcessHandler(config=config)
+    paths = output_paths(download.filename, convert_to, config)
+    logger.debug(paths)
+
+    for i, path in enumerate(paths):
+        p.execute_concat([x[i] for x in converted], path, log=logger)
+    return paths[0]
+
+
 def upload_job(upload, path, subtitle, folder, config):
     if not upload:
         return None
@@ -96,17 +154,26 @@ def delete_job(old_path, new_path, subt_path):
     l.append("aux")  # add new extension
     aux_file = ".".join(l)
 
-    os.remove(old_path)
-    logger.debug("Deleted file {}".format(old_path))
+    # new_path is the same as old_path if nothing was converted and subt_path
+    # is None when no subtitles were extracted.
+    for path in {old_path, aux_file, new_path, subt_path} - {None}:
+        if not os.path.exists(path):
+            continue
+        os.remove(path)
+        logger.debug("Deleted file {}".format(path))
 
-    os.remove(aux_file)
-    logger.debug("Deleted file {}".format(aux_file))
 
-    os.remove(new_path)
-    logger.debug("Deleted file {}".format(new_path))
+def delete_files(paths):
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        os.remove(path)
+        logger.debug("Deleted file {}".format(path))
 
-    os.remove(subt_path)
-    logger.debug("Deleted file {}".format(subt_path))
+
+def delete_segments(download, convert_to, config):
+    raw, converted = segment_files(download, convert_to, config)
+    delete_files(raw + [y for x in converted for y in x])
 
 
 def delete_and_upload_log(config, rec_path, folder):
@@ -118,107 +185,315 @@ def delete_and_upload_log(config, rec_path, folder):
     os.remove(log_file_path)
 
 
-def run_job(_, config):
-    db = DBStorage(config)
-    download = db.pop_download()
-    if download is None:
-        db.session.close()
-        return 5
+def stage_limit(limits, stage):
+    """
+    Return the lock guarding `stage`. Stages without a configured limit run freely.
+
+    Takes:
+        A dictionary of stage names to semaphores (or None).
+        Name of the stage about to run.
+    """
+    if limits is None or stage not in limits:
+        return contextlib.suppress()
+    return limits[stage]
+
+
+# Plain copies of the Download and Job rows, see PostProcessingPipeline.submit.
+DownloadInfo = namedtuple("DownloadInfo", ["id", "filename", "parent", "segments"])
+JobInfo = namedtuple(
+    "JobInfo", ["name", "channel", "convert_to", "subtitles", "upload", "tags"]
+)
+
+
+class Recording(object):
+    """
+    Everything known about a single download while it moves through the
+    post-processing pipeline. `download` and `job` are a DownloadInfo and a JobInfo.
+    """
+
+    def __init__(self, download, job, permissions):
+        self.download = download
+        self.job = job
+        self.permissions = permissions
+
+        self.new_path = None
+        # Further renditions, see output_paths.
+        self.extra_paths = []
+        self.subt_path = None
+        self.fileid = None
+        self.extra_fileids = []
+        self.error = None
+
+        self._branches = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Recording: {}>".format(self.download.filename)
+
+    @property
+    def is_segment(self):
+        return self.download.parent is not None
+
+
+class PostProcessingPipeline(Pipeline):
+    """
+    The post-processing steps for recorded files, run as a pipeline.
+
+    The raw recording is handed to ffmpeg and ccextractor at the same time. The
+    subtitle file is uploaded as soon as ccextractor is done, even if ffmpeg is still
+    running. The converted recording is uploaded, tagged and shared once ffmpeg is
+    done. When both branches are finished, the local files are cleaned up and
+    `on_done` is called with the Recording. If anything failed along the way,
+    `recording.error` is set and nothing is deleted so the download can be retried.
+
+    Segments of a segmented recording are only converted. They are kept until the
+    whole recording comes through, at which point the converted segments are joined
+    instead of converting the whole recording, see join_job, and everything is
+    cleaned up.
+
+    Each stage gets `<stage>_concurrency` threads (from the processing section of the
+    config) and a queue of `queue_size` items.
+    """
+
+    def __init__(self, config, on_done, limits=None):
+        super().__init__(on_error=self._failed)
+        self.config = config
+        self.on_done = on_done
+        self.limits = limits
+
+        queue_size = int(config["processing", "queue_size"])
+        convert = max(int(config["processing", "convert_concurrency"]), 1)
+        subtitles = max(int(config["processing", "subtitles_concurrency"]), 1)
+        upload = max(int(config["processing", "upload_concurrency"]), 1)
+
+        self.add_stage("convert", self._convert, convert, queue_size)
+        self.add_stage("subtitles", self._subtitles, subtitles, queue_size)
+        self.add_stage("upload", self._upload, upload)
+        self.add_stage("upload_subtitles", self._upload_subtitles, upload)
+        self.add_stage("publish", self._publish)
+        self.add_stage("cleanup", self._cleanup)
+
+    def submit(self, db, download):
+        """
+        Feed a download into the pipeline. Blocks while the pipeline is full.
+
+        The stages only get plain copies of the rows. The session of `db` must not be
+        used from the stage threads, and the caller keeps committing on it (claiming
+        and acking other downloads), which expires any ORM objects handed out.
+
+        Takes:
+            An open DBStorage, used to look up the job and its permissions.
+            The Download object to process.
+        """
+        job = db.get_job(download.jobname)
+
+        permission_set = db.get_permissions_for_tags([x.name for x in job.tag_list])
+
+        recording = Recording(
+            DownloadInfo(
+                download.id, download.filename, download.parent, download.segments
+            ),
+            JobInfo(
+                job.name,
+                job.channel,
+                job.convert_to,
+                job.subtitles,
+                job.upload,
+                job.tags,
+            ),
+            set(permission_set),
+        )
+        subtitles = job.subtitles and not recording.is_segment
+        recording._branches = 2 if subtitles else 1
+
+        self.put("convert", recording)
+        if subtitles:
+            self.put("subtitles", recording)
+
+    def _branch_done(self, recording):
+        with recording._lock:
+            recording._branches -= 1
+            finished = recording._branches == 0
+
+        if not finished:
+            return
+        if recording.error is None and not recording.is_segment:
+            self.put("cleanup", recording)
+        else:
+            self.on_done(recording)
+
+    def _failed(self, stage, recording, error):
+        recording.error = error
+        if stage == "cleanup":
+            self.on_done(recording)
+        else:
+            self._branch_done(recording)
+
+    def _convert(self, recording):
+        with stage_limit(self.limits, "convert"):
+            if recording.download.segments:
+                recording.new_path = join_job(
+                    recording.job.convert_to, recording.download, self.config
+                )
+            else:
+                recording.new_path = process_job(
+                    recording.job.convert_to, recording.download.filename, self.config
+                )
+            if recording.job.convert_to:
+                recording.extra_paths = output_paths(
+                    recording.download.filename, recording.job.convert_to, self.config
+                )[1:]
+
+        if (
+            recording.job.upload
+            and recording.error is None
+            and not recording.is_segment
+        ):
+            self.put("upload", recording)
+        else:
+            self._branch_done(recording)
 
-    associated_job = db.get_job(download.jobname)
+    def _subtitles(self, recording):
+        with stage_limit(self.limits, "subtitles"):
+            recording.subt_path = run_ccex(
+                True, recording.download.filename, self.config
+            )
 
-    permission_set = set()
-    if associated_job.tags is not None and len(associated_job.tags) > 0:
-        for tag in associated_job.tags.split(","):
-            perms = db.get_permissions(tag)
-            for _, mail, role in perms:
-                permission_set.add((mail, role))
+        if recording.job.upload and recording.error is None:
+            self.put("upload_subtitles", recording)
+        else:
+            self._branch_done(recording)
 
-    new_path = process_job(associated_job.convert_to, download.filename, config)
+    def _upload(self, recording):
+        with stage_limit(self.limits, "upload"):
+            recording.fileid, _ = upload_job(
+                True, recording.new_path, None, recording.job.channel, self.config
+            )
+            for path in recording.extra_paths:
+                fileid, _ = upload_job(
+                    True, path, None, recording.job.channel, self.config
+                )
+                recording.extra_fileids.append(fileid)
+        self.put("publish", recording)
+
+    def _upload_subtitles(self, recording):
+        with stage_limit(self.limits, "upload"):
+            upload_job(
+                True, recording.subt_path, None, recording.job.channel, self.config
+            )
+        self._branch_done(recording)
 
-    subt_path = run_ccex(associated_job.subtitles, new_path, config)
+    def _publish(self, recording):
+        for fileid in [recording.fileid] + recording.extra_fileids:
+            tag_job(fileid, recording.job.tags, self.config)
+            share_job(fileid, recording.permissions, self.config)
+        self._branch_done(recording)
+
+    def _cleanup(self, recording):
+        delete_job(
+            recording.download.filename, recording.new_path, recording.subt_path
+        )
+        delete_files(recording.extra_paths)
+        if recording.download.segments:
+            delete_segments(
+                recording.download, recording.job.convert_to, self.config
+            )
+        delete_and_upload_log(
+            self.config, recording.download.filename, recording.job.channel
+        )
+        self.on_done(recording)
 
-    fileId, _ = upload_job(
-        associated_job.upload, new_path, subt_path, associated_job.channel, config
-    )
 
-    tag_job(fileId, associated_job.tags, config)
+def process_download(db, download, config, limits=None):
+    """
+    Run the entire post-processing pipeline for a single recorded file and wait for
+    it to finish.
 
-    share_job(fileId, permission_set, config)
+    Takes:
+        An open DBStorage.
+        The Download object to process.
+        Config object.
+        (optional) stage name to semaphore mapping limiting parallel stages.
+    Raises:
+        Whatever went wrong during processing.
+    """
+    finished = queue.Queue()
+    pipeline = PostProcessingPipeline(config, finished.put, limits)
+    pipeline.start()
 
-    delete_job(download.filename, new_path, subt_path)
+    pipeline.submit(db, download)
+    recording = finished.get()
+    pipeline.stop()
 
-    delete_and_upload_log(config, download.filename, associated_job.channel)
+    if recording.error is not None:
+        raise recording.error
 
-    db.session.close()
+
+def run_job(_, config):
+    """
+    Process downloads one after the other until the queue is empty.
+
+    Returns:
+        The number of downloads processed.
+    """
+    db = DBStorage(config)
+    processed = 0
+    try:
+        while True:
+            download = db.claim_download("run_job")
+            if download is None:
+                return processed
+
+            try:
+                process_download(db, download, config)
+            except Exception:
+                db.release_download(download)
+                raise
+            db.ack_download(download)
+            processed += 1
+    finally:
+        db.close()
 
 
 def check_channel_up(_, config):
+    """
+    Probe all channels in parallel, see probe_channels, and record whether each is
+    up. The following options are read from the `recording` section of the config:
+        probe_packets: number of TS packets a channel has to deliver to be up.
+        probe_timeout: seconds to wait for them.
+        probe_workers: max channels probed at once.
+    """
     db = DBStorage(config)
-    li_of_ch = db.get_channels()
+    channels = [(x.name, x.ip_string) for x in db.get_channels()]
+    # Don't hold on to a read transaction while probing.
+    db.close()
     logger = getLogger(__name__)
 
-    for channel in li_of_ch:
-        base_path = config["downloads", "temp_save_location"]
-        logger.debug("Testing channel: {}".format(channel))
-        full_path = (
-            base_path
-            + "ChannelTest->"
-            + channel.name
-            + "--"
-            + str(datetime.datetime.now().strftime("%Y%m%d_%H:%M"))
-            + ".ts"
-        )
+    packets = int(config["recording", "probe_packets"])
+    results = probe_channels(
+        [ip for _, ip in channels],
+        bind=config["recording", "bind"],
+        packets=packets,
+        timeout=float(config["recording", "probe_timeout"]),
+        workers=int(config["recording", "probe_workers"]),
+    )
 
-        aux_file_path = (
-                base_path
-                + "ChannelTest->"
-                + channel.name
-                + "--"
-                + str(datetime.datetime.now().strftime("%Y%m%d_%H:%M"))
-                + ".aux"
+    checks = []
+    for (name, _), result in zip(channels, results):
+        is_up = result.is_up(packets)
+        logger.debug(
+            "Channel: {} is {}. {}".format(name, "up" if is_up else "down", result)
         )
-
-        duration = 30 * 27000000  # 30 Seconds
-        multicat = config["recording", "multicat"]
-        bind_ip = config["recording", "bind"]
-
-        if bind_ip:
-            bind_ip = "/ifaddr=" + bind_ip
-
-        command = "{multicat} -u -d {duration} @{ip}{bind} {path}".format(
-            multicat=multicat,
-            duration=duration,
-            ip=channel.ip_string,
-            path=full_path,
-            bind=bind_ip,
+        checks.append(
+            {
+                "channel": name,
+                "is_up": is_up,
+                "packets": result.packets,
+                "errors": result.errors,
+                "message": result.error,
+            }
         )
 
-        try:
-            stdout = subprocess.check_output(command.split(), stderr=subprocess.STDOUT)
-
-        except FileNotFoundError:
-            logger.critical(
-                "multicat does not exist at the provided path {}".format(multicat)
-            )
-            return -1
-        except subprocess.CalledProcessError:
-            logger.critical("Some error has occured during recording test {}".format(channel.name))
-            logger.critical("Dumping output:\n{}".format(stdout))
-            return -1
-
-        logger.debug("Recording for {} saved.".format(channel.name))
-        size = os.path.getsize(full_path)
-        if size < 1024:
-            logger.debug("Channel: {} seems down.".format(channel.name))
-            db.set_channel_down(channel.name)
-        else:
-            logger.debug("Channel: {} is up.".format(channel.name))
-            db.set_channel_up(channel.name)
-
-        logger.debug("Deleting the files created.")
-        os.remove(full_path)
-        os.remove(aux_file_path)
-
-    db.session.close()
+    db.add_channel_checks(checks)
+    db.close()
     return 0
@@ -0,0 +1,159 @@
+import multiprocessing
+import os
+import queue
+import threading
+
+from ProjectNephos.backends import DBStorage
+from ProjectNephos.orchestration.tasks import PostProcessingPipeline
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    A set of long running processes that drain the downloads queue.
+
+    Each worker keeps claiming downloads from the queue for as long as there are any
+    and goes idle once the queue is empty, until `notify` is called or `idle_wait`
+    seconds have passed. Within a worker, downloads go through a
+    PostProcessingPipeline so several of them can be in different stages at once.
+    Failed downloads are released back to the queue to be retried. Heavy stages are
+    additionally guarded by semaphores shared between all workers, so that e.g. at
+    most `convert_concurrency` ffmpeg processes are ever running, no matter how many
+    workers there are.
+
+    The following options are read from the `processing` section of the config:
+        workers: number of worker processes. 0 disables the pool.
+        idle_wait: seconds to wait for a notification when the queue is found empty.
+        <stage>_concurrency: max parallel runs of the stage across all workers.
+        queue_size: how many downloads may wait in front of a stage in a worker.
+    """
+
+    STAGES = ["convert", "subtitles", "upload"]
+
+    def __init__(self, config):
+        self.config = config
+        self.size = int(config["processing", "workers"])
+        self.idle_wait = float(config["processing", "idle_wait"])
+
+        self.limits = {}
+        for stage in self.STAGES:
+            limit = int(config["processing", stage + "_concurrency"])
+            if limit > 0:
+                self.limits[stage] = multiprocessing.BoundedSemaphore(limit)
+
+        self.stop_event = multiprocessing.Event()
+        # One per worker, as each worker clears its own once it wakes up.
+        self.wakeups = []
+        self.processes = []
+
+    def start(self):
+        for i in range(self.size):
+            wakeup = multiprocessing.Event()
+            self.wakeups.append(wakeup)
+            p = multiprocessing.Process(
+                target=worker_loop,
+                args=(
+                    self.config,
+                    self.limits,
+                    self.stop_event,
+                    self.idle_wait,
+                    wakeup,
+                ),
+                name="nephos-worker-{}".format(i),
+                daemon=True,
+            )
+            p.start()
+            self.processes.append(p)
+        logger.debug("Started {} post-processing workers".format(self.size))
+
+    def notify(self):
+        """
+        Wake up idle workers because new downloads have been queued.
+        """
+        for wakeup in self.wakeups:
+            wakeup.set()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.notify()
+        for p in self.processes:
+            p.join(timeout)
+        self.processes = []
+        self.wakeups = []
+        logger.debug("Post-processing workers stopped")
+
+
+def _forward_wakeups(wakeup, stop_event, idle_wait, put):
+    while not stop_event.is_set():
+        if wakeup.wait(idle_wait):
+            wakeup.clear()
+            put(None)
+
+
+def worker_loop(config, limits, stop_event, idle_wait, wakeup=None):
+    """
+    Body of a single worker process. Runs until `stop_event` is set.
+
+    Downloads are claimed and fed into a PostProcessingPipeline for as long as it
+    accepts them. Finished downloads are acked (or released on failure) here. The
+    database session is only used from this thread; the pipeline threads get plain
+    copies of the rows they need, see PostProcessingPipeline.submit. While idle, the
+    worker waits for either a download to finish or for `wakeup` to be set.
+    """
+    db = DBStorage(config)
+    name = "{}-{}".format(multiprocessing.current_process().name, os.getpid())
+
+    finished = queue.Queue()
+    pipeline = PostProcessingPipeline(config, finished.put, limits)
+    pipeline.start()
+    in_flight = {}
+
+    if wakeup is not None:
+        # Setting `wakeup` puts a None on the queue of finished downloads, which
+        # is what the worker waits on when idle.
+        threading.Thread(
+            target=_forward_wakeups,
+            args=(wakeup, stop_event, idle_wait, finished.put),
+            daemon=True,
+        ).start()
+
+    def settle(recording):
+        if recording is None:
+            return
+        download = in_flight.pop(recording.download.id)
+        if recording.error is None:
+            db.ack_download(download)
+        else:
+            logger.error(
+                "Processing of {} failed: {}".format(download, recording.error)
+            )
+            db.release_download(download)
+
+    while not stop_event.is_set() or in_flight:
+        while True:
+            try:
+                settle(finished.get_nowait())
+            except queue.Empty:
+                break
+
+        download = None
+        if not stop_event.is_set():
+            download = db.claim_download(name)
+
+        if download is None:
+            try:
+                settle(finished.get(timeout=idle_wait))
+            except queue.Empty:
+                for d in in_flight.values():
+                    db.extend_lease(d)
+            continue
+
+        logger.debug("Processing {}".format(download))
+        in_flight[download.id] = download
+        pipeline.submit(db, download)
+
+    pipeline.stop()
+    db.close()
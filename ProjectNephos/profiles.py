@@ -0,0 +1,113 @@
+"""
+Transcode profiles, as used by jobs through `convert_to`.
+
+A profile is a section named "profile:<name>" in the config, for example
+
+    [profile:h264]
+    extension = mp4
+    video_codec = libx264
+    preset = veryfast
+    crf = 23
+    threads = 2
+    audio_codec = aac
+    audio_bitrate = 128k
+
+Other options are video_bitrate and scale, the height of the output in pixels. All
+options but extension are optional and left to ffmpeg if not given.
+
+A profile can instead list the names of other profiles as `renditions`, in which
+case all of them are produced from a single decode of the input. Their files are
+named <recording>.<rendition>.<extension>.
+
+A `convert_to` that isn't the name of a profile is taken as the extension to
+convert to, with ffmpeg's defaults for everything else.
+"""
+from collections import namedtuple
+from configparser import NoOptionError, NoSectionError
+
+FIELDS = [
+    "name",
+    "extension",
+    "video_codec",
+    "preset",
+    "crf",
+    "video_bitrate",
+    "scale",
+    "threads",
+    "audio_codec",
+    "audio_bitrate",
+]
+
+
+class TranscodeProfile(namedtuple("TranscodeProfile", FIELDS)):
+    def output_args(self):
+        """
+        Returns:
+            The ffmpeg options for an output encoded with this profile.
+        """
+        args = []
+        options = [
+            ("-c:v", self.video_codec),
+            ("-preset", self.preset),
+            ("-crf", self.crf),
+            ("-b:v", self.video_bitrate),
+            ("-vf", "scale=-2:{}".format(self.scale) if self.scale else None),
+            ("-threads", self.threads),
+            ("-c:a", self.audio_codec),
+            ("-b:a", self.audio_bitrate),
+        ]
+        for option, value in options:
+            if value:
+                args += [option, str(value)]
+        return args
+
+
+def _option(config, section, key):
+    try:
+        return config[section, key] or None
+    except (NoSectionError, NoOptionError, KeyError):
+        return None
+
+
+def get_profiles(config, name):
+    """
+    Takes:
+        Config object.
+        Name of a profile, i.e. the `convert_to` of a job.
+    Returns:
+        List of TranscodeProfiles to encode to in one pass, or None if there is no
+        profile by that name.
+    Raises:
+        ValueError if the profile is incomplete.
+    """
+    section = "profile:" + name
+    renditions = _option(config, section, "renditions")
+    if renditions is not None:
+        profiles = []
+        for rendition in renditions.split():
+            found = get_profiles(config, rendition)
+            if found is None or len(found) > 1:
+                raise ValueError(
+                    "Rendition {} of {} is not a single profile".format(rendition, name)
+                )
+            profiles.extend(found)
+        return profiles
+
+    values = {x: _option(config, section, x) for x in FIELDS[1:]}
+    if not any(values.values()):
+        return None
+    if values["extension"] is None:
+        raise ValueError("Profile {} has no extension".format(name))
+    return [TranscodeProfile(name=name, **values)]
+
+
+def input_args(profiles):
+    """
+    Returns:
+        The ffmpeg options for the input, when encoding to `profiles` at once.
+    """
+    threads = [int(x.threads) for x in profiles if x.threads]
+    if not threads:
+        return []
+    # The decoder feeds all encoders, so it gets as many threads as the largest.
+    return ["-threads", str(max(threads))]
@@ -0,0 +1,157 @@
+"""
+Runs external programs like ffmpeg, ccextractor and multicat.
+
+Their output is streamed line by line to a logger as it is printed instead of being
+collected in memory, and only the last few lines are kept around for when the program
+fails. ffmpeg progress reports (see FFMPEG_PROGRESS) are parsed and handed to a
+callback instead of being logged.
+"""
+import collections
+import re
+import subprocess
+import threading
+import time
+
+from ProjectNephos.exceptions import ProcessFailed
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Lines of output kept for error messages.
+TAIL_LINES = 50
+# Seconds a program gets to exit after being asked to before it is killed.
+KILL_GRACE = 10
+# Seconds between checks for the timeout and cancellation.
+POLL_INTERVAL = 0.5
+
+# Add these to an ffmpeg command to get machine readable progress on stdout.
+FFMPEG_PROGRESS = ["-progress", "pipe:1", "-nostats"]
+_PROGRESS_LINE = re.compile(r"^([a-z0-9_]+)=(.*)$")
+
+
+def parse_ffmpeg_progress(values):
+    """
+    Takes:
+        Dictionary of the key=value pairs of one ffmpeg progress report.
+    Returns:
+        Dictionary with frame, fps, total_size (bytes), out_time (seconds of output
+        written), speed (relative to realtime) and done. Values ffmpeg didn't know
+        yet are None.
+    """
+
+    def number(key, cast, suffix=""):
+        value = values.get(key, "").strip()
+        if value.endswith(suffix):
+            value = value[: len(value) - len(suffix)]
+        try:
+            return cast(value)
+        except ValueError:
+            return None
+
+    # Despite the name, out_time_ms is in microseconds as well.
+    out_time = number("out_time_us", int)
+    if out_time is None:
+        out_time = number("out_time_ms", int)
+
+    return {
+        "frame": number("frame", int),
+        "fps": number("fps", float),
+        "total_size": number("total_size", int),
+        "out_time": out_time / 1000000 if out_time is not None else None,
+        "speed": number("speed", float, "x"),
+        "done": values.get("progress") == "end",
+    }
+
+
+def _stop(process):
+    process.terminate()
+    try:
+        process.wait(KILL_GRACE)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def _watch(process, timeout, cancel, stopped):
+    deadline = None if not timeout else time.monotonic() + timeout
+    while process.poll() is None:
+        if cancel is not None and cancel.is_set():
+            stopped.append("cancelled")
+        elif deadline is not None and time.monotonic() > deadline:
+            stopped.append("timed out after {}s".format(timeout))
+        else:
+            time.sleep(POLL_INTERVAL)
+            continue
+        _stop(process)
+        return
+
+
+def run_process(
+    command, log=None, tail=TAIL_LINES, timeout=None, cancel=None, on_progress=None
+):
+    """
+    Run a program and wait for it to finish.
+
+    Takes:
+        The command, as a list.
+        (optional) logger to stream the output to, at debug level.
+        (optional) number of lines of output to keep.
+        (optional) seconds after which the program is stopped. None or 0 waits
+            forever.
+        (optional) threading.Event that stops the program when set.
+        (optional) function called with every ffmpeg progress report, see
+            parse_ffmpeg_progress. Only for ffmpeg commands with FFMPEG_PROGRESS.
+    Returns:
+        The last `tail` lines of output, as a string.
+    Raises:
+        FileNotFoundError if the program doesn't exist.
+        ProcessFailed if it exits with an error, times out or is cancelled.
+    """
+    log = log or logger
+    lines = collections.deque(maxlen=tail)
+    progress = {}
+    stopped = []
+
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    watcher = None
+    if timeout or cancel is not None:
+        watcher = threading.Thread(
+            target=_watch, args=(process, timeout, cancel, stopped), daemon=True
+        )
+        watcher.start()
+
+    with process.stdout:
+        for raw in process.stdout:
+            # Progress bars are redrawn with carriage returns.
+            for line in raw.decode("utf-8", errors="replace").split("\r"):
+                line = line.rstrip()
+                if not line:
+                    continue
+
+                match = _PROGRESS_LINE.match(line) if on_progress else None
+                if match is not None:
+                    progress[match.group(1)] = match.group(2)
+                    if match.group(1) == "progress":
+                        on_progress(parse_ffmpeg_progress(progress))
+                        progress = {}
+                    continue
+
+                lines.append(line)
+                log.debug(line)
+
+    returncode = process.wait()
+    if watcher is not None:
+        watcher.join()
+
+    output = "\n".join(lines)
+    if stopped:
+        raise ProcessFailed(
+            "{} {}".format(command[0], stopped[0]), returncode, output
+        )
+    if returncode != 0:
+        raise ProcessFailed(
+            "{} exited with {}".format(command[0], returncode), returncode, output
+        )
+    return output
@@ -1,4 +1,7 @@
-from ProjectNephos.backends.DataBase import DBStorage
+from ProjectNephos.backends.DataBase import DBStorage, Job, Tag, _engines
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Query
 
 from mock import MagicMock, patch, sentinel
 import pytest
@@ -6,11 +9,22 @@ import pytest
 MODULE_NAME = "ProjectNephos.backends.DataBase"
 
 
+def make_config(location, wal=True, single_writer=False):
+    return {
+        ("recording", "db_location"): location,
+        ("recording", "db_wal"): wal,
+        ("recording", "db_busy_timeout"): "1",
+        ("recording", "db_retries"): "2",
+        ("recording", "db_single_writer"): single_writer,
+    }
+
+
 @patch(MODULE_NAME + ".sessionmaker")
-@patch(MODULE_NAME + ".Base.metadata")
+@patch(MODULE_NAME + ".init_schema")
 @patch(MODULE_NAME + ".create_engine")
-def test_default_object(create_engine, metadata, sessionmaker):
-    config = {("recording", "db_location"): "random1"}
+def test_default_object(create_engine, init_schema, sessionmaker):
+    config = make_config("random1", wal=False)
+    _engines.clear()
     create_engine.return_value = sentinel.engine = MagicMock()
 
     Session = MagicMock()
@@ -22,14 +36,20 @@ def test_default_object(create_engine, metadata, sessionmaker):
     assert d.engine == sentinel.engine
     assert d.session == Session()
 
-    create_engine.assert_called_once_with("sqlite:///random1")
-    metadata.create_all.assert_called_once_with(sentinel.engine)
-    Session.configure.assert_called_once_with(bind=sentinel.engine)
+    create_engine.assert_called_once()
+    assert create_engine.call_args[0] == ("sqlite:///random1",)
+    init_schema.assert_called_once_with(sentinel.engine)
+    sessionmaker.assert_called_once_with(bind=sentinel.engine)
+
+    # Later opens in the same process reuse the engine and skip the schema setup.
+    DBStorage(config)
+    create_engine.assert_called_once()
+    init_schema.assert_called_once()
 
 
 @pytest.fixture
 @patch(MODULE_NAME + ".sessionmaker")
-@patch(MODULE_NAME + ".Base.metadata")
+@patch(MODULE_NAME + ".init_schema")
 @patch(MODULE_NAME + ".create_engine")
 def default_object(*_):
     """
@@ -57,3 +77,493 @@ def test_permissions(default_object):
 
     assert session.add.call_count == len(tags)
     session.commit.assert_called_once()
+
+
+@pytest.fixture
+def sqlite_db(tmpdir):
+    """
+    A DBStorage backed by an actual SQLite file with a job to attach downloads to.
+    """
+    config = make_config(str(tmpdir.join("nephos.sqlite")))
+    db = DBStorage(config)
+    db.add_channel("channel1", "1.2.3.4:1234")
+    db.add_job("job1", "channel1", "0 0 * * * *", 30, True, None, False, None)
+    return db, config
+
+
+def test_claim_download(sqlite_db):
+    db, config = sqlite_db
+    db.add_file("/path/one.ts", "job1")
+    db.add_file("/path/two.ts", "job1")
+
+    other = DBStorage(config)
+    first = db.claim_download("worker1")
+    second = other.claim_download("worker2")
+
+    assert first.filename == "/path/one.ts"
+    assert second.filename == "/path/two.ts"
+    assert first.claimed_by.startswith("worker1/")
+    assert first.attempts == 1
+    assert db.claim_download("worker1") is None
+
+
+def test_claim_expired_lease(sqlite_db):
+    db, _ = sqlite_db
+    db.add_file("/path/one.ts", "job1")
+
+    crashed = db.claim_download("worker1", lease_time=-1)
+    retried = db.claim_download("worker2")
+
+    assert retried.id == crashed.id
+    assert retried.attempts == 2
+
+
+def test_lost_lease(sqlite_db):
+    db, config = sqlite_db
+    db.add_file("/path/one.ts", "job1")
+    other = DBStorage(config)
+
+    late = db.claim_download("worker1", lease_time=-1)
+    current = other.claim_download("worker2")
+    assert current.id == late.id
+
+    # worker1 finishes after its lease ran out. None of this may touch the row.
+    assert db.extend_lease(late) is False
+    assert db.release_download(late) is False
+    assert db.ack_download(late) is False
+
+    other.session.refresh(current)
+    assert current.status == "claimed"
+    assert current.claimed_by.startswith("worker2/")
+    assert other.extend_lease(current) is True
+    assert other.ack_download(current) is True
+    assert db.claim_download("worker1") is None
+
+
+def test_claim_expired_last_attempt(sqlite_db):
+    db, _ = sqlite_db
+    db.add_file("/path/one.ts", "job1")
+
+    for _ in range(DBStorage.MAX_ATTEMPTS):
+        crashed = db.claim_download("worker1", lease_time=-1)
+    assert crashed.attempts == DBStorage.MAX_ATTEMPTS
+
+    assert db.claim_download("worker2") is None
+    assert [x.filename for x in db.get_failed_downloads()] == ["/path/one.ts"]
+
+
+def test_ack_release_download(sqlite_db):
+    db, _ = sqlite_db
+    db.add_file("/path/one.ts", "job1")
+    db.add_file("/path/two.ts", "job1")
+
+    d = db.claim_download("worker1")
+    db.ack_download(d)
+
+    for _ in range(DBStorage.MAX_ATTEMPTS):
+        d = db.claim_download("worker1")
+        assert d.filename == "/path/two.ts"
+        db.release_download(d)
+
+    assert db.claim_download("worker1") is None
+    assert [x.filename for x in db.get_failed_downloads()] == ["/path/two.ts"]
+
+
+def test_pop_download(sqlite_db):
+    db, _ = sqlite_db
+    db.add_file("/path/one.ts", "job1")
+
+    assert db.pop_download().filename == "/path/one.ts"
+    assert db.pop_download() is None
+
+
+@patch(MODULE_NAME + ".time.sleep")
+def test_pop_download_retried(sleep, sqlite_db):
+    db, _ = sqlite_db
+    db.add_file("/path/one.ts", "job1")
+    db.add_file("/path/two.ts", "job1")
+    locked = OperationalError("DELETE", {}, Exception("database is locked"))
+    real_delete, failures = Query.delete, [locked]
+
+    def delete(query, *args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return real_delete(query, *args, **kwargs)
+
+    with patch.object(Query, "delete", delete):
+        popped = db.pop_download()
+
+    # The retry pops the same download again, nothing is left claimed.
+    assert popped.filename == "/path/one.ts"
+    assert sleep.call_count == 1
+    assert db.claim_download("worker1").filename == "/path/two.ts"
+    assert db.claim_download("worker1") is None
+
+
+def test_add_missing_columns(tmpdir):
+    location = str(tmpdir.join("old.sqlite"))
+    engine = create_engine("sqlite:///" + location)
+    engine.execute(
+        "CREATE TABLE downloads (id INTEGER PRIMARY KEY, filename VARCHAR NOT NULL, "
+        "jobname VARCHAR)"
+    )
+    engine.execute("INSERT INTO downloads (filename) VALUES ('/path/old.ts')")
+
+    db = DBStorage(make_config(location))
+    d = db.claim_download("worker1")
+
+    assert d.filename == "/path/old.ts"
+    assert d.attempts == 1
+
+
+def test_upload_session(sqlite_db):
+    db, _ = sqlite_db
+
+    db.add_upload_session("/path/one.ts", 10, 1.5, "http://random1")
+    assert db.get_upload_session("/path/one.ts", 10, 1.5) == "http://random1"
+    # The file changed since the upload started.
+    assert db.get_upload_session("/path/one.ts", 11, 1.5) is None
+
+    db.delete_upload_session("/path/one.ts")
+    assert db.get_upload_session("/path/one.ts", 10, 1.5) is None
+
+
+def test_search_index(sqlite_db):
+    db, _ = sqlite_db
+    db.index_file("news1.ts", "channel1", "google", "id1", ["news"])
+    db.index_file("news1.ts", "channel1", "ftp", "/channel1/news1.ts")
+    db.index_file("sports.ts", "channel1", "google", "id2", ["sports", "live"])
+    db.index_tags("ftp", "/channel1/news1.ts", ["news"])
+
+    assert db.search_index(name_subs="news") == [
+        ("news1.ts", {"google": "id1", "ftp": "/channel1/news1.ts"})
+    ]
+    assert db.search_index(tag_subs=["live"]) == [("sports.ts", {"google": "id2"})]
+    assert len(db.search_index(tag_subs=["news", "live"])) == 2
+    assert db.search_index(tag_subs=["news", "live"], do_and=True) == []
+
+    db.unindex_file("google", "id2")
+    assert db.search_index(tag_subs=["live"]) == []
+
+
+def test_replace_index(sqlite_db):
+    db, _ = sqlite_db
+    db.index_file("old.ts", None, "google", "id1")
+    db.index_file("old.ts", None, "ftp", "/old.ts")
+
+    assert db.get_indexed_backends() == set()
+    db.replace_index("google", [("new.ts", "channel1", "id2", ["tag1"])])
+    db.replace_index("google", [("new.ts", "channel1", "id2", ["tag1"])])
+    assert db.get_indexed_backends() == {"google"}
+
+    assert db.search_index(name_subs=".ts") == [
+        ("new.ts", {"google": "id2"}),
+        ("old.ts", {"ftp": "/old.ts"}),
+    ]
+
+
+def test_folder_ids(sqlite_db):
+    db, _ = sqlite_db
+    db.add_folder_id("channel1", "id1")
+    db.add_folder_id("channel1/2018", "id2")
+    db.add_folder_id("channel12", "id3")
+    db.add_folder_id("channel1", "id4")
+
+    assert db.get_folder_id("channel1") == "id4"
+    assert db.get_folder_id("channel2") is None
+
+    db.delete_folder_id("channel1")
+    assert db.get_folder_id("channel1") is None
+    assert db.get_folder_id("channel1/2018") is None
+    assert db.get_folder_id("channel12") == "id3"
+
+    db.add_folder_id("channel1", "id1")
+    db.add_folder_id("channel1/2018", "id2")
+    db.add_folder_id("channel1/2018/06", "id5")
+    db.add_folder_id("channel1/2017", "id6")
+    db.delete_folder_id("channel1/2018")
+    assert db.get_folder_id("channel1") is None
+    assert db.get_folder_id("channel1/2018/06") is None
+    assert db.get_folder_id("channel1/2017") == "id6"
+
+
+def test_unit_of_work(sqlite_db):
+    db, _ = sqlite_db
+
+    with db.unit_of_work():
+        db.add_channel("channel2", "1.2.3.4:5678")
+        db.add_channel("channel3", "1.2.3.4:5679")
+        other = DBStorage(db.config)
+        # Nothing is committed until the unit of work is done.
+        assert len(other.get_channels()) == 1
+    other.close()
+    assert len(other.get_channels()) == 3
+
+    with pytest.raises(ValueError):
+        with db.unit_of_work():
+            db.add_channel("channel4", "1.2.3.4:5680")
+            raise ValueError
+    assert len(db.get_channels()) == 3
+
+
+def test_wal(sqlite_db):
+    db, _ = sqlite_db
+    assert db.engine.execute("PRAGMA journal_mode").scalar() == "wal"
+
+
+@patch(MODULE_NAME + ".time.sleep")
+def test_retry_when_locked(sleep, sqlite_db):
+    db, _ = sqlite_db
+    locked = OperationalError("UPDATE", {}, Exception("database is locked"))
+    real_commit, failures = db._commit, [locked, locked]
+
+    def commit():
+        if failures:
+            raise failures.pop()
+        real_commit()
+
+    db._commit = commit
+    db.add_channel("channel2", "1.2.3.4:5678")
+
+    assert sleep.call_count == 2
+    other = DBStorage(db.config)
+    assert [x.name for x in other.get_channels()] == ["channel1", "channel2"]
+
+
+@patch(MODULE_NAME + ".time.sleep")
+def test_retry_gives_up(sleep, sqlite_db):
+    db, _ = sqlite_db
+    locked = OperationalError("UPDATE", {}, Exception("database is locked"))
+    db._commit = MagicMock(side_effect=locked)
+
+    with pytest.raises(OperationalError):
+        db.add_channel("channel2", "1.2.3.4:5678")
+    assert sleep.call_count == 2
+
+
+def test_single_writer(tmpdir):
+    db = DBStorage(make_config(str(tmpdir.join("nephos.sqlite")), single_writer=True))
+    db.add_channel("channel1", "1.2.3.4:1234")
+    db.add_job("job1", "channel1", "0 0 * * * *", 30, True, None, False, None)
+    db.add_file("/path/one.ts", "job1")
+
+    assert db.writer_lock is not None
+    # pop_download takes the lock and then calls claim_download, which takes it again.
+    assert db.pop_download().filename == "/path/one.ts"
+    assert db.writer_lock._depth == 0
+
+
+def test_schedule_tags(sqlite_db):
+    db, _ = sqlite_db
+    db.add_channel("channel2", "1.2.3.4:5678")
+    db.add_schedule("prog1", "channel1", "0 20 * * * *", 30, ["news", "english"])
+    db.add_schedule("prog2", "channel2", "0 18 * * * *", 30, ["newsroom"])
+    db.add_schedule("prog3", "channel2", "0 19 * * * *", 30, ["news"])
+
+    assert [x.program for x in db.get_schedule_items(tags=["news"])] == [
+        "prog3",
+        "prog1",
+    ]
+    assert [x.program for x in db.get_schedule_items("channel2", ["news"])] == [
+        "prog3"
+    ]
+    assert db.session.query(Tag).count() == 3
+
+
+def test_job_tags(sqlite_db):
+    db, _ = sqlite_db
+    db.add_job("job2", "channel1", "0 0 * * * *", 30, True, None, False, ["a", "b"])
+    db.add_job("job3", "channel1", "0 0 * * * *", 30, True, None, False, ["b"])
+    db.add_permissions(["b", "c"], "random_email", "reader")
+
+    assert [x.name for x in db.get_jobs_by_tags(["a"])] == ["job2"]
+    assert [x.name for x in db.get_jobs_by_tags(["b"])] == ["job2", "job3"]
+    assert db.get_permissions_for_tags(["a", "b"]) == {("random_email", "reader")}
+    assert db.get_permissions_for_tags([]) == set()
+
+
+def test_migrate_tags(tmpdir):
+    location = str(tmpdir.join("old.sqlite"))
+    engine = create_engine("sqlite:///" + location)
+    engine.execute(
+        "CREATE TABLE schedule (id INTEGER PRIMARY KEY, channel VARCHAR, "
+        "program VARCHAR NOT NULL, start VARCHAR(16), duration INTEGER, tags VARCHAR)"
+    )
+    engine.execute(
+        "INSERT INTO schedule (program, tags) VALUES ('prog1', 'news,sports'), "
+        "('prog2', 'sports')"
+    )
+
+    db = DBStorage(make_config(location))
+
+    assert [x.program for x in db.get_schedule_items(tags=["sports"])] == [
+        "prog1",
+        "prog2",
+    ]
+    indexes = [x[1] for x in db.engine.execute("PRAGMA index_list(schedule)")]
+    assert "ix_schedule_start" in indexes
+
+
+def test_import_schedule(sqlite_db):
+    db, _ = sqlite_db
+
+    def item(program, start, duration, tags):
+        return {
+            "channel": "channel1",
+            "program": program,
+            "start": start,
+            "duration": duration,
+            "tags": tags,
+        }
+
+    first = [
+        item("prog1", "0 20 * * * *", 30, ["news"]),
+        item("prog2", "0 21 * * * *", 30, []),
+    ]
+    assert db.import_schedule(first) == (2, 0)
+    second = [
+        item("prog1", "0 20 * * * *", 60, ["sports", "sports"]),
+        item("prog3", "0 22 * * * *", 30, ["news"]),
+    ]
+    assert db.import_schedule(second) == (1, 1)
+
+    items = db.get_schedule_items()
+    assert [(x.program, x.duration) for x in items] == [
+        ("prog1", 60),
+        ("prog2", 30),
+        ("prog3", 30),
+    ]
+    assert [x.program for x in db.get_schedule_items(tags=["news"])] == ["prog3"]
+    assert [x.program for x in db.get_schedule_items(tags=["sports"])] == ["prog1"]
+
+
+def test_import_schedule_chunked(sqlite_db):
+    db, _ = sqlite_db
+    db.LOOKUP_SIZE = 4
+    items = [
+        {
+            "channel": "channel1",
+            "program": "prog{}".format(i),
+            "start": "0 {} * * * *".format(i),
+            "duration": 30,
+            "tags": ["news"],
+        }
+        for i in range(10)
+    ]
+
+    assert db.import_schedule(items) == (10, 0)
+    assert db.import_schedule(items) == (0, 10)
+    assert len(db.get_schedule_items(tags=["news"])) == 10
+
+
+def test_add_jobs(sqlite_db):
+    db, _ = sqlite_db
+
+    def job(name, start, tags):
+        return {
+            "name": name,
+            "channel": "channel1",
+            "start": start,
+            "duration": 30,
+            "upload": True,
+            "convert_to": None,
+            "subtitles": False,
+            "tags": tags,
+        }
+
+    # job1 already records "0 0 * * * *".
+    jobs = [
+        job("prog-1", "0 0 * * * *", None),
+        job("prog-2", "0 20 1 6 * 2018", ["a"]),
+        job("prog-3", "0 20 2 6 * 2018", ["a", "b"]),
+        job("other-4", "0 20 2 6 * 2018", ["c"]),
+        job("prog-2", "0 21 1 6 * 2018", ["c"]),
+    ]
+    result = (["prog-2", "prog-3"], ["prog-1"], ["other-4", "prog-2"])
+
+    assert db.add_jobs(jobs, dry_run=True) == result
+    assert db.session.query(Job).count() == 1
+
+    assert db.add_jobs(jobs) == result
+    assert [x.name for x in db.get_jobs_by_tags(["a"])] == ["prog-2", "prog-3"]
+    assert [x.name for x in db.get_jobs_by_tags(["b"])] == ["prog-3"]
+    assert db.get_job("prog-3").tags == "a,b"
+    assert db.add_jobs(jobs) == ([], [x["name"] for x in jobs], [])
+
+
+def test_job_versions(sqlite_db):
+    db, _ = sqlite_db
+    versions = db.get_job_versions()
+    job = db.get_job("job1")
+    assert versions == {job.id: job.updated_at}
+    old = job.updated_at
+
+    db.add_jobs(
+        [
+            {
+                "name": "job2",
+                "channel": "channel1",
+                "start": "0 12 * * * *",
+                "duration": 30,
+                "upload": True,
+                "convert_to": None,
+                "subtitles": False,
+                "tags": None,
+            }
+        ]
+    )
+    job.duration = 60
+    db.session.commit()
+
+    versions = db.get_job_versions()
+    assert len(versions) == 2
+    assert versions[job.id] >= old
+    assert versions[job.id] == job.updated_at
+    assert [x.name for x in db.get_jobs_by_ids(versions)] == ["job1", "job2"]
+
+
+def test_channel_checks(sqlite_db):
+    db, _ = sqlite_db
+    db.add_channel("channel2", "1.2.3.4:5678")
+    check = {"packets": 500, "errors": 0, "message": None}
+
+    db.add_channel_checks(
+        [
+            dict(check, channel="channel1", is_up=False),
+            dict(check, channel="channel2", is_up=True),
+        ]
+    )
+    db.add_channel_checks([dict(check, channel="channel1", is_up=True)])
+
+    assert db.get_channels("channel1").is_up
+    assert [x.is_up for x in db.get_channel_checks("channel1")] == [True, False]
+    assert len(db.get_channel_checks("channel1", limit=1)) == 1
+
+    with patch.object(DBStorage, "CHECK_HISTORY", -1):
+        db.add_channel_checks([dict(check, channel="channel2", is_up=False)])
+    assert db.get_channel_checks("channel1") == []
+    assert not db.get_channels("channel2").is_up
+
+
+def test_claim_segmented(sqlite_db):
+    db, _ = sqlite_db
+    db.add_file("/path/one.part000.ts", "job1", parent="/path/one.ts")
+    db.add_file("/path/one.part001.ts", "job1", parent="/path/one.ts")
+    db.add_file("/path/one.ts", "job1", segments=2)
+
+    first = db.claim_download("worker1")
+    second = db.claim_download("worker1")
+    assert [first.filename, second.filename] == [
+        "/path/one.part000.ts",
+        "/path/one.part001.ts",
+    ]
+    # The whole recording waits for its segments.
+    assert db.claim_download("worker1") is None
+
+    db.ack_download(first)
+    assert db.claim_download("worker1") is None
+
+    # Segments that failed for good don't hold it up.
+    second.attempts = DBStorage.MAX_ATTEMPTS
+    db.release_download(second)
+    assert db.claim_download("worker1").segments == 2
@@ -1,20 +1,36 @@
-from ProjectNephos.backends.FTP import FTPStorage
+from ProjectNephos.backends.FTP import FTPStorage, FTPConnectionPool
 
 from mock import MagicMock, patch, sentinel
+import ftplib
 import pytest
+import threading
 
-from ProjectNephos.exceptions import FileNotFound
+from ProjectNephos.exceptions import AuthFailure, FileNotFound
 
 MODULE_NAME = "ProjectNephos.backends.FTP"
 
 
+def make_config(pool_min="1", pool_max="2", keepalive="0", optimistic=False):
+    return {
+        ("ftp", "host"): "random_host",
+        ("ftp", "port"): "21",
+        ("ftp", "username"): "random_user",
+        ("ftp", "password"): "random_pass",
+        ("ftp", "pool_min"): pool_min,
+        ("ftp", "pool_max"): pool_max,
+        ("ftp", "idle_timeout"): "300",
+        ("ftp", "keepalive"): keepalive,
+        ("others", "optimistic"): optimistic,
+        ("others", "exists_ttl"): "30",
+    }
+
+
 @pytest.fixture
 @patch(MODULE_NAME + ".ftplib.FTP")
-def default_object(*_):
-    config = MagicMock()
-    obj = FTPStorage(config)
+def default_object(FTP):
+    obj = FTPStorage(make_config())
 
-    return obj, obj.ftp
+    return obj, FTP.return_value
 
 
 @patch(MODULE_NAME + ".isfile")
@@ -30,3 +46,197 @@ def test_write_nonexistant(isfile, default_object):
 def test_permissions(default_object):
     f, _ = default_object
     assert f.add_permission_user("asdf") is None
+
+
+def test_exists_no_cwd(default_object):
+    f, ftp = default_object
+    ftp.mlsd.return_value = [("random2", {"type": "file"})]
+
+    assert f.is_exists("/random1/random2")
+    assert not f.is_exists("/random1/random3")
+
+    ftp.mlsd.assert_called_with("/random1")
+    ftp.cwd.assert_not_called()
+
+
+def test_exists_cached(default_object):
+    f, ftp = default_object
+    ftp.mlsd.return_value = [("random1", {"type": "file"})]
+
+    assert f.is_exists("/folder/random1")
+    assert f.is_exists("/folder/random1")
+    ftp.mlsd.assert_called_once_with("/folder")
+
+
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_optimistic_read_missing(FTP):
+    f = FTPStorage(make_config(optimistic=True))
+    ftp = FTP.return_value
+    ftp.retrbinary.side_effect = ftplib.error_perm("550 No such file or directory.")
+
+    with pytest.raises(FileNotFound):
+        f.read("/folder/random1")
+    ftp.mlsd.assert_not_called()
+    assert not f.is_exists("/folder/random1")
+
+
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_optimistic_delete(FTP):
+    f = FTPStorage(make_config(optimistic=True))
+    ftp = FTP.return_value
+
+    f.delete("/folder/random1")
+    ftp.delete.side_effect = ftplib.error_perm("550 No such file or directory.")
+    assert f.delete("/folder/random2") is None
+
+    assert ftp.delete.call_count == 2
+    ftp.mlsd.assert_not_called()
+
+
+def test_traverse_tree(default_object):
+    f, ftp = default_object
+    tree = {
+        "/": [
+            (".", {"type": "cdir"}),
+            ("random1", {"type": "dir"}),
+            ("random2", {"type": "file"}),
+        ],
+        "/random1": [("random3", {"type": "file"})],
+    }
+    ftp.mlsd.side_effect = lambda path: tree[path]
+
+    found = [(x[0], x[1]["folder"]) for x in f._traverse_tree(ftp, "/")]
+
+    assert found == [("random3", "/random1"), ("random2", "")]
+
+
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_pool_bad_login(FTP):
+    FTP.return_value.login.side_effect = ftplib.error_perm
+
+    with pytest.raises(AuthFailure):
+        FTPConnectionPool(make_config())
+
+
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_pool_reuses_connections(FTP):
+    FTP.side_effect = lambda: MagicMock()
+    pool = FTPConnectionPool(make_config(pool_min="1", pool_max="2"))
+
+    with pool.connection() as first:
+        with pool.connection() as second:
+            assert first != second
+    with pool.connection() as third:
+        assert third in (first, second)
+
+    assert FTP.call_count == 2
+
+
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_pool_bounded(FTP):
+    pool = FTPConnectionPool(make_config(pool_min="0", pool_max="1"))
+    borrowed = threading.Event()
+
+    def borrow():
+        with pool.connection():
+            borrowed.set()
+
+    with pool.connection():
+        t = threading.Thread(target=borrow)
+        t.start()
+        assert not borrowed.wait(0.2)
+    t.join()
+
+    assert borrowed.is_set()
+    assert FTP.call_count == 1
+
+
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_pool_discards_broken(FTP):
+    FTP.side_effect = lambda: MagicMock()
+    pool = FTPConnectionPool(make_config(pool_min="1", pool_max="1"))
+
+    with pytest.raises(EOFError):
+        with pool.connection() as broken:
+            raise EOFError
+
+    broken.quit.assert_called_once()
+    with pool.connection() as replacement:
+        assert replacement != broken
+        replacement.login.assert_called_once_with("random_user", "random_pass")
+
+
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_pool_keeps_on_temp_error(FTP):
+    FTP.side_effect = lambda: MagicMock()
+    pool = FTPConnectionPool(make_config(pool_min="1", pool_max="1"))
+
+    with pytest.raises(ftplib.error_temp):
+        with pool.connection() as first:
+            raise ftplib.error_temp("450 File busy")
+
+    first.quit.assert_not_called()
+    with pool.connection() as second:
+        assert second is first
+    assert FTP.call_count == 1
+
+
+@patch(MODULE_NAME + ".time.time")
+@patch(MODULE_NAME + ".ftplib.FTP")
+def test_pool_prune(FTP, time):
+    FTP.side_effect = lambda: MagicMock()
+    time.return_value = 0
+    pool = FTPConnectionPool(make_config(pool_min="1", pool_max="2"))
+
+    with pool.connection():
+        with pool.connection():
+            pass
+
+    time.return_value = 1000
+    pool.prune()
+
+    # One is closed for being idle too long, the other is kept alive.
+    assert len(pool._idle) == 1
+    kept = pool._idle[0][0]
+    kept.voidcmd.assert_called_once_with("NOOP")
+    assert pool._size == 1
+
+
+def fake_transfer(ftp, data):
+    def transfercmd(cmd, rest=None):
+        conn = MagicMock()
+        conn.__enter__.return_value = conn
+        remaining = [data[rest or 0 :]]
+
+        def recv(size):
+            chunk, remaining[0] = remaining[0][:size], remaining[0][size:]
+            return chunk
+
+        conn.recv.side_effect = recv
+        return conn
+
+    ftp.transfercmd.side_effect = transfercmd
+
+
+def test_iter_read(default_object):
+    f, ftp = default_object
+    f.BLOCK_SIZE = 4
+    ftp.mlsd.return_value = [("random1", {"type": "file"})]
+    fake_transfer(ftp, b"0123456789")
+
+    assert list(f.iter_read("/folder/random1")) == [b"0123", b"4567", b"89"]
+    ftp.transfercmd.assert_called_once_with("RETR /folder/random1", rest=None)
+    ftp.voidresp.assert_called_once()
+
+
+def test_read_to_range(default_object, tmpdir):
+    f, ftp = default_object
+    f.BLOCK_SIZE = 4
+    ftp.mlsd.return_value = [("random1", {"type": "file"})]
+    fake_transfer(ftp, b"0123456789")
+    ftp.voidresp.side_effect = ftplib.error_temp("426 Transfer aborted")
+    dest = tmpdir.join("random2")
+
+    assert f.read_to("/folder/random1", str(dest), start=3, end=8) == 6
+    assert dest.read_binary() == b"345678"
+    ftp.transfercmd.assert_called_once_with("RETR /folder/random1", rest=3)
@@ -1,5 +1,10 @@
+import io
+
+from googleapiclient import discovery
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpMockSequence
 
+from ProjectNephos.backends.DataBase import DBStorage
 from ProjectNephos.backends.GDrive import DriveStorage
 from ProjectNephos.exceptions import AuthFailure, FileNotFound
 from mock import MagicMock, patch
@@ -27,6 +32,12 @@ def test_default_object_creation(getc, Http, build):
     config = {
         ("google", "auth_token_location"): "random4",
         ("google", "client_secret_location"): "random5",
+        ("google", "resumable"): True,
+        ("google", "chunk_size"): "8",
+        ("google", "search_page_size"): "5000",
+        ("google", "search_limit"): "0",
+        ("others", "optimistic"): True,
+        ("others", "exists_ttl"): "30",
     }
     g = DriveStorage(config)
 
@@ -38,6 +49,11 @@ def test_default_object_creation(getc, Http, build):
 
     assert g.file_service == "random2"
     assert g.perm_service == "random3"
+    assert g.resumable
+    assert g.chunk_size == 8 * 1024 * 1024
+    assert g.page_size == 1000
+    assert g.search_limit is None
+    assert g.optimistic
 
 
 @patch(MODULE_NAME + ".discovery.build")
@@ -105,6 +121,8 @@ def default_object(build, *_):
     service.permissions.return_value = perm_service
     build.return_value = service
     g = DriveStorage(MagicMock())
+    g._db = MagicMock()
+    g.db.get_folder_id.return_value = None
     return g, file_service, perm_service
 
 
@@ -120,7 +138,7 @@ def test_folder_preexisiting(default_object):
 
     assert folder_id == "random1"
     query = "name = 'random2' and mimeType = 'application/vnd.google-apps.folder'"
-    file_service.list.assert_called_once_with(q=query, pageSize=5)
+    file_service.list.assert_called_once_with(q=query, pageSize=5, fields="files(id)")
     l.execute.assert_called_once()
     file_service.create.assert_not_called()
 
@@ -137,7 +155,7 @@ def test_folder_preexisting_multiple(default_object):
 
     assert folder_id == "random1"
     query = "name = 'random2' and mimeType = 'application/vnd.google-apps.folder'"
-    file_service.list.assert_called_once_with(q=query, pageSize=5)
+    file_service.list.assert_called_once_with(q=query, pageSize=5, fields="files(id)")
     l.execute.assert_called_once()
     file_service.create.assert_not_called()
 
@@ -159,10 +177,90 @@ def test_folder_new(default_object):
 
     assert folder_id == "something"
     query = "name = 'random2' and mimeType = 'application/vnd.google-apps.folder'"
-    file_service.list.assert_called_once_with(q=query, pageSize=5)
+    file_service.list.assert_called_once_with(q=query, pageSize=5, fields="files(id)")
     l.execute.assert_called_once()
     file_service.create.assert_called()
     c.execute.assert_called()
+    g.db.add_folder_id.assert_called_once_with("random2", "something")
+
+
+def test_folder_cached(default_object):
+    g, file_service, _ = default_object
+    g.db.get_folder_id.return_value = "random1"
+
+    assert g.create_folder("random2/2018/06") == "random1"
+    g.db.get_folder_id.assert_called_once_with("random2/2018/06")
+    file_service.list.assert_not_called()
+
+
+def test_folder_nested(default_object):
+    g, file_service, _ = default_object
+    g.db.get_folder_id.side_effect = lambda path: {"random2": "id1"}.get(path)
+    file_service.list.return_value.execute.return_value = {}
+    file_service.create.return_value.execute.side_effect = [{"id": "id2"}, {"id": "id3"}]
+
+    assert g.create_folder("/random2/2018/06/") == "id3"
+
+    assert file_service.list.call_count == 2
+    _, kwargs = file_service.list.call_args
+    assert kwargs["q"].endswith(" and 'id2' in parents")
+    _, kwargs = file_service.create.call_args
+    assert kwargs["body"]["parents"] == ["id2"]
+    g.db.add_folder_id.assert_any_call("random2/2018", "id2")
+    g.db.add_folder_id.assert_any_call("random2/2018/06", "id3")
+
+
+def test_write_stale_folder(default_object, tmpdir):
+    g, file_service, _ = default_object
+    g.resumable = False
+    upload = tmpdir.join("random1.ts")
+    upload.write(b"0123456789")
+
+    folders = {"random2": "stale_id"}
+    g.db.get_folder_id.side_effect = folders.get
+    g.db.delete_folder_id.side_effect = folders.pop
+    file_service.list.return_value.execute.return_value = {"files": [{"id": "new_id"}]}
+    file_service.create.return_value.execute.side_effect = [not_found(), {"id": "id1"}]
+
+    assert g.write(str(upload), "random2") == "id1"
+
+    g.db.delete_folder_id.assert_called_once_with("random2")
+    _, kwargs = file_service.create.call_args
+    assert kwargs["body"]["parents"] == ["new_id"]
+
+
+def test_write_stale_ancestor(default_object, tmpdir):
+    g, file_service, _ = default_object
+    g.resumable = False
+    g._db = DBStorage(
+        {
+            ("recording", "db_location"): str(tmpdir.join("nephos.sqlite")),
+            ("recording", "db_wal"): True,
+            ("recording", "db_busy_timeout"): "1",
+            ("recording", "db_retries"): "2",
+            ("recording", "db_single_writer"): False,
+        }
+    )
+    upload = tmpdir.join("random1.ts")
+    upload.write(b"0123456789")
+
+    # random2 itself was deleted on Drive, along with everything in it.
+    g.db.add_folder_id("random2", "stale1")
+    g.db.add_folder_id("random2/2018", "stale2")
+    g.db.add_folder_id("random2/2018/06", "stale3")
+    file_service.list.return_value.execute.side_effect = [
+        {"files": [{"id": "new1"}]},
+        {"files": [{"id": "new2"}]},
+        {"files": [{"id": "new3"}]},
+    ]
+    file_service.create.return_value.execute.side_effect = [not_found(), {"id": "id1"}]
+
+    assert g.write(str(upload), "/random2//2018/06/") == "id1"
+
+    _, kwargs = file_service.create.call_args
+    assert kwargs["body"]["parents"] == ["new3"]
+    assert file_service.list.call_count == 3
+    assert g.db.get_folder_id("random2") == "new1"
 
 
 def test_exists_yes(default_object):
@@ -194,6 +292,44 @@ def test_write():
     pass
 
 
+def test_exists_cached(default_object):
+    g, file_service, _ = default_object
+    g.exists_cache.ttl = 30
+
+    assert g.is_exists("random1")
+    assert g.is_exists("random1")
+    file_service.get.assert_called_once_with(fileId="random1")
+
+
+def test_optimistic_read_missing(default_object):
+    g, file_service, _ = default_object
+    g.optimistic = True
+    file_service.get_media.return_value.execute.side_effect = not_found()
+
+    with pytest.raises(FileNotFound):
+        g.read("random1")
+    file_service.get.assert_not_called()
+    assert not g.is_exists("random1")
+
+
+def test_optimistic_delete_missing(default_object):
+    g, file_service, _ = default_object
+    g.optimistic = True
+    file_service.delete.return_value.execute.side_effect = not_found()
+
+    assert g.delete("random1") is None
+    file_service.get.assert_not_called()
+
+
+def test_optimistic_add_perms(default_object):
+    g, file_service, perm_service = default_object
+    g.optimistic = True
+    perm_service.create.return_value.execute.return_value = "random2"
+
+    assert g.add_permissions_user("random1", "email", "reader") == "random2"
+    file_service.get.assert_not_called()
+
+
 @patch(MODULE_NAME + ".isfile")
 def test_write_nonexistant(isfile, default_object):
     g, _, _ = default_object
@@ -222,18 +358,145 @@ def test_delete():
     pass
 
 
-def test_search():
-    pass
+def search_pages(file_service, *pages):
+    responses = []
+    for i, page in enumerate(pages):
+        resp = {"files": [{"name": n, "id": "id_" + n} for n in page]}
+        if i < len(pages) - 1:
+            resp["nextPageToken"] = "token{}".format(i)
+        responses.append(resp)
+    file_service.list.return_value.execute.side_effect = responses
 
 
-def test_search_no_result():
-    pass
+def test_search(default_object):
+    g, file_service, _ = default_object
+    g.page_size, g.search_limit = 2, None
+    search_pages(file_service, ["a", "b"], ["c", "d"], ["e"])
+
+    response = g.search(name_subs="random1", tag_subs=["random2"], do_and=True)
+
+    assert response == [(x, "id_" + x) for x in "abcde"]
+    assert file_service.list.call_count == 3
+    _, kwargs = file_service.list.call_args
+    assert kwargs["q"] == "name contains 'random1' and fullText contains 'random2'"
+    assert kwargs["pageToken"] == "token1"
+    assert kwargs["fields"] == "nextPageToken, files(id, name)"
+
+
+def test_search_limit(default_object):
+    g, file_service, _ = default_object
+    g.page_size, g.search_limit = 2, 3
+    search_pages(file_service, ["a", "b"], ["c"], ["e"])
+
+    response = g.search(tag_subs=["random1", "random2"])
+
+    assert response == [("a", "id_a"), ("b", "id_b"), ("c", "id_c")]
+    assert file_service.list.call_count == 2
+    _, kwargs = file_service.list.call_args
+    assert kwargs["pageSize"] == 1
+    assert kwargs["q"] == "fullText contains 'random1' or fullText contains 'random2'"
+
+
+def test_iter_search_lazy(default_object):
+    g, file_service, _ = default_object
+    g.page_size, g.search_limit = 2, None
+    search_pages(file_service, ["a", "b"], ["c"])
+
+    results = g.iter_search(name_subs="random1")
+    assert next(results) == ("a", "id_a")
+    assert file_service.list.call_count == 1
+
+
+def test_search_no_result(default_object):
+    g, file_service, _ = default_object
+    g.page_size, g.search_limit = 2, None
+    search_pages(file_service, [])
+
+    with pytest.raises(FileNotFound):
+        g.search(name_subs="random1")
 
 
 def test_add_perms():
     pass
 
 
+class FakeBatch(object):
+    """
+    Stands in for a BatchHttpRequest. Requests are MagicMocks with the response (or
+    the exception) they should produce in `result`.
+    """
+
+    batches = []
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+        FakeBatch.batches.append(self)
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            if isinstance(request.result, Exception):
+                self.callback(request_id, None, request.result)
+            else:
+                self.callback(request_id, request.result, None)
+
+
+@pytest.fixture
+def batch_object(default_object):
+    g, file_service, perm_service = default_object
+    g.service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback)
+    FakeBatch.batches = []
+    return g, file_service, perm_service
+
+
+def not_found():
+    resp = MagicMock()
+    resp.status = 404
+    return HttpError(resp, b"")
+
+
+def test_add_perms_bulk(batch_object):
+    g, _, perm_service = batch_object
+    g.BATCH_SIZE = 2
+
+    def create(fileId, body):
+        return MagicMock(result=not_found() if fileId == "id2" else "perm_" + fileId)
+
+    perm_service.create.side_effect = create
+
+    response = g.add_permissions_bulk(["id1", "id2", "id3"], "email", "reader")
+
+    assert len(FakeBatch.batches) == 2
+    assert response["id1"] == "perm_id1"
+    assert response["id3"] == "perm_id3"
+    assert isinstance(response["id2"], FileNotFound)
+    perm_service.create.assert_called_with(
+        fileId="id3", body={"type": "user", "role": "reader", "emailAddress": "email"}
+    )
+
+
+def test_tag_bulk(batch_object):
+    g, file_service, _ = batch_object
+
+    def get(fileId, fields):
+        return MagicMock(result=not_found() if fileId == "id2" else {"description": "a"})
+
+    file_service.get.side_effect = get
+    file_service.update.side_effect = lambda fileId, body: MagicMock(result=body)
+
+    response = g.tag_bulk(["id1", "id2"], ["tag1", "tag2"])
+
+    assert response["id1"] is None
+    assert isinstance(response["id2"], FileNotFound)
+    file_service.update.assert_called_once_with(
+        fileId="id1", body={"description": "a\ntag1 \ntag2"}
+    )
+    assert len(FakeBatch.batches) == 2
+
+
 @patch(MODULE_NAME + ".DriveStorage.is_exists")
 def test_add_perms_no_file(is_exists, default_object):
     g, _, _ = default_object
@@ -242,3 +505,140 @@ def test_add_perms_no_file(is_exists, default_object):
     with pytest.raises(FileNotFound):
         g.add_permissions_user("random1", "email", "role")
     is_exists.assert_called_with("random1")
+
+
+def http_files(responses):
+    """
+    An actual Drive files service whose requests are answered with `responses`, see
+    HttpMockSequence.
+    """
+    http = HttpMockSequence(responses)
+    try:
+        service = discovery.build("drive", "v3", http=http, static_discovery=True)
+    except TypeError:
+        pytest.skip("Needs a client library that ships discovery documents")
+    return service.files(), http
+
+
+@pytest.fixture
+def resumable_object(default_object, tmpdir):
+    g, _, _ = default_object
+    g.resumable = True
+    g.chunk_size = 4
+    g._db = MagicMock()
+
+    upload = tmpdir.join("random1.ts")
+    upload.write(b"0123456789")
+    return g, str(upload)
+
+
+def sent_ranges(http):
+    return [x[3].get("Content-Range") for x in http.request_sequence if x[1] == "PUT"]
+
+
+NEW_SESSION = ({"status": "200", "location": "http://upload/random2"}, "")
+DONE = ({"status": "200"}, '{"id": "random3"}')
+
+
+def uploaded(end):
+    return {"status": "308", "range": "bytes=0-{}".format(end)}, ""
+
+
+def test_write_resumable(resumable_object):
+    g, filename = resumable_object
+    g.db.get_upload_session.return_value = None
+    g.file_service, http = http_files([NEW_SESSION, uploaded(3), uploaded(7), DONE])
+
+    assert g.write(filename) == "random3"
+    assert sent_ranges(http) == ["bytes 0-3/10", "bytes 4-7/10", "bytes 8-9/10"]
+    g.db.add_upload_session.assert_called_once()
+    assert g.db.add_upload_session.call_args[0][3] == "http://upload/random2"
+    g.db.delete_upload_session.assert_called_once_with(filename)
+    assert g.last_upload_stats["bytes"] == 10
+
+
+def test_write_resume_session(resumable_object):
+    g, filename = resumable_object
+    g.db.get_upload_session.return_value = "http://upload/random2"
+    # The server has the first chunk.
+    g.file_service, http = http_files([uploaded(3), uploaded(7), DONE])
+
+    assert g.write(filename) == "random3"
+    assert http.request_sequence[0][0] == "http://upload/random2"
+    assert sent_ranges(http) == ["bytes */10", "bytes 4-7/10", "bytes 8-9/10"]
+    g.db.add_upload_session.assert_not_called()
+    assert g.last_upload_stats["bytes"] == 6
+
+
+def test_write_resume_complete(resumable_object):
+    g, filename = resumable_object
+    g.db.get_upload_session.return_value = "http://upload/random2"
+    # The upload was interrupted after the server got the last chunk.
+    g.file_service, http = http_files([DONE])
+
+    assert g.write(filename) == "random3"
+    assert sent_ranges(http) == ["bytes */10"]
+    g.db.delete_upload_session.assert_called_once_with(filename)
+    assert g.last_upload_stats["bytes"] == 0
+
+
+def test_write_resume_expired_session(resumable_object):
+    g, filename = resumable_object
+    g.db.get_upload_session.side_effect = ["http://upload/random1", None]
+    g.file_service, http = http_files(
+        [({"status": "404"}, "random4"), NEW_SESSION, uploaded(3), uploaded(7), DONE]
+    )
+
+    assert g.write(filename) == "random3"
+    assert g.db.get_upload_session.call_count == 2
+    assert sent_ranges(http)[1:] == ["bytes 0-3/10", "bytes 4-7/10", "bytes 8-9/10"]
+    assert g.last_upload_stats["bytes"] == 10
+
+
+def served(data, start, end):
+    headers = {
+        "status": "206",
+        "content-range": "bytes {}-{}/{}".format(start, end, len(data)),
+    }
+    return headers, data[start : end + 1]
+
+
+def test_iter_read(default_object):
+    g, _, _ = default_object
+    g.optimistic, g.chunk_size = True, 4
+    data = b"0123456789"
+
+    g.file_service, http = http_files(
+        [served(data, 0, 3), served(data, 4, 7), served(data, 8, 9)]
+    )
+    assert list(g.iter_read("random1")) == [b"0123", b"4567", b"89"]
+
+    g.file_service, http = http_files([served(data, 3, 6), served(data, 7, 8)])
+    assert list(g.iter_read("random1", start=3, end=8)) == [b"3456", b"78"]
+    assert [x[3]["range"] for x in http.request_sequence] == [
+        "bytes=3-6",
+        "bytes=7-8",
+    ]
+
+
+def test_iter_read_past_end(default_object):
+    g, _, _ = default_object
+    g.optimistic, g.chunk_size = True, 5
+    data = b"0123456789"
+    # The file is a multiple of the chunk size, so the read past its end is refused.
+    g.file_service, _ = http_files(
+        [served(data, 0, 4), served(data, 5, 9), ({"status": "416"}, "")]
+    )
+
+    assert list(g.iter_read("random1")) == [b"01234", b"56789"]
+
+
+def test_read_to(default_object):
+    g, _, _ = default_object
+    g.optimistic, g.chunk_size = True, 4
+    data = b"0123456789"
+    g.file_service, _ = http_files([served(data, 5, 8), served(data, 9, 9)])
+    dest = io.BytesIO()
+
+    assert g.read_to("random1", dest, start=5) == 5
+    assert dest.getvalue() == b"56789"
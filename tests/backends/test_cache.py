@@ -0,0 +1,33 @@
+from ProjectNephos.backends.cache import ExpiringCache
+
+from mock import patch
+
+MODULE_NAME = "ProjectNephos.backends.cache"
+
+
+@patch(MODULE_NAME + ".time.time")
+def test_expiry(time):
+    time.return_value = 100
+    cache = ExpiringCache("10")
+    cache.set("random1", False)
+
+    time.return_value = 109
+    assert cache.get("random1") is False
+
+    time.return_value = 111
+    assert cache.get("random1") is None
+
+
+def test_disabled():
+    cache = ExpiringCache("0")
+    cache.set("random1", True)
+
+    assert cache.get("random1", "random2") == "random2"
+
+
+def test_invalidate():
+    cache = ExpiringCache("10")
+    cache.set("random1", True)
+    cache.invalidate("random1")
+
+    assert cache.get("random1") is None
@@ -0,0 +1,122 @@
+from ProjectNephos.backends.registry import BackendRegistry
+
+from mock import MagicMock, patch, sentinel
+import pytest
+import threading
+
+MODULE_NAME = "ProjectNephos.backends.registry"
+
+
+@pytest.fixture
+def backends():
+    google = MagicMock()
+    google.THREAD_SAFE = False
+    ftp = MagicMock()
+    ftp.THREAD_SAFE = True
+    with patch.dict(MODULE_NAME + ".options", {"google": google, "ftp": ftp}):
+        yield google, ftp
+
+
+def test_client_reused(backends):
+    google, _ = backends
+    r = BackendRegistry()
+
+    first = r.get("google", sentinel.config)
+    second = r.get("google", sentinel.config)
+
+    assert first == second
+    google.assert_called_once_with(sentinel.config)
+
+
+def test_client_per_thread(backends):
+    google, ftp = backends
+    r = BackendRegistry()
+
+    def use():
+        r.get("google", sentinel.config)
+        r.get("ftp", sentinel.config)
+
+    use()
+    t = threading.Thread(target=use)
+    t.start()
+    t.join()
+
+    assert google.call_count == 2
+    assert ftp.call_count == 1
+
+
+@patch(MODULE_NAME + ".time.time")
+def test_unhealthy_client_replaced(time, backends):
+    google, _ = backends
+    google.side_effect = [MagicMock(), MagicMock()]
+    r = BackendRegistry()
+
+    time.return_value = 0
+    first = r.get("google", sentinel.config)
+
+    # Not checked while it's in regular use.
+    time.return_value = r.CHECK_INTERVAL
+    assert r.get("google", sentinel.config) == first
+    first.health_check.assert_not_called()
+
+    first.health_check.side_effect = EOFError
+    time.return_value = 3 * r.CHECK_INTERVAL
+    second = r.get("google", sentinel.config)
+
+    assert second != first
+    assert google.call_count == 2
+    first.close.assert_called_once()
+
+
+def test_dead_thread_evicted(backends):
+    google, _ = backends
+    r = BackendRegistry()
+
+    t = threading.Thread(target=r.get, args=("google", sentinel.config))
+    t.start()
+    t.join()
+    r.get("google", sentinel.config)
+
+    assert len(r._clients) == 1
+    google.return_value.close.assert_called_once()
+
+
+def test_concurrent_create(backends):
+    _, ftp = backends
+    created = [MagicMock(), MagicMock()]
+    clients = list(created)
+    barrier = threading.Barrier(2)
+
+    def connect(config):
+        # Both threads are creating a client at the same time.
+        barrier.wait(5)
+        return clients.pop()
+
+    ftp.side_effect = connect
+    r = BackendRegistry()
+    got = []
+    threads = [
+        threading.Thread(target=lambda: got.append(r.get("ftp", sentinel.config)))
+        for _ in range(2)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert got[0] is got[1]
+    assert len(r._clients) == 1
+    # The client that lost is closed, the one handed out isn't.
+    assert [x.close.call_count for x in created if x is not got[0]] == [1]
+    got[0].close.assert_not_called()
+
+
+def test_reset(backends):
+    google, _ = backends
+    r = BackendRegistry()
+
+    r.get("google", sentinel.config)
+    r.reset()
+    r.get("google", sentinel.config)
+
+    assert google.call_count == 2
@@ -0,0 +1,272 @@
+from ProjectNephos.backends import storage
+from ProjectNephos.backends.storage import DataStore
+from ProjectNephos.exceptions import BackendFailure
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from mock import MagicMock, patch, sentinel
+import pytest
+import threading
+
+MODULE_NAME = "ProjectNephos.backends.storage"
+
+
+def make_store(policy="all", timeout="0", search_index=False):
+    config = {
+        ("others", "backends"): "google ftp",
+        ("others", "backend_policy"): policy,
+        ("others", "backend_timeout"): timeout,
+        ("others", "search_index"): search_index,
+    }
+    with patch(MODULE_NAME + ".get_backend") as get_backend:
+        get_backend.side_effect = lambda *_: MagicMock()
+        store = DataStore(config)
+    store._db = MagicMock()
+    return store, store.backends["google"], store.backends["ftp"]
+
+
+def test_write():
+    store, google, ftp = make_store()
+    google.write.return_value = "id1"
+    ftp.write.return_value = "/id1"
+
+    assert store.write("random1", "random2") == {"google": "id1", "ftp": "/id1"}
+    google.write.assert_called_once_with("random1", "random2")
+    ftp.write.assert_called_once_with("random1", "random2")
+
+
+def test_write_concurrent():
+    store, google, ftp = make_store()
+    # Each backend waits for the other one to start. Only works if both run at once.
+    barrier = threading.Barrier(2, timeout=5)
+    google.write.side_effect = lambda *_: barrier.wait()
+    ftp.write.side_effect = lambda *_: barrier.wait()
+
+    store.write("random1")
+
+
+def test_write_all_policy():
+    store, google, ftp = make_store("all")
+    google.write.return_value = "id1"
+    ftp.write.side_effect = ValueError("random3")
+
+    with pytest.raises(BackendFailure) as e:
+        store.write("random1")
+
+    assert e.value.results == {"google": "id1"}
+    assert isinstance(e.value.errors["ftp"], ValueError)
+
+
+def test_write_best_effort_policy():
+    store, google, ftp = make_store("best_effort")
+    google.write.return_value = "id1"
+    ftp.write.side_effect = ValueError("random3")
+
+    response = store.write("random1")
+
+    assert response["google"] == "id1"
+    assert isinstance(response["ftp"], ValueError)
+
+    google.write.side_effect = ValueError("random4")
+    with pytest.raises(BackendFailure):
+        store.write("random1")
+
+
+def test_timeout():
+    store, google, ftp = make_store("best_effort", "0.1")
+    release = threading.Event()
+    google.write.side_effect = lambda *_: release.wait()
+    ftp.write.return_value = "/id1"
+
+    response = store.write("random1")
+    release.set()
+
+    assert response["ftp"] == "/id1"
+    assert isinstance(response["google"], TimeoutError)
+
+
+def test_timeout_serialized():
+    store, google, ftp = make_store("best_effort", "0.1")
+    release = threading.Event()
+    calls = []
+    google.write.side_effect = lambda *_: calls.append(1) or release.wait()
+
+    assert isinstance(store.write("random1")["google"], TimeoutError)
+    # The timed out write still holds the client, so the next one waits for it.
+    assert isinstance(store.write("random1")["google"], TimeoutError)
+    assert len(calls) == 1
+
+    release.set()
+    assert store.write("random1")["google"] is True
+    assert len(calls) == 3
+
+
+def test_thread_safe_not_serialized():
+    store, google, ftp = make_store("best_effort", "0.1")
+    google.THREAD_SAFE = True
+    release = threading.Event()
+    calls = []
+    google.write.side_effect = lambda *_: calls.append(1) or release.wait()
+
+    store.write("random1")
+    store.write("random1")
+    release.set()
+
+    assert len(calls) == 2
+
+
+def test_shared_executor():
+    with patch.dict(storage._executors, clear=True), patch(
+        MODULE_NAME + ".ThreadPoolExecutor", wraps=ThreadPoolExecutor
+    ) as executor:
+        make_store()[0].write("random1")
+        make_store()[0].write("random1")
+
+    executor.assert_called_once()
+
+
+def test_tag_skips_failed_backends():
+    store, google, ftp = make_store()
+
+    store.tag({"google": "id1", "ftp": ValueError()}, ["tag1"])
+
+    google.tag.assert_called_once_with("id1", ["tag1"])
+    ftp.tag.assert_not_called()
+
+
+def test_add_permission_user():
+    store, google, ftp = make_store()
+
+    store.add_permission_user({"google": "id1", "ftp": "/id1"}, "mail", "reader")
+
+    google.add_permissions_user.assert_called_once_with("id1", "mail", "reader")
+    ftp.add_permissions_user.assert_called_once_with("/id1", "mail", "reader")
+
+
+def test_delete():
+    store, google, ftp = make_store()
+
+    store.delete({"google": "id1", "ftp": "/id1"})
+
+    google.delete.assert_called_once_with("id1")
+    ftp.delete.assert_called_once_with("/id1")
+
+
+def test_search_merged():
+    store, google, ftp = make_store()
+    google.search.return_value = [("b", "id2"), ("a", "id1")]
+    ftp.search.return_value = [("a", "/a")]
+
+    response = store.search(name_subs="random1")
+
+    assert response == [("a", {"google": "id1", "ftp": "/a"}), ("b", {"google": "id2"})]
+
+
+def test_write_indexed():
+    store, google, ftp = make_store("best_effort")
+    google.write.return_value = "id1"
+    ftp.write.side_effect = ValueError("random3")
+
+    store.write("/local/random1.ts", "random2")
+
+    store.db.index_file.assert_called_once_with(
+        "random1.ts", "random2", "google", "id1"
+    )
+
+
+def test_tag_delete_indexed():
+    store, google, ftp = make_store()
+    fileids = {"google": "id1", "ftp": "/id1"}
+
+    store.tag(fileids, ["tag1"])
+    store.delete(fileids)
+
+    store.db.index_tags.assert_any_call("google", "id1", ["tag1"])
+    store.db.index_tags.assert_any_call("ftp", "/id1", ["tag1"])
+    assert store.db.unindex_file.call_count == 2
+
+
+def test_search_from_index():
+    store, google, ftp = make_store(search_index=True)
+    store.db.get_indexed_backends.return_value = {"google", "ftp"}
+    store.db.search_index.return_value = sentinel.response
+
+    assert store.search(tag_subs=["tag1"], do_and=True) == sentinel.response
+    store.db.search_index.assert_called_once_with(None, ["tag1"], True)
+    google.search.assert_not_called()
+    ftp.search.assert_not_called()
+
+
+def test_search_builds_index():
+    store, google, ftp = make_store(search_index=True)
+    store.db.get_indexed_backends.return_value = {"google"}
+    ftp.list_files.return_value = [("a", None, "/a", [])]
+    store.db.search_index.return_value = sentinel.response
+
+    assert store.search(name_subs="a") == sentinel.response
+    google.list_files.assert_not_called()
+    store.db.replace_index.assert_called_once_with("ftp", [("a", None, "/a", [])])
+    ftp.search.assert_not_called()
+
+
+def test_search_index_unavailable():
+    store, google, ftp = make_store(search_index=True)
+    store.db.get_indexed_backends.return_value = set()
+    ftp.list_files.side_effect = ValueError("random1")
+    google.search.return_value = [("a", "id1")]
+    ftp.search.return_value = []
+
+    # The index is missing ftp, so the backends are asked.
+    assert store.search(name_subs="a") == [("a", {"google": "id1"})]
+    store.db.search_index.assert_not_called()
+
+
+def test_reindex():
+    store, google, ftp = make_store()
+    google.list_files.return_value = iter([("a", None, "id1", [])])
+    ftp.list_files.return_value = [("a", None, "/a", []), ("b", "c", "/c/b", ["t"])]
+
+    assert store.reindex() == {"google": 1, "ftp": 2}
+    store.db.replace_index.assert_any_call("google", [("a", None, "id1", [])])
+
+
+def test_bulk_fallback():
+    store, google, ftp = make_store()
+    google.add_permissions_bulk.return_value = {"id1": "perm1", "id2": "perm2"}
+    del ftp.add_permissions_bulk
+    ftp.add_permissions_user.side_effect = [None, ValueError("random1")]
+    fileids_list = [
+        {"google": "id1", "ftp": "/id1"},
+        {"google": "id2", "ftp": "/id2"},
+        {"google": "id3", "ftp": ValueError("random2")},
+    ]
+
+    response = store.add_permission_user_bulk(fileids_list, "email", "reader")
+
+    google.add_permissions_bulk.assert_called_once_with(
+        ["id1", "id2", "id3"], "email", "reader"
+    )
+    assert ftp.add_permissions_user.call_count == 2
+    assert response["ftp"]["/id1"] is None
+    assert store.failed_items(response) == {"ftp": ["/id2"]}
+
+
+def test_tag_bulk_indexed():
+    store, google, ftp = make_store()
+    google.tag_bulk.return_value = {"id1": None, "id2": ValueError("random1")}
+    ftp.tag_bulk.return_value = {"/id1": None}
+
+    store.tag_bulk([{"google": "id1", "ftp": "/id1"}, {"google": "id2"}], ["tag1"])
+
+    assert store.db.index_tags.call_count == 2
+    store.db.index_tags.assert_any_call("google", "id1", ["tag1"])
+    store.db.index_tags.assert_any_call("ftp", "/id1", ["tag1"])
+
+
+def test_read_to_first_available():
+    store, google, ftp = make_store()
+    ftp.read_to.return_value = 10
+
+    fileids = {"google": ValueError("random1"), "ftp": "/id1"}
+    assert store.read_to(fileids, "random2", start=5) == 10
+    ftp.read_to.assert_called_once_with("/id1", "random2", 5, None)
+    google.read_to.assert_not_called()
@@ -75,3 +75,14 @@ def test_run_normal(default_object):
     ch.run(args)
     db.get_channels.assert_not_called()
     db.add_channel.assert_called_once_with("asdf", "1.2.3.4")
+
+
+def test_run_history(default_object):
+    ch, db = default_object
+
+    args = MagicMock()
+    args.action = "history"
+    args.name = "asdf"
+
+    ch.run(args)
+    db.get_channel_checks.assert_called_once_with("asdf", limit=50)
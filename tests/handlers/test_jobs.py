@@ -84,3 +84,25 @@ def test_add_job(default_object):
     db.get_channels.return_value = [1]
     jb.run(args)
     db.add_job.assert_called()
+
+
+def test_add_program_tags(default_object):
+    jb, db, args = default_object
+
+    args.action = "add"
+    args.name, args.program_tags, args.dry_run = "sub", ["news"], True
+    progs = [
+        MagicMock(id=1, program="prog1", channel="ch", start="0 0 1 6 * *", duration=5),
+        MagicMock(id=2, program="prog1", channel="ch", start="0 0 2 6 * *", duration=5),
+    ]
+
+    db.get_job.return_value = None
+    db.get_schedule_items.return_value = progs
+    db.add_jobs.return_value = (["sub->prog1-1", "sub->prog1-2"], [], [])
+    jb.run(args)
+
+    db.add_job.assert_not_called()
+    jobs = db.add_jobs.call_args[0][0]
+    # Every airing gets a job.
+    assert [x["name"] for x in jobs] == ["sub->prog1-1", "sub->prog1-2"]
+    assert db.add_jobs.call_args[1] == {"dry_run": True}
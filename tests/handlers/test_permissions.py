@@ -7,8 +7,10 @@ MODULE_NAME = "ProjectNephos.handlers.permissions"
 
 
 @pytest.fixture
+@patch(MODULE_NAME + ".SearchHandler")
+@patch(MODULE_NAME + ".DataStore")
 @patch(MODULE_NAME + ".DBStorage")
-def default_object(_):
+def default_object(*_):
     ph = PermissionHandler(config=sentinel.config)
 
     args = MagicMock()
@@ -17,3 +19,23 @@ def default_object(_):
 
     return ph, ph.db, args
 
+
+def test_add(default_object):
+    ph, db, args = default_object
+    args.action = "add"
+    args.for_tags = ["tag1"]
+    args.share_with = "random_mail"
+    args.not_persistent = False
+    ph.search.execute_command.return_value = [
+        ("file1", {"google": "id1"}),
+        ("file2", {"google": "id2", "ftp": "/id2"}),
+    ]
+
+    ph.run(args)
+
+    db.add_permissions.assert_called_once_with(["tag1"], "random_mail", "reader")
+    ph.backend.add_permission_user_bulk.assert_called_once_with(
+        [{"google": "id1"}, {"google": "id2", "ftp": "/id2"}],
+        email="random_mail",
+        role="reader",
+    )
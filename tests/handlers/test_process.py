@@ -27,3 +27,53 @@ def test_bad_file(isfile):
     with pytest.raises(FileNotFound):
         sh.run(args)
     isfile.assert_called_once_with("random_input1")
+
+
+@patch(MODULE_NAME + ".run_process")
+def test_execute_command(run_process):
+    sh = ProcessHandler("random_subcommand")
+    sh.init_with_config({("processing", "process_timeout"): "0"})
+
+    sh.execute_command("in.ts", "out.mp4")
+
+    command = run_process.call_args[0][0]
+    assert command[:5] == ["ffmpeg", "-nostdin", "-y", "-i", "in.ts"]
+    assert command[-1] == "out.mp4"
+    assert "-progress" in command
+    assert run_process.call_args[1]["timeout"] is None
+    assert run_process.call_args[1]["on_progress"] is not None
+
+
+@patch(MODULE_NAME + ".run_process")
+def test_execute_concat(run_process, tmpdir):
+    sh = ProcessHandler("random_subcommand")
+    sh.init_with_config({("processing", "process_timeout"): "3600"})
+    output = str(tmpdir.join("out.mp4"))
+    lists = []
+    run_process.side_effect = lambda command, *_, **__: lists.append(
+        open(command[command.index("-i") + 1]).read()
+    )
+
+    sh.execute_concat(["/a/one.mp4", "/a/it's.mp4"], output)
+
+    assert lists == ["file '/a/one.mp4'\nfile '/a/it'\\''s.mp4'\n"]
+    assert run_process.call_args[1]["timeout"] == 3600
+    assert tmpdir.listdir() == []
+
+
+@patch(MODULE_NAME + ".run_process")
+def test_execute_profiles(run_process):
+    sh = ProcessHandler("random_subcommand")
+    sh.init_with_config({("processing", "process_timeout"): "0"})
+    hd = MagicMock(threads="4")
+    hd.output_args.return_value = ["-crf", "23"]
+    sd = MagicMock(threads="2")
+    sd.output_args.return_value = ["-crf", "26"]
+
+    sh.execute_profiles("in.ts", [(hd, "hd.mp4"), (sd, "sd.mp4")])
+
+    command = run_process.call_args[0][0]
+    # Decoded once, encoded twice.
+    assert command.count("-i") == 1
+    assert command[3:7] == ["-threads", "4", "-i", "in.ts"]
+    assert command[-6:] == ["-crf", "23", "hd.mp4", "-crf", "26", "sd.mp4"]
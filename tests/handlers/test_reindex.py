@@ -0,0 +1,17 @@
+from ProjectNephos.handlers.reindex import ReindexHandler
+
+from mock import MagicMock, patch
+
+MODULE_NAME = "ProjectNephos.handlers.reindex"
+
+
+@patch(MODULE_NAME + ".DataStore")
+def test_run(ds):
+    ds.return_value.reindex.return_value = {"google": 5}
+
+    rh = ReindexHandler("reindex")
+    rh.init_with_config("random_config")
+    rh.run(MagicMock())
+
+    ds.assert_called_once_with("random_config")
+    ds.return_value.reindex.assert_called_once()
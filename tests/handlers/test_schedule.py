@@ -0,0 +1,56 @@
+from ProjectNephos.handlers.schedule import ScheduleHandler
+
+from mock import MagicMock, patch, sentinel
+import pytest
+
+MODULE_NAME = "ProjectNephos.handlers.schedule"
+
+
+@pytest.fixture
+@patch(MODULE_NAME + ".DBStorage")
+def default_object(_):
+    sh = ScheduleHandler(config=sentinel.config)
+    channel = MagicMock()
+    channel.name = "CNN"
+    sh.db.get_channels.return_value = [channel]
+    sh.db.import_schedule.side_effect = lambda batch: (len(batch), 0)
+    return sh, sh.db
+
+
+def program(channel, aliases=()):
+    return {"channel": channel, "aliases": list(aliases), "program": "random1"}
+
+
+def test_import_batches(default_object):
+    sh, db = default_object
+    sh.BATCH_SIZE = 2
+    programs = [program("CNN"), program("cnn.us", ["CNN"]), program("BBC")] * 2
+
+    counts = sh.execute_command(iter(programs))
+
+    assert counts["added"] == 4
+    assert counts["skipped"] == 2
+    assert db.import_schedule.call_count == 2
+    batch = db.import_schedule.call_args_list[0][0][0]
+    assert [x["channel"] for x in batch] == ["CNN", "CNN"]
+
+
+def test_import_untitled(default_object):
+    sh, db = default_object
+    untitled = program("CNN")
+    untitled.update(program=None, start="0 20 1 6 * 2018")
+
+    counts = sh.execute_command(iter([program("CNN"), untitled]))
+
+    assert counts["added"] == 1
+    assert counts["skipped"] == 1
+    assert counts["untitled"] == 1
+
+
+def test_import_requires_file(default_object):
+    sh, db = default_object
+    args = MagicMock()
+    args.action, args.file = "import", None
+
+    assert sh.run(args) == -1
+    db.import_schedule.assert_not_called()
@@ -1,6 +1,6 @@
 from ProjectNephos.handlers.tag import TagHandler
 
-from mock import patch
+from mock import MagicMock, patch
 
 MODULE_NAME = "ProjectNephos.handlers.tag"
 
@@ -15,3 +15,22 @@ def test_default(ds, _):
     assert sh.subcommand == "random_subcommand"
     assert sh.backend == "random_drive_store"
     ds.assert_called_once_with("random_config")
+
+
+@patch(MODULE_NAME + ".SearchHandler")
+@patch(MODULE_NAME + ".DataStore")
+def test_run(ds, sh):
+    sh.return_value.execute_command.return_value = [
+        ("file1", {"google": "id1"}),
+        ("file2", {"google": "id2"}),
+    ]
+    th = TagHandler("tag")
+    th.init_with_config("random_config")
+
+    args = MagicMock()
+    args.for_name, args.add_tags = "file", ["tag1"]
+    th.run(args)
+
+    ds.return_value.tag_bulk.assert_called_once_with(
+        [{"google": "id1"}, {"google": "id2"}], ["tag1"]
+    )
@@ -0,0 +1,146 @@
+from ProjectNephos.orchestration.capture import *
+from ProjectNephos.orchestration.mpegts import TS_SYNC_BYTE
+
+from mock import MagicMock
+import os
+import socket
+import threading
+import time
+
+
+def ts_packet(pid, counter, payload=True, sync=TS_SYNC_BYTE):
+    control = 0x10 if payload else 0x20
+    return bytes([sync, pid >> 8, pid & 0xFF, control | counter]) + b"\x00" * 184
+
+
+def test_writer(tmpdir):
+    path = str(tmpdir.join("out.ts"))
+    w = TSWriter(path, buffer_size=WRITE_ALIGN)
+
+    w.feed(b"".join(ts_packet(256, x) for x in range(7)))
+    # A broken packet is dropped.
+    w.feed(ts_packet(256, 7, sync=0))
+    # 8 and 9 are missing. Packets without payload don't move the counter.
+    w.feed(ts_packet(256, 10) + ts_packet(256, 10, payload=False) + ts_packet(256, 11))
+    # Null packets have no counter.
+    w.feed(ts_packet(0x1FFF, 0) + ts_packet(0x1FFF, 5))
+
+    assert w.stats.bytes == 0
+    w.close()
+
+    assert w.stats.packets == 13
+    assert w.stats.errors == 1
+    assert w.stats.continuity_errors == 3
+    assert w.stats.bytes == 12 * 188
+    with open(path, "rb") as f:
+        assert f.read()[:188] == ts_packet(256, 0)
+
+
+def test_writer_aligned(tmpdir):
+    w = TSWriter(str(tmpdir.join("out.ts")), buffer_size=WRITE_ALIGN)
+    packets = WRITE_ALIGN // 188 + 5
+
+    for x in range(packets):
+        w.feed(ts_packet(256, x % 16))
+
+    assert w.stats.bytes == WRITE_ALIGN
+    w.close()
+    assert w.stats.bytes == packets * 188
+    assert w.stats.continuity_errors == 0
+
+
+def test_capture_loopback(tmpdir):
+    path = str(tmpdir.join("out.ts"))
+    finder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    finder.bind(("127.0.0.1", 0))
+    port = finder.getsockname()[1]
+    finder.close()
+
+    stop = threading.Event()
+
+    def send():
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        counter = 0
+        while not stop.is_set():
+            data = b""
+            for _ in range(7):
+                data += ts_packet(256, counter)
+                counter = (counter + 1) % 16
+            sender.sendto(data, ("127.0.0.1", port))
+            stop.wait(0.005)
+        sender.close()
+
+    t = threading.Thread(target=send)
+    t.start()
+    progress = MagicMock()
+    try:
+        stats = capture(
+            "127.0.0.1:{}".format(port), path, 0.5, progress=progress, interval=0.2
+        )
+    finally:
+        stop.set()
+        t.join()
+
+    assert stats.packets > 0
+    assert stats.errors == 0
+    assert stats.bytes == stats.packets * 188
+    assert progress.call_count == 3
+    with open(path, "rb") as f:
+        assert len(f.read()) == stats.bytes
+
+
+def test_segment_path():
+    assert segment_path("/files/job--20180601_20:00.ts", 7) == (
+        "/files/job--20180601_20:00.part007.ts"
+    )
+
+
+def test_capture_segments(tmpdir):
+    path = str(tmpdir.join("out.ts"))
+    finder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    finder.bind(("127.0.0.1", 0))
+    port = finder.getsockname()[1]
+    finder.close()
+
+    stop = threading.Event()
+
+    def send():
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        while not stop.is_set():
+            sender.sendto(ts_packet(256, 0) * 7, ("127.0.0.1", port))
+            stop.wait(0.005)
+        sender.close()
+
+    t = threading.Thread(target=send)
+    t.start()
+    segments = []
+    threads = set()
+    progress = MagicMock()
+
+    def on_segment(path):
+        # Blocking here must not hold up the capture.
+        threads.add(threading.current_thread())
+        time.sleep(0.3)
+        segments.append(path)
+
+    try:
+        stats = capture(
+            "127.0.0.1:{}".format(port),
+            path,
+            0.5,
+            segment=0.2,
+            on_segment=on_segment,
+            progress=progress,
+            interval=0.1,
+        )
+    finally:
+        stop.set()
+        t.join()
+
+    assert segments == [segment_path(path, x) for x in range(3)]
+    assert threading.current_thread() not in threads
+    assert progress.call_count == 5
+    assert sum(os.path.getsize(x) for x in segments) == stats.bytes
+
+    concat_files(segments, path)
+    assert os.path.getsize(path) == stats.bytes
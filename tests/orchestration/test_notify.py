@@ -0,0 +1,37 @@
+from ProjectNephos.orchestration.notify import DownloadListener, notify_new_download
+
+import os
+import pytest
+
+
+@pytest.fixture
+def config(tmpdir):
+    return {("processing", "notify_socket"): str(tmpdir.join("notify.sock"))}
+
+
+def test_notify(config):
+    listener = DownloadListener(config)
+    assert not listener.wait(0.01)
+
+    notify_new_download(config)
+    notify_new_download(config)
+
+    assert listener.wait(1)
+    # Both notifications were consumed at once.
+    assert not listener.wait(0.01)
+
+    listener.close()
+    assert not os.path.exists(config["processing", "notify_socket"])
+
+
+def test_notify_nobody_listening(config):
+    notify_new_download(config)
+
+
+def test_stale_socket(config):
+    DownloadListener(config)
+    listener = DownloadListener(config)
+
+    notify_new_download(config)
+    assert listener.wait(1)
+    listener.close()
@@ -0,0 +1,63 @@
+from ProjectNephos.orchestration.pipeline import Pipeline
+
+from mock import MagicMock
+import threading
+import time
+
+
+def test_stages_hand_on_items():
+    p = Pipeline()
+    done = []
+
+    p.add_stage("double", lambda x: p.put("collect", x * 2), workers=2)
+    p.add_stage("collect", done.append)
+    p.start()
+
+    for i in range(10):
+        p.put("double", i)
+
+    # Wait for every item to reach the last stage before stopping.
+    while len(done) < 10:
+        time.sleep(0.01)
+    p.stop()
+
+    assert sorted(done) == [i * 2 for i in range(10)]
+    assert p.threads == []
+
+
+def test_errors_reported():
+    on_error = MagicMock()
+    error = ValueError("random1")
+    called = threading.Event()
+
+    def fail(_):
+        called.set()
+        raise error
+
+    p = Pipeline(on_error=on_error)
+    p.add_stage("fail", fail)
+    p.start()
+    p.put("fail", "item1")
+    called.wait()
+    p.stop()
+
+    on_error.assert_called_once_with("fail", "item1", error)
+
+
+def test_backpressure():
+    p = Pipeline()
+    release = threading.Event()
+    p.add_stage("slow", lambda _: release.wait(), maxsize=1)
+    p.start()
+
+    p.put("slow", 1)  # Picked up by the thread
+    p.put("slow", 2)  # Waits in the queue
+
+    blocked = threading.Thread(target=p.put, args=("slow", 3))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join()
+    p.stop()
@@ -0,0 +1,92 @@
+from ProjectNephos.orchestration.probe import *
+from ProjectNephos.orchestration.mpegts import RTP_HEADER_SIZE, TS_SYNC_BYTE, DEFAULT_PORT
+
+from mock import patch
+import socket
+import threading
+import time
+
+MODULE_NAME = "ProjectNephos.orchestration.probe"
+
+
+def ts_packet(pid, sync=TS_SYNC_BYTE):
+    return bytes([sync, pid >> 8, pid & 0xFF]) + b"\xff" * (TS_PACKET_SIZE - 3)
+
+
+def test_parse_datagram():
+    data = ts_packet(0) + ts_packet(256) + ts_packet(256, sync=0)
+    assert parse_datagram(data) == (3, 1, {0, 256})
+
+    rtp = b"\x80" + b"\x00" * (RTP_HEADER_SIZE - 1)
+    assert parse_datagram(rtp + ts_packet(17) * 7) == (7, 0, {17})
+
+    # Transport error bit set, then a truncated packet.
+    assert parse_datagram(ts_packet(0x80 << 8) + b"\x47\x00") == (2, 2, set())
+
+
+def test_is_up():
+    assert ProbeResult(10, 0, {0, 256}, None).is_up(10)
+    assert not ProbeResult(9, 0, {0, 256}, None).is_up(10)
+    assert not ProbeResult(10, 1, {0, 256}, None).is_up(10)
+    assert not ProbeResult(10, 0, {NULL_PID}, None).is_up(10)
+    assert not ProbeResult(10, 0, {0}, "Timed out").is_up(10)
+
+
+@patch(MODULE_NAME + ".open_socket")
+def test_probe_channel(open_socket):
+    sock = open_socket.return_value
+    sock.recv.side_effect = [ts_packet(0) * 7, ts_packet(256) * 7]
+
+    result = probe_channel("239.1.1.1:5000", packets=10)
+
+    assert result == ProbeResult(14, 0, {0, 256}, None)
+    open_socket.assert_called_once_with("239.1.1.1", 5000, None)
+    sock.close.assert_called_once()
+
+
+@patch(MODULE_NAME + ".open_socket")
+def test_probe_channel_timeout(open_socket):
+    open_socket.return_value.recv.side_effect = [ts_packet(0) * 7, socket.timeout]
+
+    result = probe_channel("239.1.1.1", packets=10)
+
+    assert result == ProbeResult(7, 0, {0}, "Timed out")
+    open_socket.assert_called_once_with("239.1.1.1", DEFAULT_PORT, None)
+
+
+@patch(MODULE_NAME + ".open_socket")
+def test_probe_channel_no_socket(open_socket):
+    open_socket.side_effect = OSError("No such device")
+
+    result = probe_channel("239.1.1.1:5000")
+    assert result.packets == 0
+    assert "No such device" in result.error
+
+
+def test_probe_channel_unicast():
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    finder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    finder.bind(("127.0.0.1", 0))
+    port = finder.getsockname()[1]
+    finder.close()
+
+    def send():
+        for _ in range(20):
+            sender.sendto(ts_packet(256) * 7, ("127.0.0.1", port))
+            time.sleep(0.01)
+
+    t = threading.Thread(target=send)
+    t.start()
+    result = probe_channel("127.0.0.1:{}".format(port), packets=7, timeout=2)
+    t.join()
+    sender.close()
+
+    assert result.is_up(7)
+
+
+@patch(MODULE_NAME + ".probe_channel")
+def test_probe_channels(probe_channel):
+    probe_channel.side_effect = lambda address, *_: address
+
+    assert probe_channels(["a", "b", "c"], workers=2) == ["a", "b", "c"]
+    assert probe_channels([]) == []
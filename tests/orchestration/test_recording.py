@@ -1 +1,79 @@
-from ProjectNephos.orchestration import recording
\ No newline at end of file
+from ProjectNephos.orchestration import recording
+from mock import MagicMock, patch
+import pytest
+
+MODULE_NAME = "ProjectNephos.orchestration.recording"
+
+
+@pytest.fixture
+def native_config(tmpdir):
+    return {
+        ("downloads", "local_save_location"): str(tmpdir) + "/",
+        ("recording", "logs"): str(tmpdir) + "/",
+        ("recording", "recorder"): "native",
+        ("recording", "bind"): None,
+        ("recording", "progress_interval"): "60",
+        ("recording", "segment_length"): "0",
+    }
+
+
+@patch(MODULE_NAME + ".notify_new_download")
+@patch(MODULE_NAME + ".capture")
+@patch(MODULE_NAME + ".DBStorage")
+def test_record_native(DBStorage, capture, notify, native_config):
+    job = MagicMock(duration=30)
+    job.name = "job1"
+    DBStorage.return_value.get_channels.return_value.ip_string = "239.1.1.1:1234"
+    capture.return_value.bytes = 1024
+
+    assert recording.record_video(job, native_config) == 0
+
+    assert capture.call_args[0][0] == "239.1.1.1:1234"
+    assert capture.call_args[0][2] == 30 * 60
+    DBStorage.return_value.add_file.assert_called_once()
+    notify.assert_called_once()
+
+
+@patch(MODULE_NAME + ".notify_new_download")
+@patch(MODULE_NAME + ".capture")
+@patch(MODULE_NAME + ".DBStorage")
+def test_record_native_nothing_received(DBStorage, capture, notify, native_config):
+    job = MagicMock(duration=30)
+    job.name = "job1"
+    capture.return_value.bytes = 0
+
+    assert recording.record_video(job, native_config) == -1
+    DBStorage.return_value.add_file.assert_not_called()
+    notify.assert_not_called()
+
+
+@patch(MODULE_NAME + ".notify_new_download")
+@patch(MODULE_NAME + ".capture")
+@patch(MODULE_NAME + ".DBStorage")
+def test_record_segmented(DBStorage, capture, notify, native_config, tmpdir):
+    job = MagicMock(duration=30)
+    job.name = "job1"
+    native_config["recording", "segment_length"] = "5"
+    db = DBStorage.return_value
+
+    def record(address, path, duration, on_segment, **kwargs):
+        for i, data in enumerate([b"a", b"", b"b"]):
+            segment = tmpdir.join("seg{}.ts".format(i))
+            segment.write(data)
+            on_segment(str(segment))
+        return MagicMock()
+
+    capture.side_effect = record
+
+    assert recording.record_video(job, native_config) == 0
+
+    assert capture.call_args[1]["segment"] == 5 * 60
+    # The empty segment is dropped, but counted.
+    assert [x[1] for x in db.add_file.call_args_list[:-1]] == [
+        {"parent": x} for x in [db.add_file.call_args[0][0]] * 2
+    ]
+    assert db.add_file.call_args[1] == {"segments": 3}
+    assert notify.call_count == 3
+    with open(db.add_file.call_args[0][0]) as f:
+        assert f.read() == "ab"
+    assert not tmpdir.join("seg1.ts").exists()
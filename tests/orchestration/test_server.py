@@ -26,21 +26,104 @@ def default_object(*_):
     return obj, obj.sched
 
 
+def make_job(id):
+    job = MagicMock(id=id)
+    job.start = "0 20 * * * *"
+    return job
+
+
 def test_recording_job(default_object):
     s, sch = default_object
-    rec_list = [MagicMock()] * 5
-    s.db.get_job.return_value = rec_list
+    rec_list = [make_job(x) for x in range(5)]
+    s.db.get_job_versions.return_value = {x: 1.0 for x in range(5)}
+    s.db.get_jobs_by_ids.return_value = rec_list
 
     s.add_recording_jobs()
     assert sch.add_job.call_count == len(rec_list)
+    assert sch.add_job.call_args[1]["id"] == "recording-4"
+    s.db.close.assert_called_once()
 
 
+def test_reload_recording_jobs(default_object):
+    s, sch = default_object
+    s.recording_jobs = {1: 1.0, 2: 1.0, 3: 1.0}
+    s.db.get_job_versions.return_value = {1: 1.0, 2: 2.0, 4: 1.0}
+    s.db.get_jobs_by_ids.side_effect = lambda ids: [make_job(x) for x in ids]
+
+    s.add_recording_jobs()
+
+    assert sorted(s.db.get_jobs_by_ids.call_args[0][0]) == [2, 4]
+    assert sch.add_job.call_count == 2
+    sch.remove_job.assert_called_once_with("recording-3")
+    assert s.recording_jobs == {1: 1.0, 2: 2.0, 4: 1.0}
+
+
+def test_reload_bad_job(default_object):
+    s, sch = default_object
+    s.db.get_job_versions.return_value = {1: 1.0, 2: 1.0}
+    s.db.get_jobs_by_ids.return_value = [make_job(1), make_job(2)]
+    sch.add_job.side_effect = [ValueError, MagicMock()]
+
+    s.add_recording_jobs()
+    assert s.recording_jobs == {1: 1.0, 2: 1.0}
+
+
+@patch(MODULE_NAME + ".Server.start_listener")
+@patch(MODULE_NAME + ".Server.start_workers")
 @patch(MODULE_NAME + ".Server.add_regular_jobs")
 @patch(MODULE_NAME + ".Server.add_recording_jobs")
-def test_run_server(rec_job, reg_job, default_object):
+def test_run_server(rec_job, reg_job, start_workers, start_listener, default_object):
     s, sch = default_object
     s.run_server()
 
+    start_workers.assert_called_once()
+    start_listener.assert_called_once()
     rec_job.assert_called_once()
     reg_job.assert_called_once()
     sch.start.assert_called_once()
+
+
+@patch(MODULE_NAME + ".WorkerPool")
+def test_start_workers(WorkerPool, default_object):
+    s, sch = default_object
+    WorkerPool.return_value.size = 2
+
+    s.start_workers()
+    s.add_regular_jobs()
+
+    WorkerPool.return_value.start.assert_called_once()
+    assert s.pool == WorkerPool.return_value
+    # run_job is not polled when workers drain the queue.
+    assert sch.add_job.call_count == 2
+
+
+@patch(MODULE_NAME + ".WorkerPool")
+def test_start_workers_disabled(WorkerPool, default_object):
+    s, sch = default_object
+    WorkerPool.return_value.size = 0
+
+    s.start_workers()
+    s.add_regular_jobs()
+
+    WorkerPool.return_value.start.assert_not_called()
+    assert s.pool is None
+    assert sch.add_job.call_count == 3
+
+
+def test_new_download_wakes_workers(default_object):
+    s, sch = default_object
+    s.pool = MagicMock()
+
+    s.on_new_download()
+
+    s.pool.notify.assert_called_once()
+    sch.add_job.assert_not_called()
+
+
+def test_new_download_without_workers(default_object):
+    s, sch = default_object
+
+    s.on_new_download()
+
+    sch.add_job.assert_called_once()
+    assert sch.add_job.call_args[0][0].__name__ == "run_job"
@@ -1,4 +1,6 @@
 from ProjectNephos.orchestration.tasks import *
+from ProjectNephos.orchestration.probe import ProbeResult
+from ProjectNephos.config import Configuration
 
 from mock import MagicMock, patch, sentinel
 import pytest
@@ -15,6 +17,24 @@ def test_process_job(ph):
     ph().execute_command.assert_called_once()
 
 
+@patch(MODULE_NAME + ".ProcessHandler")
+def test_process_job_profile(ph):
+    config = Configuration()
+    config.conf_items.set("downloads", "temp_save_location", "/temp1/")
+    ret = process_job("h264_all", "/test1/fname.ts", config)
+
+    assert ret == "/temp1/fname.h264.mp4"
+    outputs = ph().execute_profiles.call_args[0][1]
+    assert [(x.name, y) for x, y in outputs] == [
+        ("h264", "/temp1/fname.h264.mp4"),
+        ("h264_sd", "/temp1/fname.h264_sd.mp4"),
+    ]
+    ph().execute_command.assert_not_called()
+
+    assert output_paths("/test1/fname.ts", "h264", config) == ["/temp1/fname.mp4"]
+    assert output_paths("/test1/fname.ts", "mkv", config) == ["/temp1/fname.mkv"]
+
+
 @patch(MODULE_NAME + ".ProcessHandler")
 def test_process_job_no(ph):
     config = {("downloads", "temp_save_location"): "/temp1/temp2/"}
@@ -22,3 +42,306 @@ def test_process_job_no(ph):
 
     assert ret == "/test1/test2/fname.abc"
     ph().execute_command.assert_not_called()
+
+
+PROCESSING_CONFIG = {
+    ("processing", "queue_size"): "2",
+    ("processing", "convert_concurrency"): "1",
+    ("processing", "subtitles_concurrency"): "1",
+    ("processing", "upload_concurrency"): "2",
+}
+
+
+@pytest.fixture
+def pipeline_mocks():
+    names = [
+        "process_job",
+        "run_ccex",
+        "upload_job",
+        "tag_job",
+        "share_job",
+        "delete_job",
+        "delete_and_upload_log",
+        "output_paths",
+    ]
+    patchers = [patch(MODULE_NAME + "." + name) for name in names]
+    mocks = dict(zip(names, [p.start() for p in patchers]))
+
+    mocks["process_job"].return_value = "/temp/fname.mp4"
+    mocks["output_paths"].return_value = ["/temp/fname.mp4"]
+    mocks["run_ccex"].return_value = "/temp/fname.srt"
+    mocks["upload_job"].return_value = ({"google": "id1"}, None)
+
+    db = MagicMock()
+    job = db.get_job.return_value
+    job.tags = "tag1,tag2"
+    job.subtitles = True
+    job.upload = True
+    db.get_permissions_for_tags.return_value = {("mail1", "reader")}
+
+    yield mocks, db, job
+
+    for p in patchers:
+        p.stop()
+
+
+def make_download(filename="/files/fname.ts", parent=None, segments=None):
+    download = MagicMock(segments=segments)
+    # `parent` is taken by the MagicMock constructor.
+    download.parent = parent
+    download.filename = filename
+    return download
+
+
+def test_process_download(pipeline_mocks):
+    mocks, db, job = pipeline_mocks
+    download = make_download()
+
+    process_download(db, download, PROCESSING_CONFIG)
+
+    mocks["process_job"].assert_called_once_with(
+        job.convert_to, "/files/fname.ts", PROCESSING_CONFIG
+    )
+    # ccextractor works on the raw recording, not on the converted one
+    mocks["run_ccex"].assert_called_once_with(
+        True, "/files/fname.ts", PROCESSING_CONFIG
+    )
+    assert mocks["upload_job"].call_count == 2
+    mocks["tag_job"].assert_called_once_with(
+        {"google": "id1"}, "tag1,tag2", PROCESSING_CONFIG
+    )
+    mocks["share_job"].assert_called_once_with(
+        {"google": "id1"}, {("mail1", "reader")}, PROCESSING_CONFIG
+    )
+    db.get_permissions_for_tags.assert_called_once_with(
+        [x.name for x in job.tag_list]
+    )
+    mocks["delete_job"].assert_called_once_with(
+        "/files/fname.ts", "/temp/fname.mp4", "/temp/fname.srt"
+    )
+
+
+@patch(MODULE_NAME + ".delete_files")
+def test_process_renditions(delete_files, pipeline_mocks):
+    mocks, db, job = pipeline_mocks
+    job.subtitles = False
+    mocks["output_paths"].return_value = ["/temp/fname.hd.mp4", "/temp/fname.sd.mp4"]
+    mocks["upload_job"].side_effect = [
+        ({"google": "id1"}, None),
+        ({"google": "id2"}, None),
+    ]
+
+    process_download(db, make_download(), PROCESSING_CONFIG)
+
+    assert mocks["upload_job"].call_args[0][1] == "/temp/fname.sd.mp4"
+    assert [x[0][0] for x in mocks["tag_job"].call_args_list] == [
+        {"google": "id1"},
+        {"google": "id2"},
+    ]
+    assert mocks["share_job"].call_count == 2
+    delete_files.assert_called_once_with(["/temp/fname.sd.mp4"])
+
+
+def test_process_download_no_upload(pipeline_mocks):
+    mocks, db, job = pipeline_mocks
+    job.upload = False
+    job.subtitles = False
+
+    process_download(db, make_download(), PROCESSING_CONFIG)
+
+    mocks["run_ccex"].assert_not_called()
+    mocks["upload_job"].assert_not_called()
+    mocks["tag_job"].assert_not_called()
+    mocks["delete_job"].assert_called_once()
+
+
+def test_process_download_failure(pipeline_mocks):
+    mocks, db, job = pipeline_mocks
+    mocks["process_job"].side_effect = ValueError("random1")
+
+    with pytest.raises(ValueError):
+        process_download(db, make_download(), PROCESSING_CONFIG)
+
+    # Nothing is deleted so that the download can be retried.
+    mocks["delete_job"].assert_not_called()
+    mocks["tag_job"].assert_not_called()
+
+
+def test_process_segment(pipeline_mocks):
+    mocks, db, job = pipeline_mocks
+    download = make_download("/files/fname.part001.ts", parent="/files/fname.ts")
+
+    process_download(db, download, PROCESSING_CONFIG)
+
+    mocks["process_job"].assert_called_once_with(
+        job.convert_to, "/files/fname.part001.ts", PROCESSING_CONFIG
+    )
+    # Segments are only converted and kept until the whole recording is done.
+    mocks["run_ccex"].assert_not_called()
+    mocks["upload_job"].assert_not_called()
+    mocks["delete_job"].assert_not_called()
+    mocks["delete_and_upload_log"].assert_not_called()
+
+
+@patch(MODULE_NAME + ".delete_segments")
+@patch(MODULE_NAME + ".join_job")
+def test_process_segmented(join_job, delete_segments, pipeline_mocks):
+    mocks, db, job = pipeline_mocks
+    join_job.return_value = "/temp/fname.mp4"
+    download = make_download(segments=3)
+
+    process_download(db, download, PROCESSING_CONFIG)
+
+    info = DownloadInfo(download.id, "/files/fname.ts", None, 3)
+    join_job.assert_called_once_with(job.convert_to, info, PROCESSING_CONFIG)
+    mocks["process_job"].assert_not_called()
+    mocks["run_ccex"].assert_called_once_with(
+        True, "/files/fname.ts", PROCESSING_CONFIG
+    )
+    mocks["delete_job"].assert_called_once_with(
+        "/files/fname.ts", "/temp/fname.mp4", "/temp/fname.srt"
+    )
+    delete_segments.assert_called_once_with(info, job.convert_to, PROCESSING_CONFIG)
+
+
+def test_process_while_claiming(tmpdir, pipeline_mocks):
+    """
+    The worker keeps claiming and acking downloads while others are inside a stage.
+    """
+    mocks, _, _ = pipeline_mocks
+    config = dict(PROCESSING_CONFIG)
+    config.update(
+        {
+            ("processing", "convert_concurrency"): "2",
+            ("recording", "db_location"): str(tmpdir.join("nephos.sqlite")),
+            ("recording", "db_wal"): True,
+            ("recording", "db_busy_timeout"): "1",
+            ("recording", "db_retries"): "2",
+            ("recording", "db_single_writer"): False,
+        }
+    )
+    db = DBStorage(config)
+    db.add_channel("channel1", "1.2.3.4:1234")
+    db.add_job("job1", "channel1", "0 0 * * * *", 30, True, "mp4", False, ["tag1"])
+    db.add_file("/files/one.ts", "job1")
+    db.add_file("/files/two.ts", "job1")
+
+    converting, proceed = threading.Event(), threading.Event()
+
+    def convert(convert_to, filename, config):
+        if filename == "/files/one.ts":
+            converting.set()
+            proceed.wait(5)
+        return filename
+
+    mocks["process_job"].side_effect = convert
+    finished = queue.Queue()
+    pipeline = PostProcessingPipeline(config, finished.put)
+    pipeline.start()
+
+    first = db.claim_download("worker1")
+    pipeline.submit(db, first)
+    assert converting.wait(5)
+
+    second = db.claim_download("worker1")
+    pipeline.submit(db, second)
+    recording = finished.get(timeout=5)
+    assert recording.download.filename == "/files/two.ts"
+    db.ack_download(second)
+
+    # The commits above expired the ORM objects and closing the session detaches
+    # them. The first download must still get through on its copies.
+    db.close()
+    proceed.set()
+    recording = finished.get(timeout=5)
+    pipeline.stop()
+
+    assert recording.error is None
+    assert recording.download.filename == "/files/one.ts"
+    assert mocks["tag_job"].call_args_list[-1][0][1] == "tag1"
+    db.ack_download(first)
+    assert db.claim_download("worker1") is None
+
+
+@pytest.fixture
+def segments(tmpdir):
+    config = {("downloads", "temp_save_location"): str(tmpdir.mkdir("temp")) + "/"}
+    files = tmpdir.mkdir("files")
+    for i in [0, 2]:
+        files.join("fname.part00{}.ts".format(i)).write("")
+    return make_download(str(files) + "/fname.ts", segments=3), config
+
+
+@patch(MODULE_NAME + ".process_job")
+@patch(MODULE_NAME + ".ProcessHandler")
+def test_join_job(ph, process_job, segments):
+    download, config = segments
+    temp = config["downloads", "temp_save_location"]
+
+    # Not all segments were converted.
+    open(temp + "fname.part000.mp4", "w").close()
+    join_job("mp4", download, config)
+    process_job.assert_called_once_with("mp4", download.filename, config)
+
+    open(temp + "fname.part002.mp4", "w").close()
+    assert join_job("mp4", download, config) == temp + "fname.mp4"
+    ph().execute_concat.assert_called_once_with(
+        [temp + "fname.part000.mp4", temp + "fname.part002.mp4"],
+        temp + "fname.mp4",
+        log=logger,
+    )
+
+    delete_segments(download, "mp4", config)
+    assert segment_files(download, "mp4", config) == ([], [])
+    assert os.listdir(temp) == []
+
+
+@patch(MODULE_NAME + ".os")
+def test_delete_job_not_converted(os):
+    os.path.exists.return_value = True
+
+    delete_job("/files/fname.ts", "/files/fname.ts", None)
+
+    assert os.remove.call_count == 2
+    os.remove.assert_any_call("/files/fname.ts")
+    os.remove.assert_any_call("/files/fname.aux")
+
+
+@patch(MODULE_NAME + ".process_download")
+@patch(MODULE_NAME + ".DBStorage")
+def test_run_job_drains_queue(DBStorage, process_download):
+    db = DBStorage.return_value
+    db.claim_download.side_effect = [sentinel.d1, sentinel.d2, None]
+
+    assert run_job(None, sentinel.config) == 2
+
+    assert process_download.call_count == 2
+    db.ack_download.assert_called_with(sentinel.d2)
+    db.close.assert_called_once()
+
+
+@patch(MODULE_NAME + ".probe_channels")
+@patch(MODULE_NAME + ".DBStorage")
+def test_check_channel_up(DBStorage, probe_channels):
+    db = DBStorage.return_value
+    db.get_channels.return_value = [
+        MagicMock(ip_string="1.2.3.4:1234"),
+        MagicMock(ip_string="1.2.3.5:1234"),
+    ]
+    probe_channels.return_value = [
+        ProbeResult(10, 0, {0, 100}, None),
+        ProbeResult(3, 0, {0}, "Timed out"),
+    ]
+    config = {
+        ("recording", "bind"): None,
+        ("recording", "probe_packets"): "10",
+        ("recording", "probe_timeout"): "1",
+        ("recording", "probe_workers"): "4",
+    }
+
+    assert check_channel_up(None, config) == 0
+
+    assert probe_channels.call_args[0][0] == ["1.2.3.4:1234", "1.2.3.5:1234"]
+    checks = db.add_channel_checks.call_args[0][0]
+    assert [x["is_up"] for x in checks] == [True, False]
+    assert checks[1]["message"] == "Timed out"
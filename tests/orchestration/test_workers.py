@@ -0,0 +1,130 @@
+from ProjectNephos.orchestration.workers import WorkerPool, worker_loop, _forward_wakeups
+
+from mock import MagicMock, patch, sentinel
+import pytest
+
+MODULE_NAME = "ProjectNephos.orchestration.workers"
+
+
+def make_config(workers="3", convert="1"):
+    return {
+        ("processing", "workers"): workers,
+        ("processing", "idle_wait"): "0.5",
+        ("processing", "convert_concurrency"): convert,
+        ("processing", "subtitles_concurrency"): "0",
+        ("processing", "upload_concurrency"): "2",
+    }
+
+
+def test_default_object():
+    pool = WorkerPool(make_config())
+
+    assert pool.size == 3
+    assert pool.idle_wait == 0.5
+    assert sorted(pool.limits.keys()) == ["convert", "upload"]
+
+
+@patch(MODULE_NAME + ".multiprocessing.Process")
+def test_start_stop(Process):
+    pool = WorkerPool(make_config())
+    pool.start()
+
+    assert Process.call_count == 3
+    assert Process.return_value.start.call_count == 3
+
+    pool.stop()
+    assert pool.stop_event.is_set()
+    assert Process.return_value.join.call_count == 3
+    assert pool.processes == []
+
+
+@patch(MODULE_NAME + ".multiprocessing.Process")
+def test_notify_wakes_all(Process):
+    pool = WorkerPool(make_config())
+    pool.start()
+
+    wakeups = [x[1]["args"][4] for x in Process.call_args_list]
+    assert len(set(map(id, wakeups))) == 3
+
+    pool.notify()
+    # The first worker to wake up doesn't clear the others' events.
+    wakeups[0].clear()
+    assert all(x.is_set() for x in wakeups[1:])
+
+
+class FakePipeline(object):
+    """
+    Stands in for PostProcessingPipeline and finishes every download immediately.
+    """
+
+    errors = {}
+
+    def __init__(self, config, on_done, limits=None):
+        self.on_done = on_done
+        self.submitted = []
+        self.stopped = False
+        FakePipeline.instance = self
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+    def submit(self, db, download):
+        self.submitted.append(download)
+        recording = MagicMock()
+        recording.download = download
+        recording.error = self.errors.get(download)
+        self.on_done(recording)
+
+
+@pytest.fixture
+def downloads():
+    d1, d2 = MagicMock(), MagicMock()
+    d1.id, d2.id = 1, 2
+    return d1, d2
+
+
+@patch(MODULE_NAME + ".PostProcessingPipeline", FakePipeline)
+@patch(MODULE_NAME + ".DBStorage")
+def test_worker_loop_drains(DBStorage, downloads):
+    db = DBStorage.return_value
+    stop_event = MagicMock()
+    stop_event.is_set.side_effect = [False] * 6 + [True] * 3
+    db.claim_download.side_effect = list(downloads) + [None]
+    FakePipeline.errors = {}
+
+    worker_loop(sentinel.config, sentinel.limits, stop_event, 0.01)
+
+    assert FakePipeline.instance.submitted == list(downloads)
+    assert db.ack_download.call_count == 2
+    assert FakePipeline.instance.stopped
+
+
+@patch(MODULE_NAME + ".PostProcessingPipeline", FakePipeline)
+@patch(MODULE_NAME + ".DBStorage")
+def test_worker_loop_ack_release(DBStorage, downloads):
+    d1, d2 = downloads
+    db = DBStorage.return_value
+    stop_event = MagicMock()
+    stop_event.is_set.side_effect = [False] * 4 + [True] * 3
+    db.claim_download.side_effect = [d1, d2]
+    FakePipeline.errors = {d1: Exception("boom")}
+
+    worker_loop(sentinel.config, None, stop_event, 0.01)
+
+    db.release_download.assert_called_once_with(d1)
+    db.ack_download.assert_called_once_with(d2)
+
+
+def test_forward_wakeups():
+    wakeup, stop_event = MagicMock(), MagicMock()
+    stop_event.is_set.side_effect = [False, False, True]
+    wakeup.wait.side_effect = [True, False]
+    put = MagicMock()
+
+    _forward_wakeups(wakeup, stop_event, 0.01, put)
+
+    put.assert_called_once_with(None)
+    wakeup.clear.assert_called_once()
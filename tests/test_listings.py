@@ -0,0 +1,118 @@
+from ProjectNephos.listings import read_listings, to_cron, _parse_iso
+
+from datetime import datetime, timedelta, timezone
+from mock import patch
+from xml.etree.ElementTree import iterparse
+import io
+
+XMLTV = b"""<?xml version="1.0" encoding="UTF-8"?>
+<tv>
+  <channel id="cnn.us">
+    <display-name>CNN</display-name>
+  </channel>
+  <programme start="20180601200000" stop="20180601203000" channel="cnn.us">
+    <title>News at 8</title>
+    <category>news</category>
+    <category>english</category>
+  </programme>
+  <programme start="20180601203000" stop="20180601213000" channel="bbc.uk">
+    <title>Sports</title>
+  </programme>
+  <programme start="20180601213000" stop="20180601220000" channel="bbc.uk">
+  </programme>
+</tv>
+"""
+
+
+def test_to_cron():
+    assert to_cron(datetime(2018, 6, 1, 20, 5)) == "5 20 1 6 * 2018"
+
+
+def test_read_xmltv():
+    programs = list(read_listings(io.BytesIO(XMLTV), "xmltv"))
+
+    assert programs == [
+        {
+            "channel": "cnn.us",
+            "aliases": ["CNN"],
+            "program": "News at 8",
+            "start": "0 20 1 6 * 2018",
+            "duration": 30,
+            "tags": ["news", "english"],
+        },
+        {
+            "channel": "bbc.uk",
+            "aliases": [],
+            "program": "Sports",
+            "start": "30 20 1 6 * 2018",
+            "duration": 60,
+            "tags": [],
+        },
+        {
+            "channel": "bbc.uk",
+            "aliases": [],
+            "program": None,
+            "start": "30 21 1 6 * 2018",
+            "duration": 30,
+            "tags": [],
+        },
+    ]
+
+
+def test_read_xmltv_clears_root():
+    roots = []
+
+    def spy(f, events):
+        for event, elem in iterparse(f, events):
+            if not roots:
+                roots.append(elem)
+            yield event, elem
+
+    with patch("ProjectNephos.listings.iterparse", spy):
+        list(read_listings(io.BytesIO(XMLTV), "xmltv"))
+
+    # No emptied out elements pile up under the root.
+    assert len(roots[0]) == 0
+
+
+def test_parse_iso():
+    assert _parse_iso("2018-06-01") == datetime(2018, 6, 1)
+    assert _parse_iso("2018-06-01 20:05") == datetime(2018, 6, 1, 20, 5)
+    assert _parse_iso("2018-06-01T20:05:10.5") == datetime(
+        2018, 6, 1, 20, 5, 10, 500000
+    )
+
+    tz = timezone(timedelta(hours=2))
+    assert _parse_iso("2018-06-01T20:05:00+02:00") == datetime(
+        2018, 6, 1, 20, 5, tzinfo=tz
+    )
+    assert _parse_iso("2018-06-01T20:05:00Z") == datetime(
+        2018, 6, 1, 20, 5, tzinfo=timezone.utc
+    )
+
+
+def test_read_csv():
+    f = io.StringIO(
+        "channel,program,start,duration,tags\n"
+        "CNN,News,0 20 * * * *,30,news english\n"
+        "CNN,Late News,2018-06-01T23:00:00,15,\n"
+    )
+    programs = list(read_listings(f, "csv"))
+
+    assert programs[0]["start"] == "0 20 * * * *"
+    assert programs[0]["tags"] == ["news", "english"]
+    assert programs[1]["start"] == "0 23 1 6 * 2018"
+    assert programs[1]["duration"] == 15
+    assert programs[1]["tags"] == []
+
+
+def test_read_json():
+    item = '{"channel": "CNN", "program": "News", "start": "0 20 * * * *", '
+    item += '"duration": 30, "tags": ["news"]}'
+
+    lines = list(read_listings(io.StringIO(item + "\n\n" + item + "\n"), "json"))
+    array = list(read_listings(io.StringIO("  [" + item + "]"), "json"))
+
+    assert len(lines) == 2
+    assert lines[0] == array[0]
+    assert array[0]["tags"] == ["news"]
@@ -0,0 +1,53 @@
+from ProjectNephos.profiles import get_profiles, input_args
+from ProjectNephos.config import Configuration
+
+import pytest
+
+
+@pytest.fixture
+def config(tmpdir):
+    path = tmpdir.join("config.ini")
+    path.write(
+        "[profile:small]\n"
+        "extension = webm\n"
+        "video_codec = libvpx-vp9\n"
+        "video_bitrate = 500k\n"
+        "threads = 4\n"
+        "[profile:broken]\n"
+        "preset = fast\n"
+        "[profile:nested]\n"
+        "renditions = h264_all\n"
+    )
+    return Configuration(str(path))
+
+
+def test_get_profiles(config):
+    assert get_profiles(config, "mp4") is None
+
+    (small,) = get_profiles(config, "small")
+    assert small.output_args() == [
+        "-c:v",
+        "libvpx-vp9",
+        "-b:v",
+        "500k",
+        "-threads",
+        "4",
+    ]
+
+    (sd,) = get_profiles(config, "h264_sd")
+    assert sd.extension == "mp4"
+    assert ["-vf", "scale=-2:480"] == sd.output_args()[6:8]
+
+
+def test_renditions(config):
+    profiles = get_profiles(config, "h264_all")
+    assert [x.name for x in profiles] == ["h264", "h264_sd"]
+    assert input_args(profiles) == ["-threads", "2"]
+    assert input_args(get_profiles(config, "small") + profiles) == ["-threads", "4"]
+
+
+def test_bad_profiles(config):
+    with pytest.raises(ValueError):
+        get_profiles(config, "broken")
+    with pytest.raises(ValueError):
+        get_profiles(config, "nested")
@@ -0,0 +1,93 @@
+from ProjectNephos.runner import parse_ffmpeg_progress, run_process
+from ProjectNephos.exceptions import ProcessFailed
+
+from mock import MagicMock, patch
+import sys
+import threading
+import pytest
+
+MODULE_NAME = "ProjectNephos.runner"
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_output():
+    log = MagicMock()
+    code = "import sys\nfor i in range(100): print(i)\n"
+    code += "sys.stdout.buffer.write(b'\\xff\\n')"
+
+    output = run_process(python(code), log, tail=3)
+
+    assert output == "98\n99\n\ufffd"
+    assert log.debug.call_count == 101
+
+
+def test_carriage_returns():
+    output = run_process(python("print('10%\\r20%\\r30%')"))
+    assert output == "10%\n20%\n30%"
+
+
+def test_failure():
+    with pytest.raises(ProcessFailed) as e:
+        run_process(python("print('oops'); raise SystemExit(3)"))
+
+    assert e.value.returncode == 3
+    assert e.value.output == "oops"
+
+
+def test_not_found():
+    with pytest.raises(FileNotFoundError):
+        run_process(["/nonexistent/ffmpeg"])
+
+
+@patch(MODULE_NAME + ".POLL_INTERVAL", 0.01)
+def test_timeout():
+    with pytest.raises(ProcessFailed) as e:
+        code = "import time; print('start', flush=True); time.sleep(30)"
+        run_process(python(code), timeout=0.2)
+
+    assert "timed out" in str(e.value)
+    assert e.value.output == "start"
+
+
+@patch(MODULE_NAME + ".POLL_INTERVAL", 0.01)
+def test_cancel():
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+
+    with pytest.raises(ProcessFailed) as e:
+        run_process(python("import time; time.sleep(30)"), cancel=cancel)
+    assert "cancelled" in str(e.value)
+
+
+def test_progress():
+    report = "frame=10\\nfps=25.0\\nout_time_us=400000\\nspeed=1.5x\\nprogress={}"
+    code = "print('Input #0'); print('{}'); print('{}')".format(
+        report.format("continue"), report.format("end")
+    )
+    on_progress = MagicMock()
+
+    output = run_process(python(code), on_progress=on_progress)
+
+    assert output == "Input #0"
+    assert on_progress.call_count == 2
+    assert on_progress.call_args[0][0] == {
+        "frame": 10,
+        "fps": 25.0,
+        "total_size": None,
+        "out_time": 0.4,
+        "speed": 1.5,
+        "done": True,
+    }
+
+
+def test_parse_progress():
+    progress = parse_ffmpeg_progress(
+        {"out_time_ms": "1000000", "speed": "N/A", "total_size": "2048"}
+    )
+    assert progress["out_time"] == 1
+    assert progress["speed"] is None
+    assert progress["total_size"] == 2048
+    assert not progress["done"]